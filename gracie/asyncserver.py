@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+
+# gracie/asyncserver.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Event-loop HTTP front end
+
+    The event loop owns every connection, and only reads and writes
+    bytes. Once a complete request has arrived it is handed, with the
+    request bytes, to the usual request handler class running in a
+    worker thread; the handler's output is then written back from the
+    event loop. Idle and slow connections therefore hold no thread.
+
+    """
+
+import sys
+import os
+import socket
+import asyncore
+import logging
+import time
+import Queue
+from StringIO import StringIO
+
+from httpserver import net_location, ConnectionStats
+from httpresponse import ResponseHeader, Response
+from workerpool import WorkerPool
+
+# Get the Python logging instance for this module
+_logger = logging.getLogger("gracie.asyncserver")
+
+listen_backlog = 128
+recv_size = 8192
+max_header_size = 65536
+max_body_size = 1024 * 1024
+max_buffer_size = max_header_size + max_body_size
+idle_check_interval = 1.0
+
+
+class _RequestBuffer(object):
+    """ File-like object collecting a handler's output """
+
+    def __init__(self):
+        """ Set up a new instance """
+        self._chunks = []
+        self.closed = False
+
+    def write(self, data):
+        """ Append data to the buffer """
+        self._chunks.append(data)
+
+    def flush(self):
+        """ Nothing to flush; data is sent by the event loop """
+
+    def close(self):
+        """ Mark the buffer closed, keeping its contents """
+        self.closed = True
+
+    def getvalue(self):
+        """ Get all the data written to the buffer """
+        return "".join(self._chunks)
+
+
+class _BufferedConnection(object):
+    """ Connection stand-in serving a request from memory """
+
+    # The handler should read only the one buffered request
+    single_request = True
+
+    def __init__(self, request_text, requests_served=0):
+        """ Set up a new instance """
+        self.request_text = request_text
+        self.requests_served = requests_served
+        self.response = _RequestBuffer()
+
+    def settimeout(self, timeout):
+        """ Ignore the timeout; the event loop closes idle channels """
+
+    def makefile(self, mode, bufsize=-1):
+        """ Make a file handle to the connection stream """
+        if mode.startswith('r'):
+            conn_file = StringIO(self.request_text)
+        else:
+            conn_file = self.response
+        return conn_file
+
+
+class RequestError(Exception):
+    """ Raised when buffered data cannot be framed as a request """
+
+    def __init__(self, code, reason):
+        """ Set up a new instance """
+        Exception.__init__(self, code, reason)
+        self.code = code
+        self.reason = reason
+
+
+def find_request_end(data):
+    """ Find the end of the first complete request in ``data``
+
+        Return the offset just past the request, or ``None`` if the
+        data does not yet hold a complete request. Raise
+        `RequestError` if the request cannot be framed: its header
+        or body is too large, its Content-Length is not a
+        non-negative number, or it uses a Transfer-Encoding.
+
+        """
+    header_end = None
+    for separator in ("\r\n\r\n", "\n\n"):
+        index = data.find(separator)
+        if index >= 0:
+            end = index + len(separator)
+            if header_end is None or end < header_end:
+                header_end = end
+    if header_end is None:
+        if len(data) > max_header_size:
+            raise RequestError(400, "Request header too large")
+        return None
+    if header_end > max_header_size:
+        raise RequestError(400, "Request header too large")
+
+    content_length = None
+    for line in data[:header_end].splitlines()[1:]:
+        (name, _, value) = line.partition(":")
+        name = name.strip().lower()
+        if name == "transfer-encoding":
+            raise RequestError(400, "Transfer-Encoding not supported")
+        if name == "content-length":
+            value = value.strip()
+            if not value.isdigit():
+                raise RequestError(400, "Invalid Content-Length")
+            if content_length not in (None, int(value)):
+                raise RequestError(400, "Conflicting Content-Length")
+            content_length = int(value)
+    if content_length is None:
+        content_length = 0
+    if content_length > max_body_size:
+        raise RequestError(413, "Request body too large")
+    request_end = header_end + content_length
+    if len(data) < request_end:
+        return None
+    return request_end
+
+
+class AsyncHTTPChannel(asyncore.dispatcher):
+    """ Event-loop side of a single client connection """
+
+    def __init__(self, sock, client_address, server):
+        """ Set up a new instance """
+        asyncore.dispatcher.__init__(self, sock, map=server.socket_map)
+        self.client_address = client_address
+        self.server = server
+        self.in_buffer = ""
+        self.out_buffer = ""
+        self.busy = False
+        self.closing = False
+        self.requests_served = 0
+        self.last_activity = time.time()
+
+    def is_idle_since(self, when):
+        """ Report whether the channel has been idle since ``when`` """
+        idle = (
+            not self.busy and not self.out_buffer
+            and self.last_activity < when
+            )
+        return idle
+
+    def readable(self):
+        """ Read while not closing and the buffer has room
+
+            While a request is being handled, pipelined requests are
+            buffered until the buffer could hold a complete request
+            of the largest size allowed; reading then waits until the
+            handler has finished.
+
+            """
+        if self.closing:
+            return False
+        return len(self.in_buffer) < max_buffer_size
+
+    def writable(self):
+        """ Write while there is response data pending """
+        return bool(self.out_buffer)
+
+    def handle_read(self):
+        """ Receive data and start any complete request """
+        data = self.recv(recv_size)
+        if not data:
+            self.closing = True
+            if not self.busy and not self.out_buffer:
+                self.close()
+            return
+        self.last_activity = time.time()
+        self.in_buffer += data
+        self._start_next_request()
+
+    def _start_next_request(self):
+        """ Send the next complete buffered request to a worker """
+        if self.busy or self.closing:
+            return
+        try:
+            request_end = find_request_end(self.in_buffer)
+        except RequestError, e:
+            reason = e.reason
+            _logger.warn("Bad request: %(reason)s; closing" % vars())
+            self.in_buffer = ""
+            self.send_error_response(e.code, reason)
+            return
+        if request_end is None:
+            return
+        request_text = self.in_buffer[:request_end]
+        self.in_buffer = self.in_buffer[request_end:]
+        self.busy = True
+        self.server.submit_request(self, request_text)
+
+    def send_error_response(self, code, reason):
+        """ Send an error response and close the connection """
+        self.out_buffer += self.server.make_error_response(code, reason)
+        self.closing = True
+
+    def request_done(self, response_text, close_connection):
+        """ Queue a finished response for sending """
+        self.busy = False
+        self.requests_served += 1
+        self.last_activity = time.time()
+        self.out_buffer += response_text
+        if close_connection:
+            self.closing = True
+        if not self.out_buffer and self.closing:
+            self.close()
+        else:
+            self._start_next_request()
+
+    def handle_write(self):
+        """ Send pending response data """
+        sent = self.send(self.out_buffer)
+        self.last_activity = time.time()
+        self.out_buffer = self.out_buffer[sent:]
+        if not self.out_buffer and self.closing and not self.busy:
+            self.close()
+
+    def handle_close(self):
+        """ Close the connection when the client does """
+        self.close()
+
+    def handle_error(self):
+        """ Log an unexpected error and drop the connection """
+        (_, e, _) = sys.exc_info()
+        message = str(e)
+        _logger.error(message)
+        self.close()
+
+
+class _Waker(asyncore.file_dispatcher):
+    """ Pipe used by worker threads to wake the event loop """
+
+    def __init__(self, server):
+        """ Set up a new instance """
+        (read_fd, self.write_fd) = os.pipe()
+        asyncore.file_dispatcher.__init__(
+            self, read_fd, map=server.socket_map)
+        os.close(read_fd)
+        self.server = server
+
+    def writable(self):
+        """ Never wait to write to the wake-up pipe """
+        return False
+
+    def wake(self):
+        """ Wake the event loop from another thread """
+        os.write(self.write_fd, "x")
+
+    def handle_read(self):
+        """ Drain the wake-up pipe and deliver finished responses """
+        try:
+            self.recv(recv_size)
+        except OSError:
+            pass
+        self.server.deliver_responses()
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    """ Event-loop server for HTTP protocol requests """
+
+    # Idle connections hold no thread, so they may be kept open
+    persistent_connections = True
+
+    def __init__(
+        self,
+        server_address, RequestHandlerClass, gracie_server,
+        num_threads, queue_size, reuse_port=False,
+        ):
+        """ Set up a new instance """
+        self.socket_map = dict()
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.gracie_server = gracie_server
+        self.RequestHandlerClass = RequestHandlerClass
+        self.version = self.gracie_server.version
+        version = self.version
+        _logger.info(
+            "Starting Gracie event-loop HTTP server (version %(version)s)"
+            % vars()
+            )
+        self.reuse_port = reuse_port
+        self.server_address = server_address
+        self.executor = WorkerPool(
+            num_threads, queue_size, name="http-executor")
+        self._finished = Queue.Queue()
+        self.connection_stats = ConnectionStats()
+        self.server_bind()
+        self.listen(listen_backlog)
+        location = net_location(*self.server_address)
+        _logger.info("Listening on address %(location)s" % vars())
+
+    def server_bind(self):
+        """ Bind and name the server """
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if self.reuse_port:
+            reuse_port_option = getattr(socket, 'SO_REUSEPORT', None)
+            if reuse_port_option is not None:
+                self.socket.setsockopt(
+                    socket.SOL_SOCKET, reuse_port_option, 1)
+        self.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+        (host, port) = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.server_location = net_location(
+            self.server_name, self.server_port
+            )
+
+    def handle_accept(self):
+        """ Accept a new client connection """
+        pair = self.accept()
+        if pair is None:
+            return
+        (sock, client_address) = pair
+        AsyncHTTPChannel(sock, client_address, self)
+
+    def make_error_response(self, code, reason):
+        """ Make the text of an error response closing the connection """
+        header = ResponseHeader(code, content_type="text/plain")
+        header.fields.append(("Connection", "close"))
+        response = Response(header, "%(reason)s\n" % vars())
+        version = self.version
+        server_version = "Gracie/%(version)s" % vars()
+        return response.serialise("HTTP/1.1", server_version)
+
+    def submit_request(self, channel, request_text):
+        """ Hand a complete request to a worker thread
+
+            The event loop never waits for room in the executor
+            queue; when it is full the request is refused.
+
+            """
+        queued = self.executor.try_submit(
+            self._run_handler, channel, request_text)
+        if not queued:
+            _logger.warn("Request queue full; refusing request")
+            channel.busy = False
+            channel.send_error_response(503, "Server busy")
+
+    def _run_handler(self, channel, request_text):
+        """ Run the request handler in a worker thread """
+        connection = _BufferedConnection(
+            request_text, channel.requests_served)
+        close_connection = True
+        try:
+            handler = self.RequestHandlerClass(
+                connection, channel.client_address, self)
+            close_connection = handler.close_connection
+        except Exception, e:
+            message = str(e)
+            _logger.error(message)
+        response_text = connection.response.getvalue()
+        self._finished.put((channel, response_text, close_connection))
+        self._waker.wake()
+
+    def deliver_responses(self):
+        """ Pass finished responses to their channels """
+        while True:
+            try:
+                (channel, response_text, close_connection) = (
+                    self._finished.get_nowait())
+            except Queue.Empty:
+                break
+            if channel.connected:
+                channel.request_done(response_text, close_connection)
+
+    def close_idle_channels(self, idle_timeout):
+        """ Close client channels idle for longer than the timeout """
+        idle_since = time.time() - idle_timeout
+        for channel in self.socket_map.values():
+            if not isinstance(channel, AsyncHTTPChannel):
+                continue
+            if channel.is_idle_since(idle_since):
+                channel.close()
+
+    def serve_forever(self):
+        """ Begin serving requests indefinitely """
+        idle_timeout = self.gracie_server.opts.keepalive_timeout
+        self._waker = _Waker(self)
+        self.executor.start()
+        next_idle_check = time.time() + idle_check_interval
+        while self.socket_map:
+            asyncore.loop(
+                timeout=idle_check_interval, use_poll=True,
+                map=self.socket_map, count=1)
+            now = time.time()
+            if now >= next_idle_check:
+                self.close_idle_channels(idle_timeout)
+                next_idle_check = now + idle_check_interval
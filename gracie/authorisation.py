@@ -11,31 +11,509 @@
 """ Behaviour for authorisation of OpenID requests
 """
 
+import os
+import time
+import threading
+import fcntl
+import marshal
+import gc
 import logging
 
+from striped import StripedDict
+from interning import intern_value
+
 # Get the Python logging instance for this module
 _logger = logging.getLogger("gracie.authorisation")
 
+# Seconds an authorisation is remembered by default
+default_auth_ttl = 30 * 24 * 60 * 60
+
+# Authorisations kept for each identity
+default_max_per_identity = 100
+
+# Version of the authorisation snapshot file format
+snapshot_version = 1
+
+# Log records written before the log is compacted, at least
+compact_min_records = 10000
+
+# Seconds between checks for changes written by other processes
+refresh_interval = 1.0
+
+
 
 class ConsumerAuthStore(object):
-    """ Storage for consumer request authorisations """
+    """ Storage for consumer request authorisations
+
+        Authorisations are grouped by identity, each mapping its known
+        roots to (status, expires) pairs, so that all those for an
+        identity are found and removed together. An identity keeps at
+        most `max_per_identity` authorisations; storing another
+        discards the one nearest to expiry.
 
-    def __init__(self):
+        """
+
+    def __init__(
+        self, default_ttl=None,
+        max_per_identity=default_max_per_identity,
+        ):
         """ Set up a new instance """
-        self._authorisations = dict()
+        self.default_ttl = default_ttl
+        self.max_per_identity = max_per_identity
+        self._identities = StripedDict()
+        self._count_lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def _count(self, name, increment=1):
+        """ Add to one of the store counters """
+        self._count_lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + increment)
+        finally:
+            self._count_lock.release()
+
+    def _expiry_time(self, ttl):
+        """ Get the expiry time for a TTL, or None to keep forever """
+        if ttl is None:
+            ttl = self.default_ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        return expires
 
     def is_authorised(self, auth_tuple):
         """ Report authorisation of an (identity, known_root) tuple """
-        is_authorised = self._authorisations.get(
-            auth_tuple, False)
-        return is_authorised
+        (identity, known_root) = [intern_value(item) for item in auth_tuple]
+        stripe = self._identities.stripe_for(identity)
+        stripe.acquire()
+        try:
+            entry = None
+            known_roots = stripe.mapping.get(identity)
+            if known_roots is not None:
+                entry = known_roots.get(known_root)
+            if entry is None:
+                return False
+            (status, expires) = entry
+            is_expired = (expires is not None and expires <= time.time())
+            if is_expired:
+                self._discard(stripe.mapping, identity, known_root)
+        finally:
+            stripe.release()
+        if is_expired:
+            self._count("expired")
+            return False
+        return status
+
+    def _discard(self, identities, identity, known_root):
+        """ Remove an authorisation from a stripe's mapping """
+        known_roots = identities.get(identity)
+        if known_roots is not None:
+            known_roots.pop(known_root, None)
+            if not known_roots:
+                del identities[identity]
+
+    def _store_entry(self, identity, known_root, status, expires):
+        """ Store an authorisation, keeping within the identity's cap """
+        stripe = self._identities.stripe_for(identity)
+        num_evicted = 0
+        stripe.acquire()
+        try:
+            known_roots = stripe.mapping.get(identity)
+            if known_roots is None:
+                known_roots = stripe.mapping[identity] = dict()
+            if known_root not in known_roots:
+                while len(known_roots) >= self.max_per_identity:
+                    nearest_root = min(
+                        known_roots, key=lambda root: (
+                            known_roots[root][1] is None,
+                            known_roots[root][1]))
+                    del known_roots[nearest_root]
+                    num_evicted += 1
+            known_roots[known_root] = (status, expires)
+        finally:
+            stripe.release()
+        if num_evicted:
+            self._count("evicted", num_evicted)
+
+    def _remove_entry(self, identity, known_root):
+        """ Remove an authorisation """
+        stripe = self._identities.stripe_for(identity)
+        stripe.acquire()
+        try:
+            self._discard(stripe.mapping, identity, known_root)
+        finally:
+            stripe.release()
+
+    def _remove_identities(self, identities):
+        """ Remove every authorisation for the identities """
+        removed = self._identities.pop_many(identities)
+        num_removed = sum([
+            len(known_roots) for known_roots in removed.values()])
+        return num_removed
 
-    def store_authorisation(self, auth_tuple, status):
-        """ Store an authorisation status """
-        self._authorisations[auth_tuple] = status
+    def store_authorisation(self, auth_tuple, status, ttl=None):
+        """ Store an authorisation status
+
+            The status is remembered for `ttl` seconds, or for the
+            store's default TTL if not specified.
+
+            """
+        (identity, known_root) = [intern_value(item) for item in auth_tuple]
+        expires = self._expiry_time(ttl)
+        self._store_entry(identity, known_root, status, expires)
 
     def remove_authorisation(self, auth_tuple):
         """ Remove an authorisation status """
-        if auth_tuple in self._authorisations:
-            del self._authorisations[auth_tuple]
+        (identity, known_root) = [intern_value(item) for item in auth_tuple]
+        self._remove_entry(identity, known_root)
+
+    def remove_identity(self, identity):
+        """ Remove every authorisation for an identity
+
+            Return the number of authorisations removed.
+
+            """
+        return self.remove_identities([identity])
+
+    def remove_identities(self, identities):
+        """ Remove every authorisation for each identity
+
+            Return the number of authorisations removed.
+
+            """
+        identities = [intern_value(identity) for identity in identities]
+        return self._remove_identities(identities)
+
+    def _copy_entries(self):
+        """ Get a dict of identity to unexpired authorisations """
+        now = time.time()
+        entries = dict()
+        for stripe in self._identities.stripes:
+            stripe.acquire()
+            try:
+                for (identity, known_roots) in stripe.mapping.items():
+                    known_roots = dict([
+                        (known_root, entry)
+                        for (known_root, entry) in known_roots.items()
+                        if entry[1] is None or entry[1] > now])
+                    if known_roots:
+                        entries[identity] = known_roots
+            finally:
+                stripe.release()
+        return entries
+
+    def _load_entries(self, entries):
+        """ Replace the stored authorisations with a dict of entries """
+        stripes = self._identities.stripes
+        mappings = [dict() for stripe in stripes]
+        num_stripes = len(stripes)
+        for (identity, known_roots) in entries.iteritems():
+            mappings[hash(identity) % num_stripes][identity] = known_roots
+        for (stripe, mapping) in zip(stripes, mappings):
+            stripe.acquire()
+            try:
+                stripe.mapping = mapping
+            finally:
+                stripe.release()
+
+    def __len__(self):
+        num_entries = 0
+        for stripe in self._identities.stripes:
+            stripe.acquire()
+            try:
+                num_entries += sum([
+                    len(known_roots)
+                    for known_roots in stripe.mapping.values()])
+            finally:
+                stripe.release()
+        return num_entries
+
+    def get_stats(self):
+        """ Get a dict of the store counters """
+        stats = self._identities.get_stats()
+        stats.update(dict(
+            size = len(self),
+            identities = stats['size'],
+            expired = self.expired,
+            evicted = self.evicted,
+            ))
+        return stats
+
+
+
+class LoggedConsumerAuthStore(ConsumerAuthStore):
+    """ Consumer authorisations persisted in an append-only log
+
+        Each change is appended to the log file ``path + ".log"`` as
+        a marshalled record. Once the log has grown past an eighth of
+        the authorisations, or `compact_min_records`, the unexpired
+        authorisations are written as a single marshalled snapshot at
+        `path` and the log is emptied. Starting up loads the snapshot
+        in one read and replays only the log written since.
+
+        Worker processes sharing the files each keep their own copy,
+        picking up changes made by the others every
+        `refresh_interval` seconds. Appends hold a shared lock on the
+        log, and compaction an exclusive one.
+
+        """
+
+    def __init__(
+        self, path, default_ttl=None,
+        max_per_identity=default_max_per_identity,
+        ):
+        """ Set up a new instance """
+        super(LoggedConsumerAuthStore, self).__init__(
+            default_ttl, max_per_identity)
+        self.path = path
+        self.log_path = path + ".log"
+        self._log_lock = threading.RLock()
+        self._log_fd = None
+        self._log_pid = None
+        self._log_offset = 0
+        self._log_records = 0
+        self._snapshot_id = None
+        self._snapshot_size = 0
+        self._last_refresh = 0
+        self.compactions = 0
+        self._log_lock.acquire()
+        try:
+            self._lock_log(fcntl.LOCK_EX)
+            try:
+                self._load(truncate=True)
+            finally:
+                self._unlock_log()
+        finally:
+            self._log_lock.release()
+
+    def _get_log_fd(self):
+        """ Get the log file descriptor for this process
+
+            Locks on the log belong to an open file, so each process
+            opens the log itself rather than sharing a descriptor
+            inherited from its parent.
+
+            """
+        pid = os.getpid()
+        if self._log_fd is None or self._log_pid != pid:
+            self._log_fd = os.open(
+                self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0600)
+            self._log_pid = pid
+        return self._log_fd
+
+    def _lock_log(self, operation):
+        """ Lock the log against other processes """
+        fcntl.flock(self._get_log_fd(), operation)
+
+    def _unlock_log(self):
+        """ Release this process's lock on the log """
+        fcntl.flock(self._get_log_fd(), fcntl.LOCK_UN)
+
+    def _get_snapshot_id(self):
+        """ Get a value identifying the current snapshot file """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def _load(self, truncate=False):
+        """ Load the snapshot and replay the log after it """
+        started = time.time()
+        entries = dict()
+        self._snapshot_id = self._get_snapshot_id()
+        if self._snapshot_id is not None:
+            snapshot_file = open(self.path, 'rb')
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                (version, entries) = marshal.load(snapshot_file)
+            finally:
+                if gc_enabled:
+                    gc.enable()
+                snapshot_file.close()
+            if version != snapshot_version:
+                path = self.path
+                raise ValueError(
+                    "Unknown authorisation snapshot version"
+                    " %(version)r in %(path)r" % vars())
+        self._load_entries(entries)
+        self._snapshot_size = sum([
+            len(known_roots) for known_roots in entries.itervalues()])
+        self._log_offset = 0
+        self._log_records = 0
+        self._replay_log(truncate)
+        num_entries = len(self)
+        duration = time.time() - started
+        _logger.info(
+            "Loaded %(num_entries)d authorisations"
+            " in %(duration).3f seconds" % vars())
+
+    def _replay_log(self, truncate=False):
+        """ Apply the log records written since last read
+
+            Reading stops before a partly written record at the end
+            of the log. If `truncate` is true, the log must be locked
+            exclusively, and such a record is left by a failed write
+            and is cut from the file so that later records follow a
+            complete one.
+
+            """
+        if not os.path.exists(self.log_path):
+            return
+        log_file = open(self.log_path, 'rb')
+        try:
+            log_file.seek(self._log_offset)
+            while True:
+                offset = log_file.tell()
+                try:
+                    record = marshal.load(log_file)
+                except (EOFError, ValueError, TypeError):
+                    break
+                self._apply(record)
+                self._log_records += 1
+            log_size = os.fstat(log_file.fileno()).st_size
+        finally:
+            log_file.close()
+        self._log_offset = offset
+        if truncate and offset < log_size:
+            log_path = self.log_path
+            _logger.warn(
+                "Discarded incomplete record from %(log_path)r" % vars())
+            os.ftruncate(self._get_log_fd(), offset)
+
+    def _apply(self, record):
+        """ Apply a log record to the stored authorisations """
+        operation = record[0]
+        if operation == "s":
+            (identity, known_root, status, expires) = record[1:]
+            self._store_entry(
+                intern_value(identity), intern_value(known_root),
+                status, expires)
+        elif operation == "r":
+            (identity, known_root) = record[1:]
+            self._remove_entry(identity, known_root)
+        elif operation == "i":
+            self._remove_identities(record[1:])
+
+    def _append(self, record):
+        """ Append a record to the log, compacting it when due
+
+            If the record directly follows the log already read, it
+            is counted and skipped over here; otherwise it is left for
+            the next replay, along with the records before it.
+
+            """
+        data = marshal.dumps(record)
+        self._log_lock.acquire()
+        try:
+            self._lock_log(fcntl.LOCK_SH)
+            try:
+                log_fd = self._get_log_fd()
+                os.write(log_fd, data)
+                log_size = os.fstat(log_fd).st_size
+            finally:
+                self._unlock_log()
+            if log_size == self._log_offset + len(data):
+                self._log_offset = log_size
+                self._log_records += 1
+            compact_threshold = max(
+                compact_min_records, self._snapshot_size // 8)
+            if self._log_records >= compact_threshold:
+                self.compact()
+        finally:
+            self._log_lock.release()
+
+    def refresh(self, force=False):
+        """ Pick up changes written by other processes """
+        now = time.time()
+        if not force and now - self._last_refresh < refresh_interval:
+            return
+        self._last_refresh = now
+        self._log_lock.acquire()
+        try:
+            self._lock_log(fcntl.LOCK_SH)
+            try:
+                if self._get_snapshot_id() != self._snapshot_id:
+                    self._load()
+                else:
+                    self._replay_log()
+            finally:
+                self._unlock_log()
+        finally:
+            self._log_lock.release()
+
+    def compact(self):
+        """ Write a snapshot of the authorisations and empty the log """
+        self._log_lock.acquire()
+        try:
+            self._lock_log(fcntl.LOCK_EX)
+            try:
+                if self._get_snapshot_id() != self._snapshot_id:
+                    self._load(truncate=True)
+                else:
+                    self._replay_log(truncate=True)
+                entries = self._copy_entries()
+                temp_path = self.path + ".new"
+                snapshot_fd = os.open(
+                    temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+                snapshot_file = os.fdopen(snapshot_fd, 'wb')
+                try:
+                    marshal.dump((snapshot_version, entries), snapshot_file)
+                    snapshot_file.flush()
+                    os.fsync(snapshot_file.fileno())
+                finally:
+                    snapshot_file.close()
+                os.rename(temp_path, self.path)
+                os.ftruncate(self._get_log_fd(), 0)
+                self._snapshot_id = self._get_snapshot_id()
+                self._snapshot_size = sum([
+                    len(known_roots) for known_roots in entries.values()])
+                self._log_offset = 0
+                self._log_records = 0
+                self.compactions += 1
+            finally:
+                self._unlock_log()
+        finally:
+            self._log_lock.release()
+        num_entries = self._snapshot_size
+        _logger.info(
+            "Compacted authorisation log to %(num_entries)d entries"
+            % vars())
+
+    def is_authorised(self, auth_tuple):
+        """ Report authorisation of an (identity, known_root) tuple """
+        self.refresh()
+        return super(LoggedConsumerAuthStore, self).is_authorised(
+            auth_tuple)
+
+    def store_authorisation(self, auth_tuple, status, ttl=None):
+        """ Store an authorisation status and log it """
+        (identity, known_root) = [intern_value(item) for item in auth_tuple]
+        expires = self._expiry_time(ttl)
+        self._store_entry(identity, known_root, status, expires)
+        self._append(("s", identity, known_root, status, expires))
+
+    def remove_authorisation(self, auth_tuple):
+        """ Remove an authorisation status and log it """
+        (identity, known_root) = [intern_value(item) for item in auth_tuple]
+        self._remove_entry(identity, known_root)
+        self._append(("r", identity, known_root))
+
+    def remove_identities(self, identities):
+        """ Remove every authorisation for each identity and log it """
+        identities = [intern_value(identity) for identity in identities]
+        num_removed = self._remove_identities(identities)
+        self._append(("i",) + tuple(identities))
+        return num_removed
 
+    def get_stats(self):
+        """ Get a dict of the store counters """
+        stats = super(LoggedConsumerAuthStore, self).get_stats()
+        stats.update(dict(
+            log_records = self._log_records,
+            compactions = self.compactions,
+            ))
+        return stats
@@ -11,14 +11,54 @@
 """ Authentication services interface
 """
 
+import os
+import sys
 import pwd
 import PAM
+import time
+import errno
 import logging
+import threading
+
+from cache import LRUCache
 
 _logger = logging.getLogger("gracie.auth")
 
 pam_service_name = "gracie"
 
+# Account entries, and separately names not found, kept in memory
+default_entry_cache_size = 1024
+
+# Seconds an account entry is kept before it is looked up again
+default_entry_ttl = 5 * 60
+
+# Seconds a name not found is remembered as missing
+default_negative_ttl = 30
+
+# File whose modification discards all cached account entries
+passwd_path = "/etc/passwd"
+
+# Seconds between checks of the password file for changes
+passwd_check_interval = 1.0
+
+# PAM handles that may be in use at once
+default_max_pam_handles = 4
+
+# Authentications performed with a PAM handle before it is replaced
+default_pam_handle_max_uses = 100
+
+# Seconds a caller waits for PAM before giving up on an authentication
+default_auth_deadline = 10.0
+
+# Consecutive backend failures after which authentication fails fast
+default_breaker_threshold = 5
+
+# Seconds authentication fails fast before the backend is probed again
+default_breaker_reset = 30.0
+
+# Upper bounds in seconds of the backend latency histogram buckets
+latency_buckets = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
 
 class AuthenticationError(EnvironmentError):
     """ Raised when an authentication request fails """
@@ -27,6 +67,176 @@ class AuthenticationError(EnvironmentError):
         """ Set up a new instance """
         EnvironmentError.__init__(self, code, reason)
 
+
+class AuthServiceUnavailableError(AuthenticationError):
+    """ Raised when the authentication backend cannot give an answer """
+
+
+class CircuitBreaker(object):
+    """ Breaker failing calls fast while a backend keeps failing
+
+        After `threshold` consecutive failures the breaker opens, and
+        calls are refused without reaching the backend. Once
+        `reset_timeout` seconds have passed, one call is let through
+        as a probe: if it succeeds the breaker closes, otherwise it
+        opens again.
+
+        """
+
+    closed = "closed"
+    open = "open"
+    half_open = "half-open"
+
+    def __init__(
+        self,
+        threshold=default_breaker_threshold,
+        reset_timeout=default_breaker_reset,
+        ):
+        """ Set up a new instance """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.closed
+        self.failures = 0
+        self._opened_time = None
+        self._lock = threading.Lock()
+        self.opens = 0
+        self.probes = 0
+        self.rejected = 0
+
+    def allow(self):
+        """ Report whether a call may go to the backend now """
+        self._lock.acquire()
+        try:
+            if self.state == self.closed:
+                return True
+            now = time.time()
+            if (self.state == self.open
+                    and now - self._opened_time >= self.reset_timeout):
+                self.state = self.half_open
+                self.probes += 1
+                return True
+            self.rejected += 1
+            return False
+        finally:
+            self._lock.release()
+
+    def record_success(self):
+        """ Record that the backend answered """
+        self._lock.acquire()
+        try:
+            if self.state != self.closed:
+                _logger.warn("Authentication backend recovered")
+            self.state = self.closed
+            self.failures = 0
+        finally:
+            self._lock.release()
+
+    def record_failure(self):
+        """ Record that the backend failed to answer """
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if self.state == self.open:
+                return
+            if (self.state == self.half_open
+                    or self.failures >= self.threshold):
+                failures = self.failures
+                _logger.warn(
+                    "Authentication backend failing after"
+                    " %(failures)d failures; failing fast" % vars())
+                self.state = self.open
+                self._opened_time = time.time()
+                self.opens += 1
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """ Get a dict of the breaker state and counters """
+        stats = dict(
+            state = self.state,
+            failures = self.failures,
+            opens = self.opens,
+            probes = self.probes,
+            rejected = self.rejected,
+            )
+        return stats
+
+
+class LatencyHistogram(object):
+    """ Counts of durations in buckets bounded by `latency_buckets` """
+
+    def __init__(self, bounds=latency_buckets):
+        """ Set up a new instance """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, duration):
+        """ Count one duration in seconds """
+        index = 0
+        for bound in self.bounds:
+            if duration <= bound:
+                break
+            index += 1
+        self._lock.acquire()
+        try:
+            self.counts[index] += 1
+            self.total += duration
+            self.max = max(self.max, duration)
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """ Get a dict of the count, total, maximum and bucket counts """
+        stats = dict(
+            count = sum(self.counts),
+            total = self.total,
+            max = self.max,
+            buckets = zip(self.bounds + (None,), self.counts),
+            )
+        return stats
+
+
+class _DeadlineCall(object):
+    """ Call of a function in its own thread, waited on with a deadline
+
+        A call that misses its deadline is abandoned rather than
+        interrupted; its thread finishes in the background.
+
+        """
+
+    def __init__(self, func, *args):
+        """ Set up a new instance """
+        self.func = func
+        self.args = args
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def _run(self):
+        """ Run the function, keeping its result or exception """
+        try:
+            self._result = self.func(*self.args)
+        except:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def __call__(self, deadline):
+        """ Start the call and wait for it for `deadline` seconds """
+        thread = threading.Thread(target=self._run, name="auth-call")
+        thread.setDaemon(True)
+        thread.start()
+        self._done.wait(deadline)
+        if not self._done.isSet():
+            raise AuthServiceUnavailableError(
+                errno.ETIMEDOUT, "Authentication timed out")
+        if self._exc_info is not None:
+            (exc_type, exc_value, exc_tb) = self._exc_info
+            raise exc_type, exc_value, exc_tb
+        return self._result
+
 
 class BaseAuthService(object):
     """ Abstract interface to an authentication service """
@@ -44,7 +254,32 @@ class BaseAuthService(object):
 
 
 class PosixAuthService(BaseAuthService):
-    """ Interface to POSIX authentication service """
+    """ Interface to POSIX authentication service
+
+        Account lookups may go to a directory service over the
+        network, so entries found are cached for `entry_ttl` seconds
+        and names not found for `negative_ttl` seconds. Names not
+        found are kept apart from the entries, so lookups of bogus
+        names cannot evict real accounts. Both caches are emptied
+        when the password file changes.
+
+        """
+
+    def __init__(
+        self,
+        entry_cache_size=default_entry_cache_size,
+        entry_ttl=default_entry_ttl,
+        negative_ttl=default_negative_ttl,
+        ):
+        """ Set up a new instance """
+        super(PosixAuthService, self).__init__()
+        self.entry_ttl = entry_ttl
+        self.negative_ttl = negative_ttl
+        self._entry_cache = LRUCache(entry_cache_size)
+        self._negative_cache = LRUCache(entry_cache_size)
+        self._passwd_mtime = None
+        self._last_passwd_check = 0
+        self.invalidations = 0
 
     def _pwd_entry_to_auth_entry(self, pwd_entry):
         """ Construct an auth entry from a pwd entry """
@@ -57,12 +292,77 @@ class PosixAuthService(BaseAuthService):
             )
         return entry
 
-    def get_entry(self, value):
-        """ Get an entry from the service by key value """
+    def _check_passwd_file(self, now):
+        """ Empty the caches if the password file has changed """
+        if now - self._last_passwd_check < passwd_check_interval:
+            return
+        self._last_passwd_check = now
+        try:
+            mtime = os.stat(passwd_path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._passwd_mtime:
+            if self._passwd_mtime is not None:
+                _logger.info("Password file changed, discarding entries")
+                self.invalidations += 1
+            self._passwd_mtime = mtime
+            self._entry_cache.clear()
+            self._negative_cache.clear()
+
+    def _lookup_entry(self, value):
+        """ Look up an entry in the password database """
         pwd_entry = pwd.getpwnam(value)
         entry = self._pwd_entry_to_auth_entry(pwd_entry)
         return entry
 
+    def get_entry(self, value):
+        """ Get an entry from the service by key value
+
+            The entry returned is shared and must not be modified.
+
+            """
+        now = time.time()
+        self._check_passwd_file(now)
+        cached = self._entry_cache.get(value)
+        if cached is not None:
+            (expires, entry) = cached
+            if now < expires:
+                return entry
+        missing_until = self._negative_cache.get(value)
+        if missing_until is not None and now < missing_until:
+            raise KeyError(value)
+        try:
+            entry = self._lookup_entry(value)
+        except KeyError:
+            self._entry_cache.pop(value)
+            self._negative_cache.set(value, now + self.negative_ttl)
+            raise
+        self._negative_cache.pop(value)
+        self._entry_cache.set(value, (now + self.entry_ttl, entry))
+        return entry
+
+    def trim_caches(self):
+        """ Remove some expired entries from the caches
+
+            Return the number removed.
+
+            """
+        now = time.time()
+        num_removed = self._entry_cache.trim(
+            lambda name, cached: cached[0] <= now)
+        num_removed += self._negative_cache.trim(
+            lambda name, missing_until: missing_until <= now)
+        return num_removed
+
+    def get_stats(self):
+        """ Get a dict of the account entry cache counters """
+        stats = dict(
+            entries = self._entry_cache.get_stats(),
+            missing = self._negative_cache.get_stats(),
+            invalidations = self.invalidations,
+            )
+        return stats
+
 
 class _PamConversation(object):
     """ PAM authentication conversation """
@@ -106,29 +406,209 @@ class _PamConversation(object):
                 response_list.append(response)
         return response_list
 
-class PamAuthService(PosixAuthService):
-    """ Interface to PAM authentication service """
+class PamHandle(object):
+    """ A PAM handle with a count of the authentications it performed """
 
     def __init__(self):
         """ Set up a new instance """
-        super(PamAuthService, self).__init__()
+        self.pam_auth = PAM.pam()
+        self.uses = 0
+
+
+class PamHandlePool(object):
+    """ Bounded pool of PAM handles lent to one thread at a time
+
+        A PAM handle holds the state of one conversation, so each
+        authentication checks out a handle of its own and checks it
+        in afterward. At most `max_handles` handles exist at once;
+        a thread wanting one when all are in use waits for a checkin.
+        A handle is replaced after `max_uses` authentications, or
+        when checked in as unhealthy after an unexpected error.
 
-        self._pam_auth = PAM.pam()
+        """
+
+    def __init__(
+        self,
+        max_handles=default_max_pam_handles,
+        max_uses=default_pam_handle_max_uses,
+        ):
+        """ Set up a new instance """
+        self.max_handles = max_handles
+        self.max_uses = max_uses
+        self._idle = []
+        self._num_handles = 0
+        self._available = threading.Condition(threading.Lock())
+        self.created = 0
+        self.recycled = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def checkout(self, timeout=None):
+        """ Get a handle for this thread's exclusive use
+
+            If no handle is available within `timeout` seconds, raise
+            `AuthServiceUnavailableError`.
+
+            """
+        self._available.acquire()
+        try:
+            self.checkouts += 1
+            start_time = None
+            while not self._idle and self._num_handles >= self.max_handles:
+                now = time.time()
+                if start_time is None:
+                    start_time = now
+                    self.waits += 1
+                if timeout is None:
+                    self._available.wait()
+                elif now - start_time < timeout:
+                    self._available.wait(start_time + timeout - now)
+                else:
+                    self._record_wait(now - start_time)
+                    raise AuthServiceUnavailableError(
+                        errno.EAGAIN, "No PAM handle available")
+            if start_time is not None:
+                self._record_wait(time.time() - start_time)
+            if self._idle:
+                return self._idle.pop()
+            self._num_handles += 1
+        finally:
+            self._available.release()
+        try:
+            handle = PamHandle()
+        except:
+            self._discard()
+            raise
+        self.created += 1
+        return handle
+
+    def _record_wait(self, wait_time):
+        """ Add a wait for a handle to the counters """
+        self.wait_time += wait_time
+        self.max_wait = max(self.max_wait, wait_time)
+
+    def checkin(self, handle, healthy=True):
+        """ Return a handle to the pool after use """
+        handle.uses += 1
+        if not healthy or handle.uses >= self.max_uses:
+            self.recycled += 1
+            self._discard()
+            return
+        self._available.acquire()
+        try:
+            self._idle.append(handle)
+            self._available.notify()
+        finally:
+            self._available.release()
+
+    def _discard(self):
+        """ Give up a handle, allowing another to be created """
+        self._available.acquire()
+        try:
+            self._num_handles -= 1
+            self._available.notify()
+        finally:
+            self._available.release()
+
+    def get_stats(self):
+        """ Get a dict of the handle pool counters """
+        stats = dict(
+            handles = self._num_handles,
+            idle = len(self._idle),
+            created = self.created,
+            recycled = self.recycled,
+            checkouts = self.checkouts,
+            waits = self.waits,
+            wait_time = self.wait_time,
+            max_wait = self.max_wait,
+            )
+        return stats
+
+
+class PamAuthService(PosixAuthService):
+    """ Interface to PAM authentication service
+
+        Credentials are checked using handles from a `PamHandlePool`,
+        so threads authenticate concurrently up to the size of the
+        pool. If `helper_pool` is specified, credentials are passed
+        instead to its privileged helper processes.
+
+        A caller waits at most `deadline` seconds for PAM to answer.
+        Repeated failures to get an answer open a `CircuitBreaker`,
+        so that while the backend is down logins fail at once with
+        `AuthServiceUnavailableError` instead of tying up threads.
+
+        """
+
+    def __init__(
+        self, helper_pool=None,
+        max_handles=default_max_pam_handles,
+        handle_max_uses=default_pam_handle_max_uses,
+        deadline=default_auth_deadline,
+        breaker_threshold=default_breaker_threshold,
+        breaker_reset=default_breaker_reset,
+        **kwargs
+        ):
+        """ Set up a new instance """
+        super(PamAuthService, self).__init__(**kwargs)
+
+        self.helper_pool = helper_pool
+        self.handle_pool = PamHandlePool(max_handles, handle_max_uses)
+        self.deadline = deadline
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.latency = LatencyHistogram()
+
+    def _authenticate_creds_with_deadline(self, username, password):
+        """ Authenticate credentials, giving up after the deadline
+
+            The helper pool applies its own timeout, so it is called
+            directly.
+
+            """
+        if self.helper_pool is not None or self.deadline is None:
+            return self._authenticate_creds(username, password)
+        call = _DeadlineCall(self._authenticate_creds, username, password)
+        return call(self.deadline)
 
     def _authenticate_creds(self, username, password):
         """ Authenticate credentials against PAM """
-        self._pam_auth.start(pam_service_name)
-        self._pam_auth.set_item(PAM.PAM_USER, username)
+        if self.helper_pool is not None:
+            return self.helper_pool.authenticate(username, password)
+        handle = self.handle_pool.checkout(self.deadline)
+        healthy = False
+        try:
+            try:
+                got_username = self._authenticate_creds_with_handle(
+                    handle.pam_auth, username, password)
+            except PAM.error, e:
+                # A refusal is a normal answer; an abort means the
+                # PAM library can no longer be trusted with the handle.
+                code = None
+                if len(e.args) >= 2:
+                    code = e.args[1]
+                healthy = (code != PAM.PAM_ABORT)
+                raise
+            healthy = True
+        finally:
+            self.handle_pool.checkin(handle, healthy)
+        return got_username
+
+    def _authenticate_creds_with_handle(self, pam_auth, username, password):
+        """ Authenticate credentials using a checked out PAM handle """
+        pam_auth.start(pam_service_name)
+        pam_auth.set_item(PAM.PAM_USER, username)
         conversation = _PamConversation(password)
-        self._pam_auth.set_item(PAM.PAM_CONV, conversation)
+        pam_auth.set_item(PAM.PAM_CONV, conversation)
 
         flags = 0
         flags |= PAM.PAM_SILENT
         flags |= PAM.PAM_DISALLOW_NULL_AUTHTOK
-        self._pam_auth.authenticate(flags)
-        self._pam_auth.acct_mgmt()
+        pam_auth.authenticate(flags)
+        pam_auth.acct_mgmt()
 
-        got_username = self._pam_auth.get_item(PAM.PAM_USER)
+        got_username = pam_auth.get_item(PAM.PAM_USER)
         return got_username
 
     def authenticate(self, credentials):
@@ -139,14 +619,33 @@ class PamAuthService(PosixAuthService):
             "Attempting to authenticate credentials"
             " for %(username)r" % vars()
             )
+        if not self.breaker.allow():
+            raise AuthServiceUnavailableError(
+                errno.EAGAIN, "Authentication service unavailable")
+        start_time = time.time()
         try:
-            got_username = self._authenticate_creds(username, password)
-        except PAM.error, e:
-            if len(e.args) < 2:
-                (reason, code) = (str(e), 0)
-            else:
-                (reason, code) = e.args
-            raise AuthenticationError(code, reason)
+            try:
+                got_username = self._authenticate_creds_with_deadline(
+                    username, password)
+            except PAM.error, e:
+                self.breaker.record_success()
+                if len(e.args) < 2:
+                    (reason, code) = (str(e), 0)
+                else:
+                    (reason, code) = e.args
+                raise AuthenticationError(code, reason)
+            except AuthServiceUnavailableError:
+                self.breaker.record_failure()
+                raise
+            except AuthenticationError:
+                self.breaker.record_success()
+                raise
+            except:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+        finally:
+            self.latency.record(time.time() - start_time)
 
         _logger.info(
             "Successful authentication for %(username)r"
@@ -154,3 +653,11 @@ class PamAuthService(PosixAuthService):
             )
         return got_username
 
+    def get_stats(self):
+        """ Get a dict of the account cache and PAM handle counters """
+        stats = super(PamAuthService, self).get_stats()
+        stats['pam_handles'] = self.handle_pool.get_stats()
+        stats['breaker'] = self.breaker.get_stats()
+        stats['latency'] = self.latency.get_stats()
+        return stats
+
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# gracie/cache.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Bounded in-memory caches
+"""
+
+import threading
+
+# Positions of fields in a cache entry link
+[_PREV, _NEXT, _KEY, _VALUE] = range(4)
+
+# Entries examined by each call to trim stale entries
+default_trim_batch = 100
+
+
+class LRUCache(object):
+    """ Mapping of bounded size discarding least recently used items
+
+        Entries are kept on a circular doubly-linked list in order of
+        use, so lookup, insertion and eviction are all constant time.
+
+        """
+
+    def __init__(self, max_size):
+        """ Set up a new instance """
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._links = dict()
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def _unlink(self, link):
+        """ Remove a link from the use-order list """
+        (prev_link, next_link) = (link[_PREV], link[_NEXT])
+        prev_link[_NEXT] = next_link
+        next_link[_PREV] = prev_link
+
+    def _append(self, link):
+        """ Put a link at the most recently used end of the list """
+        last = self._root[_PREV]
+        link[_PREV] = last
+        link[_NEXT] = self._root
+        last[_NEXT] = link
+        self._root[_PREV] = link
+
+    def get(self, key, default=None):
+        """ Get the value for a key, marking it most recently used """
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[_VALUE]
+        finally:
+            self._lock.release()
+
+    def peek(self, key, default=None):
+        """ Get the value for a key without changing its use order """
+        link = self._links.get(key)
+        if link is None:
+            return default
+        return link[_VALUE]
+
+    def set(self, key, value):
+        """ Store a value, evicting the oldest entry if full """
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[_VALUE] = value
+            else:
+                link = [None, None, key, value]
+                self._links[key] = link
+            self._append(link)
+            while len(self._links) > self.max_size:
+                oldest = self._root[_NEXT]
+                self._unlink(oldest)
+                del self._links[oldest[_KEY]]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def pop(self, key, default=None):
+        """ Remove a key and return its value """
+        self._lock.acquire()
+        try:
+            link = self._links.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[_VALUE]
+        finally:
+            self._lock.release()
+
+    def sample(self, count):
+        """ Get up to `count` (key, value) pairs, most recent first """
+        self._lock.acquire()
+        try:
+            items = []
+            link = self._root[_PREV]
+            while link is not self._root and len(items) < count:
+                items.append((link[_KEY], link[_VALUE]))
+                link = link[_PREV]
+        finally:
+            self._lock.release()
+        return items
+
+    def oldest(self):
+        """ Get the least recently used (key, value) pair, or None """
+        first = self._root[_NEXT]
+        if first is self._root:
+            return None
+        return (first[_KEY], first[_VALUE])
+
+    def trim(self, is_stale, max_count=default_trim_batch):
+        """ Remove stale entries from the least recently used end
+
+            Entries are removed while ``is_stale(key, value)`` is true,
+            up to `max_count` of them. Return the number removed.
+
+            """
+        num_removed = 0
+        self._lock.acquire()
+        try:
+            while num_removed < max_count:
+                oldest = self._root[_NEXT]
+                if oldest is self._root:
+                    break
+                if not is_stale(oldest[_KEY], oldest[_VALUE]):
+                    break
+                self._unlink(oldest)
+                del self._links[oldest[_KEY]]
+                num_removed += 1
+        finally:
+            self._lock.release()
+        return num_removed
+
+    def clear(self):
+        """ Remove every entry """
+        self._lock.acquire()
+        try:
+            self._links.clear()
+            self._root[:] = [self._root, self._root, None, None]
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """ Get a dict of the cache counters """
+        stats = dict(
+            size = len(self._links),
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions,
+            )
+        return stats
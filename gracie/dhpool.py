@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# gracie/dhpool.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Pool of Diffie-Hellman keypairs generated ahead of associate requests
+"""
+
+import os
+import time
+import threading
+import logging
+import Queue
+
+from openid import cryptutil
+from openid.dh import DiffieHellman
+from openid.message import OPENID_NS
+from openid.server.server import AssociateRequest
+from openid.server.server import DiffieHellmanSHA1ServerSession
+from openid.server.server import DiffieHellmanSHA256ServerSession
+
+# Get the Python logging instance for this module
+_logger = logging.getLogger("gracie.dhpool")
+
+# Keypairs kept ready in each server process
+default_pool_size = 32
+
+# Seconds the producer waits for room before checking for a stop
+stop_check_interval = 1.0
+
+
+class DHKeyPool(object):
+    """ Bounded pool of server keypairs for the default DH group
+
+        A producer thread generates keypairs, the costly modular
+        exponentiation of an associate request, while the pool has
+        room. Each keypair is taken by exactly one request; when
+        the pool is empty a keypair is generated inline instead.
+        Keypairs made before a fork are discarded in the child, so
+        that no two processes use the same keypair.
+
+        """
+
+    def __init__(self, size=default_pool_size):
+        """ Set up a new instance """
+        self.size = size
+        self._keys = Queue.Queue(size)
+        self._pid = os.getpid()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._count_lock = threading.Lock()
+        self.generated = 0
+        self.generate_time = 0.0
+        self.taken = 0
+        self.fallbacks = 0
+
+    def _count(self, name, increment=1):
+        """ Add to one of the pool counters """
+        self._count_lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + increment)
+        finally:
+            self._count_lock.release()
+
+    def _generate(self):
+        """ Generate a keypair, counting the time taken """
+        start_time = time.time()
+        dh = DiffieHellman.fromDefaults()
+        self._count("generate_time", time.time() - start_time)
+        return dh
+
+    def _discard_inherited(self):
+        """ Empty the pool if it was filled by another process """
+        pid = os.getpid()
+        if pid == self._pid:
+            return
+        self._pid = pid
+        try:
+            while True:
+                self._keys.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def take(self):
+        """ Get an unused keypair, generating one if none is ready """
+        self._discard_inherited()
+        try:
+            dh = self._keys.get_nowait()
+        except Queue.Empty:
+            self._count("fallbacks")
+            return self._generate()
+        self._count("taken")
+        return dh
+
+    def _run(self):
+        """ Keep the pool full until stopped """
+        while not self._stopping.isSet():
+            dh = self._generate()
+            self._count("generated")
+            while not self._stopping.isSet():
+                try:
+                    self._keys.put(dh, True, stop_check_interval)
+                    break
+                except Queue.Full:
+                    pass
+
+    def start(self):
+        """ Start the producer thread
+
+            Threads do not survive a fork, so this should be called
+            in the process that will answer requests.
+
+            """
+        self._discard_inherited()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="dh-pool")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        size = self.size
+        _logger.info("Started filling pool of %(size)d DH keypairs" % vars())
+
+    def stop(self):
+        """ Stop the producer thread """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get_stats(self):
+        """ Get a dict of the pool depth and counters
+
+            The refill rate is the keypairs the producer can make per
+            second of generation time.
+
+            """
+        refill_rate = None
+        if self.generate_time:
+            refill_rate = (self.generated + self.fallbacks) / (
+                self.generate_time)
+        stats = dict(
+            size = self.size,
+            depth = self._keys.qsize(),
+            generated = self.generated,
+            taken = self.taken,
+            fallbacks = self.fallbacks,
+            refill_rate = refill_rate,
+            )
+        return stats
+
+
+def _pooled_session_from_message(cls, base_class, message):
+    """ Make a DH server session, using a pooled keypair if possible
+
+        Only requests for the default group can use a pooled
+        keypair; others, and malformed requests, are left to the
+        base class.
+
+        """
+    if (cls.key_pool is None
+            or message.getArg(OPENID_NS, 'dh_modulus') is not None
+            or message.getArg(OPENID_NS, 'dh_gen') is not None):
+        return base_class.fromMessage.im_func(cls, message)
+    consumer_pubkey = message.getArg(OPENID_NS, 'dh_consumer_public')
+    if consumer_pubkey is None:
+        return base_class.fromMessage.im_func(cls, message)
+    consumer_pubkey = cryptutil.base64ToLong(consumer_pubkey)
+    return cls(cls.key_pool.take(), consumer_pubkey)
+
+
+class PooledDHSHA1ServerSession(DiffieHellmanSHA1ServerSession):
+    """ DH-SHA1 associate session drawing keypairs from a pool """
+
+    key_pool = None
+
+    def fromMessage(cls, message):
+        return _pooled_session_from_message(
+            cls, DiffieHellmanSHA1ServerSession, message)
+
+    fromMessage = classmethod(fromMessage)
+
+
+class PooledDHSHA256ServerSession(DiffieHellmanSHA256ServerSession):
+    """ DH-SHA256 associate session drawing keypairs from a pool """
+
+    key_pool = None
+
+    def fromMessage(cls, message):
+        return _pooled_session_from_message(
+            cls, DiffieHellmanSHA256ServerSession, message)
+
+    fromMessage = classmethod(fromMessage)
+
+
+def install_key_pool(key_pool):
+    """ Make associate requests draw DH keypairs from a pool
+
+        The OpenID library chooses session classes through a mapping
+        on `AssociateRequest`, so this applies to every OpenID server
+        in the process.
+
+        """
+    PooledDHSHA1ServerSession.key_pool = key_pool
+    PooledDHSHA256ServerSession.key_pool = key_pool
+    AssociateRequest.session_classes['DH-SHA1'] = PooledDHSHA1ServerSession
+    AssociateRequest.session_classes['DH-SHA256'] = (
+        PooledDHSHA256ServerSession)
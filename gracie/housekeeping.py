@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# gracie/housekeeping.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Periodic removal of expired data, off the request path
+"""
+
+import time
+import threading
+import logging
+
+# Get the Python logging instance for this module
+_logger = logging.getLogger("gracie.housekeeping")
+
+# Seconds between housekeeping ticks
+default_interval = 60.0
+
+# Seconds of work allowed in each tick
+default_budget = 0.05
+
+
+class HousekeepingTask(object):
+    """ A named cleanup function with its schedule and counters """
+
+    def __init__(self, name, func, period, incremental):
+        """ Set up a new instance """
+        self.name = name
+        self.func = func
+        self.period = period
+        self.incremental = incremental
+        self.next_run = 0
+        self.runs = 0
+        self.removed = 0
+        self.failures = 0
+
+
+class Housekeeper(object):
+    """ Thread running cleanup tasks within a time budget per tick
+
+        Every `interval` seconds, each task that is due is run until
+        `budget` seconds of work have been done. A task's function
+        removes some expired items and returns how many. An
+        incremental task removes a bounded batch per call, and is
+        called again while it keeps finding items and budget
+        remains; if the budget runs out first, it is run again on
+        the next tick. Other tasks are called once, and then not
+        until `period` seconds later. Tasks take turns at being run
+        first, so that one slow task does not starve the rest.
+
+        """
+
+    def __init__(self, interval=default_interval, budget=default_budget):
+        """ Set up a new instance """
+        self.interval = interval
+        self.budget = budget
+        self.tasks = []
+        self._next_first = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self.ticks = 0
+        self.overruns = 0
+
+    def add_task(self, name, func, period=None, incremental=False):
+        """ Add a task run every `period` seconds, or every tick """
+        if period is None:
+            period = 0
+        task = HousekeepingTask(name, func, period, incremental)
+        self.tasks.append(task)
+
+    def _run_task(self, task, deadline):
+        """ Run one task until done or past the deadline """
+        start_time = time.time()
+        removed = 0
+        finished = True
+        try:
+            while True:
+                num_removed = task.func()
+                removed += num_removed
+                if not task.incremental or not num_removed:
+                    break
+                if time.time() >= deadline:
+                    finished = False
+                    break
+        except Exception, e:
+            task.failures += 1
+            name = task.name
+            message = str(e)
+            _logger.error(
+                "Housekeeping task %(name)s failed: %(message)s" % vars())
+        end_time = time.time()
+        task.runs += 1
+        task.removed += removed
+        if finished:
+            task.next_run = end_time + task.period
+        name = task.name
+        elapsed = end_time - start_time
+        _logger.info(
+            "Housekeeping task %(name)s removed %(removed)d items"
+            " in %(elapsed).3f seconds" % vars())
+
+    def run_tick(self):
+        """ Run the tasks that are due, within the budget """
+        start_time = time.time()
+        deadline = start_time + self.budget
+        self.ticks += 1
+        num_tasks = len(self.tasks)
+        if not num_tasks:
+            return
+        first = self._next_first % num_tasks
+        self._next_first = first + 1
+        for index in range(first, first + num_tasks):
+            task = self.tasks[index % num_tasks]
+            if task.next_run > start_time:
+                continue
+            if time.time() >= deadline:
+                self.overruns += 1
+                break
+            self._run_task(task, deadline)
+
+    def _run(self):
+        """ Run ticks until stopped """
+        while True:
+            self._stopping.wait(self.interval)
+            if self._stopping.isSet():
+                break
+            self.run_tick()
+
+    def start(self):
+        """ Start the housekeeping thread
+
+            Threads do not survive a fork, so this should be called
+            in the process that will serve requests.
+
+            """
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="housekeeping")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        num_tasks = len(self.tasks)
+        _logger.info(
+            "Started housekeeping for %(num_tasks)d tasks" % vars())
+
+    def stop(self):
+        """ Stop the housekeeping thread """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get_stats(self):
+        """ Get a dict of the tick counters and per-task counters """
+        stats = dict(
+            ticks = self.ticks,
+            overruns = self.overruns,
+            tasks = dict(
+                (task.name, dict(
+                    runs = task.runs,
+                    removed = task.removed,
+                    failures = task.failures,
+                    ))
+                for task in self.tasks),
+            )
+        return stats
@@ -17,16 +17,22 @@ import time
 import cgi
 import Cookie
 import urlparse
-import routes
 from openid.server.server import BROWSER_REQUEST_MODES
 
 from gracie import pagetemplate
+from gracie.routing import RouteTable
+from gracie.session import Session
+from gracie.signedsession import SessionTooLargeError
 from gracie.httpresponse import ResponseHeader, Response
 from gracie.httpresponse import response_codes as http_codes
 from gracie.authservice import AuthenticationError
+from gracie.authservice import AuthServiceUnavailableError
 
 session_cookie_name = "gracie_session"
 
+login_throttled_text = (
+    "Too many failed logins. Please wait a while and try again.\n")
+
 _logger = logging.getLogger("gracie.httprequest")
 
 
@@ -36,7 +42,7 @@ class BaseHTTPRequestHandler(
     """ Shim to insert base object type into hierarchy """
 
 
-mapper = routes.Mapper()
+mapper = RouteTable()
 mapper.connect('root', '', controller='about', action='view')
 mapper.connect('openid', 'openidserver', controller='openid')
 mapper.connect('identity', 'id/:name',
@@ -47,6 +53,18 @@ mapper.connect('logout', 'logout', controller='logout', action='view')
 class HTTPRequestHandler(BaseHTTPRequestHandler):
     """ Handler for individual HTTP requests """
 
+    protocol_version = "HTTP/1.1"
+
+    # Handler method names for each routed controller
+    controllers = {
+        None: '_make_url_not_found_error_response',
+        'openid': '_handle_openid_request',
+        'about': '_make_about_site_view_response',
+        'identity': '_make_identity_view_response',
+        'logout': '_make_logout_response',
+        'login': '_make_login_response',
+        }
+
     def __init__(self, request, client_address, server):
         """ Set up a new instance """
         self.gracie_server = server.gracie_server
@@ -55,6 +73,22 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             request, client_address, server
             )
 
+    def setup(self):
+        """ Set up the connection for persistent use """
+        opts = self.gracie_server.opts
+        self.timeout = opts.keepalive_timeout
+        self.max_requests = opts.max_keepalive_requests
+        super(HTTPRequestHandler, self).setup()
+        # A connection buffered by the event-loop server holds a
+        # single request, and reports how many requests it has
+        # already served.
+        self.requests_served = getattr(
+            self.connection, 'requests_served', 0)
+        self.single_request = getattr(
+            self.connection, 'single_request', False)
+        if not self.requests_served:
+            self.server.connection_stats.record_connection()
+
     def _setup_version(self):
         """ Set up the version string """
         version = self.gracie_server.version
@@ -75,18 +109,17 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
     def _begin_new_session(self):
         """ Begin a new server session """
         sess_manager = self.gracie_server.sess_manager
-        self.session = dict()
-        session_id = sess_manager.create_session(self.session)
-        self.session['session_id'] = session_id
+        self.session = Session(sess_manager)
 
     def _authenticate_session(self, username):
         """ Authenticate the current session as specified username """
         if username is not None:
-            auth_entry = self.gracie_server.auth_service.get_entry(username)
-            self.session.update(dict(
-                username = username,
-                auth_entry = auth_entry,
-                ))
+            if self.session.get('username') != username:
+                auth_service = self.gracie_server.auth_service
+                self.auth_entry = auth_service.get_entry(username)
+                self.session['username'] = username
+                sess_manager = self.gracie_server.sess_manager
+                sess_manager.index_session(self.session)
             _logger.info(
                 "Session authenticated as %(username)r" % vars()
                 )
@@ -97,6 +130,8 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         """ Set up the authentication session """
         sess_manager = self.gracie_server.sess_manager
         session_id = self._get_auth_cookie()
+        self.cookie_session_id = session_id
+        self.auth_entry = None
         try:
             self.session = sess_manager.get_session(session_id)
         except KeyError:
@@ -105,6 +140,12 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         username = self.session.get('username')
         self._authenticate_session(username)
 
+    def _store_session(self):
+        """ Store any changes made to the session by this request """
+        sess_manager = self.gracie_server.sess_manager
+        sess_manager.save_session(self.session)
+        sess_manager.flush()
+
     def _remove_auth_session(self):
         """ Remove the authentication session """
         sess_manager = self.gracie_server.sess_manager
@@ -140,14 +181,25 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         response.header.fields.append(field)
 
     def _set_auth_cookie(self, response):
-        """ Set the authentication cookie in the response """
-        field_name = "Set-Cookie"
-        epoch = time.gmtime(0)
-        expire_immediately = time.strftime(
-            '%a, %d-%b-%y %H:%M:%S GMT', epoch)
-
-        session_id = self.session['session_id']
-        self._set_cookie(response, session_cookie_name, session_id)
+        """ Set the authentication cookie in the response
+
+            The cookie is only sent when the request's session differs
+            from the one named by the request cookie: a newly created
+            session is announced, and a cookie naming a session that no
+            longer exists is expired.
+
+            """
+        session_id = self.session.get('session_id')
+        if session_id == self.cookie_session_id:
+            return
+        if session_id is not None:
+            self._set_cookie(response, session_cookie_name, session_id)
+        else:
+            epoch = time.gmtime(0)
+            expire_immediately = time.strftime(
+                '%a, %d-%b-%y %H:%M:%S GMT', epoch)
+            self._set_cookie(
+                response, session_cookie_name, "", expire_immediately)
 
     def _get_username_from_identity(self, identity):
         """ Parse a local username from an OpenID URL """
@@ -175,37 +227,57 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         return openid_url
 
     def _get_session_auth_entry(self):
+        """ Get the auth entry for the session's user, once needed """
         auth_entry = None
         if self.session:
-            auth_entry = self.session.get('auth_entry')
+            username = self.session.get('username')
+            if self.auth_entry is None and username is not None:
+                auth_service = self.gracie_server.auth_service
+                self.auth_entry = auth_service.get_entry(username)
+            auth_entry = self.auth_entry
         return auth_entry
 
     def _dispatch(self):
         """ Dispatch to the appropriate controller """
-        controller_map = {
-            None: self._make_url_not_found_error_response,
-            'openid': self._handle_openid_request,
-            'about': self._make_about_site_view_response,
-            'identity': self._make_identity_view_response,
-            'logout': self._make_logout_response,
-            'login': self._make_login_response,
-            }
         controller_name = None
         if self.route_map:
             controller_name = self.route_map['controller']
-        controller = controller_map[controller_name]
+        controller = getattr(self, self.controllers[controller_name])
 
         _logger.info(
             "Dispatching to controller %(controller_name)r" % vars()
             )
 
-        response = controller()
+        try:
+            response = controller()
+            self._store_session()
+        except SessionTooLargeError, e:
+            message = str(e)
+            _logger.warn(message)
+            response = self._make_protocol_error_response(message)
         self._set_auth_cookie(response)
         self._send_response(response)
 
+    def _set_connection_persistence(self, response):
+        """ Decide whether to keep the connection open after response """
+        self.requests_served += 1
+        if not self.server.persistent_connections:
+            self.close_connection = 1
+        if self.requests_served >= self.max_requests:
+            self.close_connection = 1
+        if self.close_connection:
+            field = ("Connection", "close")
+            response.header.fields.append(field)
+        elif self.request_version == "HTTP/1.0":
+            field = ("Connection", "keep-alive")
+            response.header.fields.append(field)
+
     def _send_response(self, response):
         """ Send an HTTP response to the user agent """
+        reused = (self.requests_served > 0)
+        self._set_connection_persistence(response)
         response.send_to_handler(self)
+        self.server.connection_stats.record_request(reused)
 
         _logger.info("Sent HTTP response")
 
@@ -225,12 +297,16 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
     def handle(self):
         """ Handle the requests """
         try:
-            super(HTTPRequestHandler, self).handle()
+            if self.single_request:
+                self.handle_one_request()
+            else:
+                super(HTTPRequestHandler, self).handle()
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception, e:
             message = str(e)
             _logger.error(message)
+            self.close_connection = 1
             response = self._make_internal_error_response(message)
             self._send_response(response)
             raise
@@ -260,8 +336,10 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             response = self._make_about_site_view_response()
         else:
             _logger.info("Received OpenID protocol request")
-            self.session['last_openid_request'] = openid_request
             if openid_request.mode in BROWSER_REQUEST_MODES:
+                # Only a request from a browser may need a login, so
+                # only then is there a request to keep in the session.
+                self.session['last_openid_request'] = openid_request
                 response = self._handle_openid_browser_request(
                     openid_request
                     )
@@ -286,6 +364,15 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                     # Session is authenticated for requested identity
                     is_session_identity = True
 
+        if is_session_identity and self._is_trusted(openid_request):
+            trust_root = openid_request.trust_root
+            _logger.info(
+                "Answering from remembered trust of %(trust_root)r"
+                % vars())
+            response = self._make_trusted_response(
+                openid_request, remember=False)
+            return response
+
         dispatch_map = {
             'checkid_immediate': self._make_checkid_immediate_response,
             'checkid_setup': self._make_checkid_setup_response,
@@ -297,6 +384,33 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
 
         return response
 
+    def _get_trust_auth_tuple(self, request):
+        """ Get the authorisation key for a request's trust root """
+        return (request.identity, request.trust_root)
+
+    def _is_trusted(self, request):
+        """ Report whether the request's trust root is remembered """
+        consumer_auth_store = self.gracie_server.consumer_auth_store
+        auth_tuple = self._get_trust_auth_tuple(request)
+        return consumer_auth_store.is_authorised(auth_tuple)
+
+    def _remember_trust(self, request):
+        """ Remember that the identity trusts the request's trust root """
+        consumer_auth_store = self.gracie_server.consumer_auth_store
+        auth_tuple = self._get_trust_auth_tuple(request)
+        consumer_auth_store.store_authorisation(auth_tuple, True)
+
+    def _make_trusted_response(self, request, remember=True):
+        """ Make a positive response to an OpenID checkid request """
+        openid_response = request.answer(True)
+        response = self._make_response_from_openid_response(
+            openid_response
+            )
+        if remember:
+            self._remember_trust(request)
+
+        return response
+
     def _make_checkid_immediate_response(
         self, request,
         is_session_identity,
@@ -305,15 +419,15 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         response = None
 
         if is_session_identity:
-            openid_response = request.answer(True)
+            response = self._make_trusted_response(request)
         else:
             openid_response = request.answer(
                 False,
                 self._make_server_url("openidserver")
                 )
-        response = self._make_response_from_openid_response(
-            openid_response
-            )
+            response = self._make_response_from_openid_response(
+                openid_response
+                )
 
         return response
 
@@ -325,10 +439,7 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         response = None
 
         if is_session_identity:
-            openid_response = request.answer(True)
-            response = self._make_response_from_openid_response(
-                openid_response
-                )
+            response = self._make_trusted_response(request)
         else:
             response = self._make_wrong_authentication_response(
                 request.identity
@@ -488,12 +599,19 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             username=want_username,
             password=password
             )
+        address = self.client_address[0]
+        login_throttle = self.gracie_server.login_throttle
+        if not login_throttle.is_allowed(want_username, address):
+            return self._make_login_throttled_response()
         auth_service = self.gracie_server.auth_service
         try:
             username = auth_service.authenticate(credentials)
             authenticated = True
+        except AuthServiceUnavailableError, e:
+            return self._make_login_unavailable_response()
         except AuthenticationError, e:
             authenticated = False
+            login_throttle.record_failure(want_username, address)
         if authenticated:
             self._authenticate_session(username)
             response = self._make_login_succeeded_response()
@@ -511,6 +629,30 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         response = Response(header, data)
         return response
 
+    def _make_login_throttled_response(self):
+        """ Construct a response refusing a login without checking it
+
+            This answers floods of guesses, so it is a fixed text
+            rather than a rendered page.
+
+            """
+        header = ResponseHeader(
+            http_codes["Too Many Requests"], content_type="text/plain")
+        response = Response(header, login_throttled_text)
+        return response
+
+    def _make_login_unavailable_response(self):
+        """ Construct a response for a login the backend could not answer """
+        name = self.query.get('username')
+        message = (
+            "The login service is unavailable at the moment."
+            " Please try again later.")
+        header = ResponseHeader(http_codes["Service Unavailable"])
+        page = pagetemplate.login_submit_failed_page(message, name)
+        data = self._get_page_data(page)
+        response = Response(header, data)
+        return response
+
     def _make_login_succeeded_response(self):
         """ Construct a response for a successful login request """
         root_url = self._make_server_url("")
@@ -526,6 +668,7 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                     openid_response
                     )
                 response = self._make_redirect_response(return_url)
+                self._remember_trust(openid_request)
             else:
                 response = self._make_wrong_authentication_response(
                     openid_request.identity
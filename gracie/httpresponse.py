@@ -11,28 +11,78 @@
 """ Utility module for HTTP response handling
 """
 
+import time
+from email.utils import formatdate
+from BaseHTTPServer import BaseHTTPRequestHandler
+
 
 # Map names to codes as per RFC2616
 response_codes = {
     "OK": 200,
     "Found": 302,
     "Not Found": 404,
+    "Too Many Requests": 429,
     "Internal Server Error": 500,
+    "Service Unavailable": 503,
     }
 
 content_type_xhtml = "application/xhtml+xml"
 
+response_protocols = ["HTTP/1.0", "HTTP/1.1"]
+
+response_messages = dict(
+    (code, name) for (name, code) in response_codes.items())
+
+def make_status_line(protocol, code):
+    """ Make the status line for a response code """
+    if code in response_messages:
+        message = response_messages[code]
+    else:
+        message = BaseHTTPRequestHandler.responses.get(code, ("",))[0]
+    status_line = "%(protocol)s %(code)d %(message)s\r\n" % vars()
+    return status_line
+
+status_lines = dict(
+    ((protocol, code), make_status_line(protocol, code))
+    for protocol in response_protocols
+    for code in response_codes.values())
+
+
+class DateFieldCache(object):
+    """ Date header field, regenerated at most once per second """
+
+    def __init__(self):
+        """ Set up a new instance """
+        self._cached = (None, None)
+
+    def get_field(self, now=None):
+        """ Get the Date header field line for the current second """
+        if now is None:
+            now = time.time()
+        second = int(now)
+        (cached_second, field) = self._cached
+        if second != cached_second:
+            date = formatdate(second, usegmt=True)
+            field = "Date: %(date)s\r\n" % vars()
+            # Replace both values at once, so other threads never
+            # see a second paired with another second's field.
+            self._cached = (second, field)
+        return field
+
+date_field_cache = DateFieldCache()
+
 
 class ResponseHeader(object):
     """ Encapsulation of an HTTP response header """
 
-    def __init__(
-        self, code,
-        protocol="HTTP/1.0", content_type=content_type_xhtml,
-        ):
-        """ Set up a new instance """
+    def __init__(self, code, content_type=content_type_xhtml):
+        """ Set up a new instance
+
+            The protocol version of the status line is that of the
+            request handler sending the response.
+
+            """
         self.code = code
-        self.protocol = protocol
         self.fields = []
         self.fields.append(("Content-Type", content_type))
 
@@ -44,11 +94,43 @@ class Response(object):
         self.header = header
         self.data = data
 
+    def serialise(self, protocol, server_version):
+        """ Serialise the status line, header and body to one string """
+        code = self.header.code
+        status_line = status_lines.get((protocol, code))
+        if status_line is None:
+            status_line = make_status_line(protocol, code)
+        data = self.data or ""
+        parts = [
+            status_line,
+            "Server: %(server_version)s\r\n" % vars(),
+            date_field_cache.get_field(),
+            ]
+        for key, value in self.header.fields:
+            parts.append("%(key)s: %(value)s\r\n" % vars())
+        content_length = len(data)
+        parts.append("Content-Length: %(content_length)d\r\n" % vars())
+        parts.append("\r\n")
+        parts.append(data)
+        return "".join(parts)
+
     def send_to_handler(self, handler):
-        """ Send this response via a request handler """
-        handler.send_response(self.header.code)
+        """ Send this response via a request handler
+
+            The whole response is written with a single call. The
+            connection is left open; the Content-Length field frames
+            the response so the client can send further requests on
+            the same connection.
+
+            """
+        handler.log_request(self.header.code)
         for key, value in self.header.fields:
-            handler.send_header(key, value)
-        handler.end_headers()
-        handler.wfile.write(self.data)
-        handler.wfile.close()
+            if key.lower() == "connection":
+                handler.close_connection = int(value.lower() == "close")
+        if handler.request_version == "HTTP/0.9":
+            response_text = self.data or ""
+        else:
+            response_text = self.serialise(
+                handler.protocol_version, handler.version_string())
+        handler.wfile.write(response_text)
+        handler.wfile.flush()
@@ -12,14 +12,20 @@
 """
 
 import logging
+import socket
+import threading
 import urlparse
 from BaseHTTPServer import HTTPServer
 
+from workerpool import WorkerPool
+
 # Get the Python logging instance for this module
 _logger = logging.getLogger("gracie.httpserver")
 
 default_host = "localhost"
 default_port = 8000
+default_keepalive_timeout = 15
+default_max_keepalive_requests = 100
 
 
 class BaseHTTPServer(HTTPServer, object):
@@ -42,15 +48,59 @@ default_root_url = urlparse.urlunsplit(
     )
 
 
+class ConnectionStats(object):
+    """ Counters for client connections and their reuse """
+
+    def __init__(self):
+        """ Set up a new instance """
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.reused_requests = 0
+
+    def record_connection(self):
+        """ Count a newly opened client connection """
+        self._lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self._lock.release()
+
+    def record_request(self, reused):
+        """ Count a request, noting whether it reused a connection """
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            if reused:
+                self.reused_requests += 1
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """ Get a dict of the current counter values """
+        stats = dict(
+            connections = self.connections,
+            requests = self.requests,
+            reused_requests = self.reused_requests,
+            )
+        return stats
+
+
 class HTTPServer(BaseHTTPServer):
     """ Server for HTTP protocol requests """
 
+    # An idle persistent connection would hold a serving thread
+    persistent_connections = False
+
     def __init__(
         self,
-        server_address, RequestHandlerClass, gracie_server
+        server_address, RequestHandlerClass, gracie_server,
+        reuse_port=False,
         ):
         """ Set up a new instance """
         self.gracie_server = gracie_server
+        self.reuse_port = reuse_port
+        self.connection_stats = ConnectionStats()
         self._setup_version()
         self._setup_logging()
         super(HTTPServer, self).__init__(
@@ -72,11 +122,22 @@ class HTTPServer(BaseHTTPServer):
 
     def server_bind(self):
         """ Bind and name the server """
+        if self.reuse_port:
+            self._set_reuse_port()
         super(HTTPServer, self).server_bind()
         self.server_location = net_location(
             self.server_name, self.server_port
             )
 
+    def _set_reuse_port(self):
+        """ Allow other processes to bind the same address and port """
+        reuse_port_option = getattr(socket, 'SO_REUSEPORT', None)
+        if reuse_port_option is None:
+            _logger.warn("SO_REUSEPORT not supported on this platform")
+        else:
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, reuse_port_option, 1)
+
     def _log_location(self):
         """ Log the net location of the server """
         location = net_location(*self.server_address)
@@ -98,3 +159,39 @@ class HTTPServer(BaseHTTPServer):
             message = str(e)
             _logger.error(message)
             raise
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """ HTTP server handing connections to a pool of worker threads """
+
+    def __init__(
+        self,
+        server_address, RequestHandlerClass, gracie_server,
+        num_threads, queue_size, reuse_port=False,
+        ):
+        """ Set up a new instance """
+        super(ThreadPoolHTTPServer, self).__init__(
+            server_address, RequestHandlerClass, gracie_server,
+            reuse_port=reuse_port,
+            )
+        self.worker_pool = WorkerPool(
+            num_threads, queue_size, name="http-worker")
+
+    def serve_forever(self):
+        """ Start the worker threads and serve requests indefinitely """
+        self.worker_pool.start()
+        super(ThreadPoolHTTPServer, self).serve_forever()
+
+    def process_request(self, request, client_address):
+        """ Queue the connection for a worker thread """
+        self.worker_pool.submit(
+            self._process_request_in_worker, request, client_address)
+
+    def _process_request_in_worker(self, request, client_address):
+        """ Handle one connection from within a worker thread """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.close_request(request)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+# gracie/interning.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Sharing of string values repeated across many stored records
+"""
+
+
+def intern_value(value):
+    """ Intern a string value as bytes, leaving other values alone
+
+        Text is encoded as UTF-8 first, so that equal values stored
+        as text or as bytes share one object.
+
+        """
+    if type(value) is unicode:
+        value = value.encode('utf-8')
+    if type(value) is str:
+        value = intern(value)
+    return value
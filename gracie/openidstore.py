@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+# gracie/openidstore.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Storage of OpenID associations and nonces in SQLite
+"""
+
+import os
+import time
+import threading
+import logging
+import sqlite3
+
+from openid.association import Association
+from openid.store.interface import OpenIDStore
+from openid.store import nonce
+from openid.server.server import Signatory
+
+from cache import LRUCache
+
+# Get the Python logging instance for this module
+_logger = logging.getLogger("gracie.openidstore")
+
+# Seconds of nonce timestamps grouped together for cleanup
+nonce_bucket_seconds = 60 * 60
+
+# Associations kept in memory by a caching store
+default_association_cache_size = 1000
+
+# Seconds a cached association is used before it is read again
+default_association_cache_ttl = 60
+
+
+class SqliteOpenIDStore(OpenIDStore):
+    """ OpenID store keeping associations and nonces in SQLite
+
+        The database is opened in write-ahead log mode so that
+        several worker processes can share it, with a connection of
+        its own in each process. Associations are keyed by server
+        URL and handle, with an index finding the newest association
+        for a server URL. Nonces are grouped into buckets by
+        timestamp, so that cleanup deletes whole buckets by index
+        rather than examining every nonce.
+
+        """
+
+    def __init__(self, path):
+        """ Set up a new instance """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+
+    def _get_connection(self):
+        """ Get the database connection for this process
+
+            The connection is opened on first use in each process, so
+            that workers forked after setup do not share one.
+
+            """
+        pid = os.getpid()
+        if self._connection is None or self._connection_pid != pid:
+            connection = sqlite3.connect(
+                self.path, timeout=30.0, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS associations ("
+                " server_url TEXT NOT NULL,"
+                " handle TEXT NOT NULL,"
+                " secret BLOB NOT NULL,"
+                " issued INTEGER NOT NULL,"
+                " lifetime INTEGER NOT NULL,"
+                " assoc_type TEXT NOT NULL,"
+                " expires INTEGER NOT NULL,"
+                " PRIMARY KEY (server_url, handle))")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS associations_issued"
+                " ON associations (server_url, issued)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS associations_expires"
+                " ON associations (expires)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS nonces ("
+                " server_url TEXT NOT NULL,"
+                " timestamp INTEGER NOT NULL,"
+                " salt TEXT NOT NULL,"
+                " bucket INTEGER NOT NULL,"
+                " PRIMARY KEY (server_url, timestamp, salt))")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS nonces_bucket"
+                " ON nonces (bucket)")
+            connection.commit()
+            self._connection = connection
+            self._connection_pid = pid
+        return self._connection
+
+    def _make_association(self, row):
+        """ Make an association from a database row """
+        (handle, secret, issued, lifetime, assoc_type) = row
+        association = Association(
+            str(handle), str(secret), issued, lifetime, str(assoc_type))
+        return association
+
+    def storeAssociation(self, server_url, association):
+        """ Store an association for a server URL """
+        expires = association.issued + association.lifetime
+        self._lock.acquire()
+        try:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO associations"
+                " (server_url, handle, secret, issued, lifetime,"
+                "  assoc_type, expires)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (server_url, association.handle,
+                 sqlite3.Binary(association.secret),
+                 association.issued, association.lifetime,
+                 association.assoc_type, expires))
+            connection.commit()
+        finally:
+            self._lock.release()
+
+    def getAssociation(self, server_url, handle=None):
+        """ Get an unexpired association for a server URL, or None
+
+            If no handle is specified, the most recently issued
+            association is returned.
+
+            """
+        now = int(time.time())
+        self._lock.acquire()
+        try:
+            connection = self._get_connection()
+            if handle is None:
+                cursor = connection.execute(
+                    "SELECT handle, secret, issued, lifetime, assoc_type"
+                    " FROM associations"
+                    " WHERE server_url = ? AND expires > ?"
+                    " ORDER BY issued DESC LIMIT 1",
+                    (server_url, now))
+            else:
+                cursor = connection.execute(
+                    "SELECT handle, secret, issued, lifetime, assoc_type"
+                    " FROM associations"
+                    " WHERE server_url = ? AND handle = ?"
+                    " AND expires > ?",
+                    (server_url, handle, now))
+            row = cursor.fetchone()
+        finally:
+            self._lock.release()
+        if row is None:
+            return None
+        return self._make_association(row)
+
+    def removeAssociation(self, server_url, handle):
+        """ Remove an association, reporting whether it existed """
+        self._lock.acquire()
+        try:
+            connection = self._get_connection()
+            cursor = connection.execute(
+                "DELETE FROM associations"
+                " WHERE server_url = ? AND handle = ?",
+                (server_url, handle))
+            connection.commit()
+            removed = (cursor.rowcount > 0)
+        finally:
+            self._lock.release()
+        return removed
+
+    def useNonce(self, server_url, timestamp, salt):
+        """ Record a nonce, reporting whether it had not been used
+
+            Nonces with a timestamp outside the allowed clock skew
+            are refused without being stored.
+
+            """
+        if abs(timestamp - time.time()) > nonce.SKEW:
+            return False
+        bucket = timestamp // nonce_bucket_seconds
+        self._lock.acquire()
+        try:
+            connection = self._get_connection()
+            try:
+                connection.execute(
+                    "INSERT INTO nonces"
+                    " (server_url, timestamp, salt, bucket)"
+                    " VALUES (?, ?, ?, ?)",
+                    (server_url, timestamp, salt, bucket))
+                connection.commit()
+                unused = True
+            except sqlite3.IntegrityError:
+                connection.rollback()
+                unused = False
+        finally:
+            self._lock.release()
+        return unused
+
+    def cleanupNonces(self):
+        """ Remove the buckets of nonces too old to be accepted
+
+            Return the number of nonces removed.
+
+            """
+        cutoff_bucket = (
+            int(time.time()) - nonce.SKEW) // nonce_bucket_seconds
+        self._lock.acquire()
+        try:
+            connection = self._get_connection()
+            cursor = connection.execute(
+                "DELETE FROM nonces WHERE bucket < ?", (cutoff_bucket,))
+            connection.commit()
+            num_removed = cursor.rowcount
+        finally:
+            self._lock.release()
+        _logger.info("Removed %(num_removed)d old nonces" % vars())
+        return num_removed
+
+    def cleanupAssociations(self):
+        """ Remove expired associations, returning how many """
+        now = int(time.time())
+        self._lock.acquire()
+        try:
+            connection = self._get_connection()
+            cursor = connection.execute(
+                "DELETE FROM associations WHERE expires <= ?", (now,))
+            connection.commit()
+            num_removed = cursor.rowcount
+        finally:
+            self._lock.release()
+        _logger.info(
+            "Removed %(num_removed)d expired associations" % vars())
+        return num_removed
+
+
+class CachingOpenIDStore(OpenIDStore):
+    """ OpenID store keeping live associations in memory
+
+        Associations are cached by server URL and handle in front of
+        a backing store. Stores and removals go through to the
+        backing store; an association past its expiry is never
+        returned. A cached association is read again after
+        `cache_ttl` seconds, so that removals by other processes
+        sharing the backing store are noticed.
+
+        Associations for dumb-mode consumers are not cached, since
+        each is invalidated once checked, and a copy cached in
+        another process would let the check be replayed.
+
+        """
+
+    def __init__(
+        self, store,
+        cache_size=default_association_cache_size,
+        cache_ttl=default_association_cache_ttl,
+        uncached_server_urls=(Signatory._dumb_key,),
+        ):
+        """ Set up a new instance """
+        self.store = store
+        self.cache_ttl = cache_ttl
+        self.uncached_server_urls = frozenset(uncached_server_urls)
+        self._cache = LRUCache(cache_size)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def storeAssociation(self, server_url, association):
+        """ Store an association, keeping it in memory """
+        self.store.storeAssociation(server_url, association)
+        if server_url not in self.uncached_server_urls:
+            key = (server_url, association.handle)
+            self._cache.set(key, (time.time(), association))
+
+    def getAssociation(self, server_url, handle=None):
+        """ Get an unexpired association, from memory if possible
+
+            Without a handle, the backing store is asked for its
+            newest association.
+
+            """
+        if handle is None or server_url in self.uncached_server_urls:
+            return self.store.getAssociation(server_url, handle)
+        key = (server_url, handle)
+        now = time.time()
+        cached = self._cache.get(key)
+        if cached is not None:
+            (loaded, association) = cached
+            if association.issued + association.lifetime <= now:
+                self._cache.pop(key)
+                self.expired += 1
+                return None
+            if now - loaded < self.cache_ttl:
+                self.hits += 1
+                return association
+        self.misses += 1
+        association = self.store.getAssociation(server_url, handle)
+        if association is None:
+            self._cache.pop(key)
+        else:
+            self._cache.set(key, (now, association))
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        """ Remove an association from memory and the backing store """
+        self._cache.pop((server_url, handle))
+        return self.store.removeAssociation(server_url, handle)
+
+    def useNonce(self, server_url, timestamp, salt):
+        """ Record a nonce in the backing store """
+        return self.store.useNonce(server_url, timestamp, salt)
+
+    def cleanupNonces(self):
+        """ Remove old nonces from the backing store """
+        return self.store.cleanupNonces()
+
+    def cleanupAssociations(self):
+        """ Remove expired associations from the backing store """
+        return self.store.cleanupAssociations()
+
+    def trim_cache(self):
+        """ Remove some expired associations from memory
+
+            Return the number removed.
+
+            """
+        now = time.time()
+        def is_expired(key, cached):
+            (loaded, association) = cached
+            return (association.issued + association.lifetime <= now)
+        num_removed = self._cache.trim(is_expired)
+        self.expired += num_removed
+        return num_removed
+
+    def get_stats(self):
+        """ Get a dict of the association cache counters """
+        stats = dict(
+            size = len(self._cache),
+            hits = self.hits,
+            misses = self.misses,
+            expired = self.expired,
+            evictions = self._cache.evictions,
+            )
+        return stats
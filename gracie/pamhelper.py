@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+# gracie/pamhelper.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Privileged helper processes performing PAM authentication
+"""
+
+import os
+import errno
+import select
+import signal
+import socket
+import struct
+import marshal
+import shutil
+import tempfile
+import threading
+import time
+import logging
+import PAM
+
+from authservice import PamAuthService, AuthenticationError
+from authservice import AuthServiceUnavailableError
+from prefork import PreforkSupervisor
+
+# Get the Python logging instance for this module
+_logger = logging.getLogger("gracie.pamhelper")
+
+# Helper processes answering authentication requests
+default_num_helpers = 4
+
+# Requests from each server process waiting for or using a helper
+default_queue_depth = 32
+
+# Seconds a server process waits for a helper to answer
+default_auth_timeout = 10.0
+
+# Seconds a helper may spend on one request before it is killed
+helper_time_limit = 60
+
+# Seconds a helper waits to read a request from a connection
+helper_read_timeout = 5.0
+
+# Seconds between checks that the server process is still running
+lifeline_check_interval = 1.0
+
+# Largest message accepted on a helper connection
+max_message_size = 64 * 1024
+
+_length_format = "!I"
+_length_size = struct.calcsize(_length_format)
+
+# Lengths of the username and password heading a request
+_request_format = "!II"
+_request_size = struct.calcsize(_request_format)
+
+
+def _recv_exactly(sock, size):
+    """ Read exactly `size` bytes from a socket """
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def send_request(sock, username, password):
+    """ Send an authentication request as two length-prefixed strings """
+    for field in (username, password):
+        if type(field) is not str:
+            raise ValueError("Request fields must be byte strings")
+    header = struct.pack(_request_format, len(username), len(password))
+    sock.sendall(header + username + password)
+
+
+def recv_request(sock):
+    """ Receive an authentication request, as (username, password)
+
+        Requests come from the unprivileged server process, so they
+        are only ever read as two byte strings, never decoded into
+        other values.
+
+        """
+    (username_size, password_size) = struct.unpack(
+        _request_format, _recv_exactly(sock, _request_size))
+    size = username_size + password_size
+    if size > max_message_size:
+        raise ValueError("Request of %(size)d bytes too large" % vars())
+    username = _recv_exactly(sock, username_size)
+    password = _recv_exactly(sock, password_size)
+    return (username, password)
+
+
+def send_message(sock, message):
+    """ Send a reply as a length-prefixed marshalled value """
+    data = marshal.dumps(message)
+    sock.sendall(struct.pack(_length_format, len(data)) + data)
+
+
+def recv_message(sock):
+    """ Receive a reply as a length-prefixed marshalled value """
+    (size,) = struct.unpack(
+        _length_format, _recv_exactly(sock, _length_size))
+    if size > max_message_size:
+        raise ValueError("Message of %(size)d bytes too large" % vars())
+    return marshal.loads(_recv_exactly(sock, size))
+
+
+def is_cancelled(conn):
+    """ Report whether the client has closed the connection """
+    (readable, _, _) = select.select([conn], [], [], 0)
+    if not readable:
+        return False
+    try:
+        data = conn.recv(1, socket.MSG_PEEK)
+    except socket.error:
+        return True
+    return (data == "")
+
+
+def handle_request(service, conn):
+    """ Answer one authentication request from a connection """
+    conn.settimeout(helper_read_timeout)
+    (username, password) = recv_request(conn)
+    if is_cancelled(conn):
+        _logger.info("Skipped cancelled request for %(username)r" % vars())
+        return
+    signal.alarm(helper_time_limit)
+    try:
+        try:
+            got_username = service._authenticate_creds(username, password)
+            reply = ("ok", got_username)
+        except PAM.error, e:
+            if len(e.args) < 2:
+                (reason, code) = (str(e), 0)
+            else:
+                (reason, code) = e.args
+            reply = ("error", reason, code)
+    finally:
+        signal.alarm(0)
+    send_message(conn, reply)
+
+
+def serve_helper(listen_socket):
+    """ Answer authentication requests until terminated
+
+        Each helper has its own PAM handle, and takes connections
+        from the shared listening socket one at a time. A helper
+        stuck in PAM for longer than `helper_time_limit` seconds is
+        killed by its alarm, and replaced by its supervisor.
+
+        """
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    service = PamAuthService()
+    while True:
+        try:
+            (conn, _) = listen_socket.accept()
+        except socket.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        try:
+            try:
+                handle_request(service, conn)
+            except (EOFError, ValueError, socket.error), e:
+                message = str(e)
+                _logger.warn(
+                    "Dropped helper connection: %(message)s" % vars())
+            except Exception, e:
+                message = str(e)
+                _logger.error(
+                    "Failed helper request: %(message)s" % vars())
+        finally:
+            conn.close()
+
+
+def detach_process():
+    """ Leave the terminal's session and let go of standard files
+
+        The helpers are started before the server becomes a daemon,
+        so they detach themselves rather than keep the terminal.
+
+        """
+    os.setsid()
+    null_fd = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null_fd, fd)
+    if null_fd > 2:
+        os.close(null_fd)
+
+
+class PamHelperSupervisor(PreforkSupervisor):
+    """ Supervisor of PAM helper processes
+
+        The supervisor runs in its own process, forked while the
+        server is still privileged, so that helpers it replaces are
+        privileged too. It stops once the server processes have all
+        exited, which it detects as end of file on a lifeline pipe.
+
+        """
+
+    def __init__(self, num_helpers, listen_socket, lifeline_fd):
+        """ Set up a new instance """
+        super(PamHelperSupervisor, self).__init__(
+            num_helpers, lambda: serve_helper(listen_socket))
+        self.lifeline_fd = lifeline_fd
+
+    def run(self):
+        """ Start the helpers and supervise them until stopped """
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        while len(self.workers) < self.num_workers:
+            self._spawn_worker()
+        while not self._stopping:
+            try:
+                (readable, _, _) = select.select(
+                    [self.lifeline_fd], [], [], lifeline_check_interval)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable and not os.read(self.lifeline_fd, 1):
+                break
+            self._reap_helpers()
+        self.stop()
+
+    def _reap_helpers(self):
+        """ Replace any helpers that have exited """
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            self._handle_worker_exit(pid, status)
+
+
+class PamHelperPool(object):
+    """ Pool of privileged processes performing PAM authentication
+
+        Helpers listen on a Unix socket in a private directory, owned
+        by `owner_uid` if specified so that a server which later drops
+        privileges can still connect. Each request is a connection;
+        requests wait in the socket's backlog until a helper is free.
+
+        A server process allows at most `queue_depth` requests to wait
+        or run at once, rejecting more immediately. A request not
+        answered within `timeout` seconds fails, and closing its
+        connection cancels it if no helper has started on it.
+
+        """
+
+    def __init__(
+        self,
+        num_helpers=default_num_helpers,
+        queue_depth=default_queue_depth,
+        timeout=default_auth_timeout,
+        owner_uid=None,
+        ):
+        """ Set up a new instance """
+        self.num_helpers = num_helpers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.owner_uid = owner_uid
+        self.socket_dir = None
+        self.socket_path = None
+        self.supervisor_pid = None
+        self._lifeline_fd = None
+        self._slots = threading.Semaphore(queue_depth)
+        self._count_lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def start(self):
+        """ Create the socket and fork the helper supervisor """
+        self.socket_dir = tempfile.mkdtemp(prefix="gracie-pam-")
+        self.socket_path = os.path.join(self.socket_dir, "helper.sock")
+        listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listen_socket.bind(self.socket_path)
+        listen_socket.listen(self.queue_depth)
+        if self.owner_uid is not None:
+            os.chown(self.socket_dir, self.owner_uid, -1)
+            os.chown(self.socket_path, self.owner_uid, -1)
+
+        (lifeline_read, lifeline_write) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(lifeline_write)
+            exitcode = os.EX_SOFTWARE
+            try:
+                try:
+                    detach_process()
+                    supervisor = PamHelperSupervisor(
+                        self.num_helpers, listen_socket, lifeline_read)
+                    supervisor.run()
+                    exitcode = os.EX_OK
+                except Exception, e:
+                    message = str(e)
+                    _logger.error(message)
+            finally:
+                shutil.rmtree(self.socket_dir, True)
+                os._exit(exitcode)
+        os.close(lifeline_read)
+        listen_socket.close()
+        self._lifeline_fd = lifeline_write
+        self.supervisor_pid = pid
+        num_helpers = self.num_helpers
+        _logger.info(
+            "Started PAM helper supervisor %(pid)d"
+            " for %(num_helpers)d helpers" % vars())
+
+    def _count(self, name):
+        """ Add one to a pool counter """
+        self._count_lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._count_lock.release()
+
+    def authenticate(self, username, password):
+        """ Authenticate credentials using a helper process
+
+            Return the username reported by PAM. A PAM failure is
+            raised as `AuthenticationError`, and failure to get an
+            answer as `AuthServiceUnavailableError`.
+
+            """
+        self._count("requests")
+        if not self._slots.acquire(False):
+            self._count("rejected")
+            raise AuthServiceUnavailableError(
+                errno.EAGAIN, "Authentication service busy")
+        try:
+            reply = self._request(username, password)
+        finally:
+            self._slots.release()
+        if reply[0] != "ok":
+            (_, reason, code) = reply
+            raise AuthenticationError(code, reason)
+        return reply[1]
+
+    def _request(self, username, password):
+        """ Send a request to a helper and wait for its reply """
+        deadline = time.time() + self.timeout
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(self.socket_path)
+                send_request(sock, username, password)
+                sock.settimeout(max(0.0, deadline - time.time()))
+                reply = recv_message(sock)
+            except socket.timeout:
+                self._count("timeouts")
+                raise AuthServiceUnavailableError(
+                    errno.ETIMEDOUT, "Authentication timed out")
+            except (socket.error, EOFError, ValueError), e:
+                self._count("failures")
+                message = str(e)
+                raise AuthServiceUnavailableError(
+                    errno.EIO,
+                    "Authentication service failed: %(message)s"
+                    % vars())
+        finally:
+            sock.close()
+        return reply
+
+    def stop(self):
+        """ Stop the helper supervisor and its helpers """
+        if self.supervisor_pid is None:
+            return
+        try:
+            os.kill(self.supervisor_pid, signal.SIGTERM)
+            os.waitpid(self.supervisor_pid, 0)
+        except OSError:
+            pass
+        os.close(self._lifeline_fd)
+        self.supervisor_pid = None
+
+    def get_stats(self):
+        """ Get a dict of the pool counters """
+        stats = dict(
+            helpers = self.num_helpers,
+            requests = self.requests,
+            rejected = self.rejected,
+            timeouts = self.timeouts,
+            failures = self.failures,
+            )
+        return stats
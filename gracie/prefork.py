@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# gracie/prefork.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Pre-forked worker process supervision
+"""
+
+import os
+import errno
+import signal
+import time
+import logging
+
+# Get the Python logging instance for this module
+_logger = logging.getLogger("gracie.prefork")
+
+# Workers that die sooner than this after starting are respawned
+# only after a pause, so a broken worker cannot fork-bomb the host.
+min_worker_lifetime = 1.0
+
+
+class PreforkSupervisor(object):
+    """ Master process keeping a set of forked workers running """
+
+    def __init__(self, num_workers, worker_func):
+        """ Set up a new instance """
+        self.num_workers = num_workers
+        self.worker_func = worker_func
+        self.workers = dict()
+        self._stopping = False
+
+    def run(self):
+        """ Start the workers and supervise them until stopped """
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+        num_workers = self.num_workers
+        _logger.info(
+            "Starting %(num_workers)d worker processes" % vars())
+        while len(self.workers) < self.num_workers:
+            self._spawn_worker()
+        while not self._stopping:
+            try:
+                (pid, status) = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._handle_worker_exit(pid, status)
+        self.stop()
+
+    def _handle_stop_signal(self, signum, frame):
+        """ Note that the master has been asked to stop """
+        self._stopping = True
+
+    def _spawn_worker(self):
+        """ Fork a new worker process """
+        pid = os.fork()
+        if pid == 0:
+            # This is the worker; it must not act on the master's
+            # signal handlers, nor ever return into the master code.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exitcode = os.EX_SOFTWARE
+            try:
+                try:
+                    self.worker_func()
+                    exitcode = os.EX_OK
+                except SystemExit, e:
+                    exitcode = e.code
+                except Exception, e:
+                    message = str(e)
+                    _logger.error(message)
+            finally:
+                os._exit(exitcode or os.EX_OK)
+        else:
+            self.workers[pid] = time.time()
+            _logger.info("Started worker process %(pid)d" % vars())
+        return pid
+
+    def _handle_worker_exit(self, pid, status):
+        """ Record the exit of a worker and replace it """
+        started = self.workers.pop(pid, None)
+        if started is None:
+            return
+        _logger.warn(
+            "Worker process %(pid)d exited with status %(status)d"
+            % vars())
+        if self._stopping:
+            return
+        lifetime = time.time() - started
+        if lifetime < min_worker_lifetime:
+            time.sleep(min_worker_lifetime - lifetime)
+        self._spawn_worker()
+
+    def stop(self):
+        """ Terminate all workers and wait for them to exit """
+        self._stopping = True
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.workers.keys():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers.clear()
+        _logger.info("Stopped all worker processes")
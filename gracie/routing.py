@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# gracie/routing.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Mapping of request paths to controllers
+"""
+
+from cache import LRUCache
+
+default_cache_size = 256
+
+# Marker for a path not yet in the result cache
+_not_cached = object()
+
+
+class RouteTable(object):
+    """ Dispatch table of routes, compiled as routes are connected
+
+        A route path is either a fixed path, matched by exact lookup,
+        or a fixed prefix followed by a single ``:name`` segment. The
+        result for each recently requested path is cached.
+
+        """
+
+    def __init__(self, cache_size=default_cache_size):
+        """ Set up a new instance """
+        self._exact_routes = dict()
+        self._prefix_routes = []
+        self._cache = LRUCache(cache_size)
+
+    def connect(self, name, path, **defaults):
+        """ Add a route for the path pattern ``path`` """
+        defaults.setdefault('action', 'index')
+        path = "/" + path
+        (prefix, _, param) = path.rpartition("/")
+        if param.startswith(":"):
+            route = ("%(prefix)s/" % vars(), param[1:], defaults)
+            self._prefix_routes.append(route)
+        else:
+            self._exact_routes[path] = defaults
+        self._cache.clear()
+
+    def _match_uncached(self, path):
+        """ Find the route for a path without using the cache """
+        route_map = self._exact_routes.get(path)
+        if route_map is not None:
+            return route_map
+        for (prefix, param_name, defaults) in self._prefix_routes:
+            if not path.startswith(prefix):
+                continue
+            value = path[len(prefix):]
+            if value and "/" not in value:
+                route_map = dict(defaults)
+                route_map[param_name] = value
+                return route_map
+        return None
+
+    def match(self, path):
+        """ Get the route map for a request path, or None
+
+            The route map returned is shared and must not be modified.
+
+            """
+        route_map = self._cache.get(path, _not_cached)
+        if route_map is _not_cached:
+            route_map = self._match_uncached(path)
+            self._cache.set(path, route_map)
+        return route_map
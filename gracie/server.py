@@ -13,18 +13,36 @@
 
 import sys
 import os
+import pwd
 import logging
 from openid.server.server import Server as OpenIDServer
 from openid.store.filestore import FileOpenIDStore as OpenIDStore
+from openidstore import SqliteOpenIDStore, CachingOpenIDStore
+from dhpool import DHKeyPool, install_key_pool
 
 from httprequest import HTTPRequestHandler
-from httpserver import HTTPServer
+from httpserver import HTTPServer, ThreadPoolHTTPServer
+from asyncserver import AsyncHTTPServer
 from authservice import PamAuthService as AuthService
-from authorisation import ConsumerAuthStore
+from pamhelper import PamHelperPool
+from authorisation import ConsumerAuthStore, LoggedConsumerAuthStore
+from throttle import LoginThrottle
 from session import SessionManager
+from session import MemorySessionBackend, SqliteSessionBackend
+from signedsession import SessionKeyRing, SignedCookieSessionManager
+from signedsession import generate_key_file
+from prefork import PreforkSupervisor
+from housekeeping import Housekeeper
 
 __version__ = "0.2.7"
 
+# Worker threads running request handlers for the event-loop server
+# when no thread count is specified
+default_executor_threads = 4
+
+# Seconds between cleanups of expired OpenID nonces and associations
+openid_cleanup_period = 15 * 60
+
 # Get the Python logging instance for this module
 _logger = logging.getLogger("gracie.server")
 
@@ -67,6 +85,19 @@ def become_daemon():
 
     remove_standard_files()
 
+
+def drop_privileges(username):
+    """ Switch this process to run as the specified user """
+    pwd_entry = pwd.getpwnam(username)
+    (uid, gid) = (pwd_entry.pw_uid, pwd_entry.pw_gid)
+    if os.getuid() == uid and os.getgid() == gid:
+        return
+    os.setgroups([gid])
+    os.setgid(gid)
+    os.setuid(uid)
+    _logger.info(
+        "Dropped privileges to %(username)r (uid %(uid)d)" % vars())
+
 
 class GracieServer(object):
     """ Server for Gracie OpenID provider service """
@@ -76,19 +107,160 @@ class GracieServer(object):
         self.version = __version__
         self.opts = opts
         self._setup_logging()
-        server_address = (opts.host, opts.port)
-        self.httpserver = HTTPServer(
-            server_address, HTTPRequestHandler, self
-            )
+        self._setup_auth_service()
+        self._setup_httpserver()
+        if self.opts.user is not None:
+            drop_privileges(self.opts.user)
         self._setup_openid()
-        self.auth_service = AuthService()
-        self.sess_manager = SessionManager()
-        self.consumer_auth_store = ConsumerAuthStore()
+        self._setup_sessions()
+        self._setup_authorisation()
+        self._setup_login_throttle()
+        self._setup_housekeeping()
+
+    def _setup_auth_service(self):
+        """ Set up the authentication service and any PAM helpers
+
+            Helpers are started before the listening socket is
+            created and before privileges are dropped, so that they
+            keep the privileges PAM needs without holding the socket.
+            They detach from the terminal themselves, and are stopped
+            when the server stops serving.
+
+            """
+        helper_pool = None
+        user = self.opts.user
+        if self.opts.pam_helpers:
+            owner_uid = None
+            if user is not None:
+                owner_uid = pwd.getpwnam(user).pw_uid
+            helper_pool = PamHelperPool(
+                self.opts.pam_helpers, self.opts.pam_queue_depth,
+                self.opts.pam_timeout, owner_uid,
+                )
+            helper_pool.start()
+        elif user is not None:
+            _logger.warn(
+                "PAM will run as %(user)r without helper processes;"
+                " authentication may fail" % vars())
+        self.helper_pool = helper_pool
+        self.auth_service = AuthService(
+            helper_pool=helper_pool,
+            max_handles=self.opts.pam_handles,
+            deadline=self.opts.login_deadline,
+            breaker_threshold=self.opts.login_breaker_failures,
+            breaker_reset=self.opts.login_breaker_reset,
+            )
+
+    def _setup_httpserver(self):
+        """ Set up the HTTP server for the configured request mode """
+        server_address = (self.opts.host, self.opts.port)
+        if self.opts.event_loop:
+            num_threads = self.opts.threads or default_executor_threads
+            self.httpserver = AsyncHTTPServer(
+                server_address, HTTPRequestHandler, self,
+                num_threads, self.opts.request_queue,
+                reuse_port=self.opts.reuse_port,
+                )
+        elif self.opts.threads:
+            self.httpserver = ThreadPoolHTTPServer(
+                server_address, HTTPRequestHandler, self,
+                self.opts.threads, self.opts.request_queue,
+                reuse_port=self.opts.reuse_port,
+                )
+        else:
+            self.httpserver = HTTPServer(
+                server_address, HTTPRequestHandler, self,
+                reuse_port=self.opts.reuse_port,
+                )
+
+    def _setup_sessions(self):
+        """ Set up the session manager and its storage backend """
+        if self.opts.session_mode == "signed":
+            self._setup_signed_sessions()
+            return
+        if self.opts.session_store == "sqlite":
+            store_path = os.path.join(self.opts.datadir, "sessions.db")
+            backend = SqliteSessionBackend(
+                store_path, cache_size=self.opts.max_sessions)
+        else:
+            backend = MemorySessionBackend(self.opts.max_sessions)
+        self.sess_manager = SessionManager(
+            backend,
+            self.opts.session_idle_timeout, self.opts.session_lifetime,
+            self.openid_server.decodeRequest,
+            )
+
+    def _setup_signed_sessions(self):
+        """ Set up sessions carried in signed cookies """
+        key_path = self.opts.session_key_file
+        if key_path is None:
+            key_path = os.path.join(self.opts.datadir, "session-keys")
+        if not os.path.exists(key_path):
+            generate_key_file(key_path)
+        key_ring = SessionKeyRing(key_path)
+        self.sess_manager = SignedCookieSessionManager(
+            key_ring, self.openid_server.decodeRequest,
+            self.opts.session_idle_timeout, self.opts.session_lifetime,
+            )
+
+    def _setup_authorisation(self):
+        """ Set up the store of consumer authorisations """
+        if self.opts.auth_store == "log":
+            store_path = os.path.join(self.opts.datadir, "authorisations")
+            self.consumer_auth_store = LoggedConsumerAuthStore(
+                store_path,
+                self.opts.auth_ttl, self.opts.auth_max_per_identity,
+                )
+        else:
+            self.consumer_auth_store = ConsumerAuthStore(
+                self.opts.auth_ttl, self.opts.auth_max_per_identity)
+
+    def _setup_login_throttle(self):
+        """ Set up the failed login counters shared by all workers """
+        self.login_throttle = LoginThrottle(
+            self.opts.login_throttle_window,
+            self.opts.login_max_user_failures,
+            self.opts.login_max_address_failures,
+            )
 
     def _setup_openid(self):
         """ Set up OpenID parameters """
-        store = OpenIDStore(self.opts.datadir)
+        if self.opts.openid_store == "sqlite":
+            store_path = os.path.join(self.opts.datadir, "openid.db")
+            store = SqliteOpenIDStore(store_path)
+        else:
+            store = OpenIDStore(self.opts.datadir)
+        if self.opts.association_cache_size:
+            store = CachingOpenIDStore(
+                store, self.opts.association_cache_size)
+        self.openid_store = store
         self.openid_server = OpenIDServer(store)
+        self.dh_key_pool = None
+        if self.opts.dh_pool_size:
+            self.dh_key_pool = DHKeyPool(self.opts.dh_pool_size)
+            install_key_pool(self.dh_key_pool)
+
+    def _setup_housekeeping(self):
+        """ Set up the tasks removing expired data in the background """
+        housekeeper = Housekeeper(
+            self.opts.housekeeping_interval, self.opts.housekeeping_budget)
+        housekeeper.add_task(
+            "sessions", self.sess_manager.expire_sessions,
+            incremental=True)
+        housekeeper.add_task(
+            "openid-associations", self.openid_store.cleanupAssociations,
+            period=openid_cleanup_period)
+        housekeeper.add_task(
+            "openid-nonces", self.openid_store.cleanupNonces,
+            period=openid_cleanup_period)
+        if isinstance(self.openid_store, CachingOpenIDStore):
+            housekeeper.add_task(
+                "association-cache", self.openid_store.trim_cache,
+                incremental=True)
+        housekeeper.add_task(
+            "account-cache", self.auth_service.trim_caches,
+            incremental=True)
+        self.housekeeper = housekeeper
 
     def __del__(self):
         _logger.info("Exiting Gracie server")
@@ -103,4 +275,32 @@ class GracieServer(object):
 
     def serve_forever(self):
         """ Begin serving requests indefinitely """
-        self.httpserver.serve_forever()
+        try:
+            if self.opts.workers:
+                supervisor = PreforkSupervisor(
+                    self.opts.workers, self._serve_worker)
+                supervisor.run()
+            else:
+                self._serve_worker()
+        finally:
+            if self.helper_pool is not None:
+                self.helper_pool.stop()
+
+    def _serve_worker(self):
+        """ Serve requests from the listening socket in this process
+
+            Housekeeping and the DH keypair pool are started here,
+            after any fork, so that each worker trims its own
+            in-memory caches and uses keypairs of its own.
+
+            """
+        if self.opts.housekeeping_interval:
+            self.housekeeper.start()
+        if self.dh_key_pool is not None:
+            self.dh_key_pool.start()
+        try:
+            self.httpserver.serve_forever()
+        finally:
+            if self.dh_key_pool is not None:
+                self.dh_key_pool.stop()
+            self.housekeeper.stop()
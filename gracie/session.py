@@ -12,48 +12,1123 @@
 """
 
 import logging
-import random
-import sha
+import os
+import sys
+import threading
+import time
+import collections
+import cPickle
+import sqlite3
+import urllib
+import cgi
+
+from cache import LRUCache
+from striped import StripedDict, default_num_stripes
+from interning import intern_value
 
 # Get the Python logger instance for this module
 _logger = logging.getLogger("gracie.session")
 
+# Seconds a session may go unused before it expires
+default_idle_timeout = 60 * 60
+
+# Seconds a session may live regardless of use
+default_lifetime = 24 * 60 * 60
+
+# Sessions kept before the least recently used are evicted
+default_max_sessions = 10000
+
+# Sessions examined for expiry on each session manager call
+expire_batch = 16
+
+# Seconds a session read from a shared store is trusted in memory
+default_cache_ttl = 2.0
+
+# Seconds between writes of a stored session's access time
+touch_interval = 60
+
+# Seconds between sweeps of expired sessions from a shared store
+expiry_interval = 60
+
+# Bytes of randomness in each session ID
+session_id_bytes = 16
+
+# Session IDs drawn from each read of the system random source
+id_block_size = 256
+
+# Attempts to find an unused session ID before giving up
+max_id_attempts = 8
+
+# Sessions measured by a memory report
+default_report_sample = 100
+
+# Users whose sessions are revoked between writes to the store
+revoke_batch = 100
+
+# Positions of fields in a session entry
+[_SESSION, _CREATED, _ACCESSED] = range(3)
+
+
+def encode_request_args(request_args):
+    """ Encode OpenID request arguments as a compact string """
+    fields = []
+    for (name, value) in sorted(request_args.items()):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        fields.append((name, value))
+    return urllib.urlencode(fields)
+
+
+def decode_request_args(data):
+    """ Decode OpenID request arguments from their compact string """
+    return dict(cgi.parse_qsl(data, keep_blank_values=True))
+
+
+class Session(object):
+    """ Compact record of one user's session state
+
+        The common session values are held in slots, with any other
+        values in an `extra` dict made only when needed. The session
+        behaves as a mapping of these values.
+
+        A pending OpenID request is kept as its encoded arguments
+        once the session is compacted at the end of a request, and
+        decoded again with the `request_decoder` its manager set when
+        next read. Values
+        derived again on every request are discarded then too.
+
+        A session made with a manager is only created in that manager
+        when first written, so requests that never change session
+        state do not leave a session behind.
+
+        """
+
+    __slots__ = [
+        'session_id', 'username', 'openid_url',
+        '_request', '_request_args', 'extra', '_manager',
+        'request_decoder',
+        ]
+
+    # Keys held in slots of the same name
+    field_names = ('session_id', 'username', 'openid_url')
+
+    # Keys discarded by compact, being derived again on each request
+    derived_names = ('openid_url',)
+
+    # Key for the pending OpenID request
+    request_name = 'last_openid_request'
+
+    def __init__(self, manager=None, items=None):
+        """ Set up a new instance """
+        for name in self.__slots__:
+            setattr(self, name, None)
+        if items is not None:
+            for (key, value) in dict(items).items():
+                self._store(key, value)
+        self._manager = manager
+
+    def _store(self, key, value):
+        """ Store a value without creating the session """
+        if key in self.field_names:
+            if key == 'username':
+                value = intern_value(value)
+            setattr(self, key, value)
+        elif key == self.request_name:
+            self._request = value
+            self._request_args = None
+        else:
+            if self.extra is None:
+                self.extra = dict()
+            self.extra[key] = value
+
+    def _create(self):
+        """ Create this session in its manager if not yet done """
+        manager = self._manager
+        if manager is not None:
+            self._manager = None
+            manager.create_session(self)
+
+    def _get_request(self):
+        """ Get the pending OpenID request, decoding it if needed """
+        if self._request is None and self._request_args is not None:
+            request_args = decode_request_args(self._request_args)
+            if self.request_decoder is None:
+                _logger.warn("No decoder for pending OpenID request")
+            else:
+                self._request = self.request_decoder(request_args)
+        return self._request
+
+    def get(self, key, default=None):
+        """ Get the value for a key, or the default """
+        if key in self.field_names:
+            value = getattr(self, key)
+        elif key == self.request_name:
+            value = self._get_request()
+        elif self.extra is not None:
+            value = self.extra.get(key)
+        else:
+            value = None
+        if value is None:
+            value = default
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._store(key, value)
+        self._create()
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).items():
+            self._store(key, value)
+        self._create()
+
+    def setdefault(self, key, default=None):
+        value = self.get(key)
+        if value is None:
+            self[key] = default
+            value = default
+        return value
+
+    def keys(self):
+        keys = [
+            name for name in self.field_names
+            if getattr(self, name) is not None]
+        if self._request is not None or self._request_args is not None:
+            keys.append(self.request_name)
+        if self.extra:
+            keys.extend(self.extra.keys())
+        return keys
+
+    def items(self):
+        return [(key, self.get(key)) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return (self.get(key) is not None)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __nonzero__(self):
+        return (len(self) > 0)
+
+    def __eq__(self, other):
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return (dict(self.items()) == dict(other.items()))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def _encoded_request_args(self):
+        """ Get the pending request's encoded arguments, or None """
+        request_args = self._request_args
+        message = getattr(self._request, 'message', None)
+        if message is not None:
+            request_args = encode_request_args(message.toPostArgs())
+        return request_args
+
+    def compact(self):
+        """ Reduce the session to the state kept between requests """
+        if self._request is not None:
+            request_args = self._encoded_request_args()
+            if request_args is not None:
+                self._request_args = request_args
+                self._request = None
+        for name in self.derived_names:
+            setattr(self, name, None)
+
+    def __getstate__(self):
+        state = dict(
+            session_id = self.session_id,
+            username = self.username,
+            request_args = self._encoded_request_args(),
+            extra = self.extra,
+            )
+        return state
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.session_id = state['session_id']
+        self.username = intern_value(state['username'])
+        self._request_args = state['request_args']
+        self.extra = state['extra']
+
+
+def deep_size(obj, seen=None):
+    """ Get the size in bytes of an object and those it refers to """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for (key, value) in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    else:
+        for name in getattr(type(obj), '__slots__', ()):
+            size += deep_size(getattr(obj, name, None), seen)
+        if hasattr(obj, '__dict__'):
+            size += deep_size(obj.__dict__, seen)
+    return size
+
+
+class SessionIDGenerator(object):
+    """ Source of unpredictable fixed-width session IDs
+
+        Random bytes are read from the system source a block at a
+        time and hex-encoded together, and each ID is a slice of that
+        buffer. The buffer is discarded after a fork, so that worker
+        processes never hand out the same IDs.
+
+        """
+
+    def __init__(
+        self, id_bytes=session_id_bytes, block_size=id_block_size):
+        """ Set up a new instance """
+        self.id_width = 2 * id_bytes
+        self.block_bytes = id_bytes * block_size
+        self._lock = threading.Lock()
+        self._buffer = ""
+        self._offset = 0
+        self._pid = None
+
+    def _refill(self):
+        """ Read a new block of random bytes """
+        self._buffer = os.urandom(self.block_bytes).encode('hex')
+        self._offset = 0
+        self._pid = os.getpid()
+
+    def next_id(self):
+        """ Get the next session ID """
+        self._lock.acquire()
+        try:
+            offset = self._offset
+            end = offset + self.id_width
+            if end > len(self._buffer) or self._pid != os.getpid():
+                self._refill()
+                (offset, end) = (0, self.id_width)
+            self._offset = end
+            session_id = self._buffer[offset:end]
+        finally:
+            self._lock.release()
+        return session_id
+
+
+def measure_id_rate(generator=None, count=100000):
+    """ Measure session IDs generated per second """
+    if generator is None:
+        generator = SessionIDGenerator()
+    next_id = generator.next_id
+    start = time.time()
+    for i in xrange(count):
+        next_id()
+    elapsed = time.time() - start
+    rate = count / max(elapsed, 1e-9)
+    return rate
+
+
+class SessionBackend(object):
+    """ Interface to storage of session records
+
+        A session record is a list of [session, created, accessed],
+        with the times in seconds since the epoch.
+
+        """
+
+    def add_record(self, session_id, record):
+        """ Store a new session record """
+        raise NotImplementedError
+
+    def get_record(self, session_id):
+        """ Get the record for a session ID, or None """
+        raise NotImplementedError
+
+    def has_record(self, session_id):
+        """ Report whether a record exists for a session ID """
+        raise NotImplementedError
+
+    def touch_record(self, session_id, record, now):
+        """ Note that the session was accessed at time `now` """
+        raise NotImplementedError
+
+    def save_session(self, session_id, session):
+        """ Store changes made to the session contents """
+        raise NotImplementedError
+
+    def remove_record(self, session_id):
+        """ Remove a session record, reporting whether it existed """
+        raise NotImplementedError
+
+    def expire_records(self, now, idle_timeout, lifetime):
+        """ Remove some expired records, returning how many """
+        raise NotImplementedError
+
+    def index_user(self, session_id, username):
+        """ Note that a session is authenticated as a user """
+
+    def user_session_ids(self, username):
+        """ Get the IDs of stored sessions authenticated as a user """
+        raise NotImplementedError
+
+    def remove_user_records(self, username):
+        """ Remove the records of a user's sessions, returning how many """
+        raise NotImplementedError
+
+    def sample_records(self, count):
+        """ Get up to `count` of the stored records """
+        return []
+
+    def flush(self):
+        """ Write out any changes not yet stored """
+
+    def get_stats(self):
+        """ Get a dict of the backend counters """
+        return dict()
+
+
+class MemorySessionBackend(SessionBackend):
+    """ Session records held in process memory
+
+        Records are kept in a striped dict of LRU caches, so requests
+        for sessions in different stripes do not contend for a lock.
+        Each stripe holds an equal share of `max_sessions`.
+
+        A separate striped index maps each username to the IDs of its
+        sessions. Entries for sessions since evicted are pruned when
+        the user's index is next updated.
+
+        """
+
+    def __init__(
+        self,
+        max_sessions=default_max_sessions,
+        num_stripes=default_num_stripes,
+        ):
+        """ Set up a new instance """
+        stripe_size = max(1, max_sessions // num_stripes)
+        self._records = StripedDict(
+            num_stripes, lambda: LRUCache(stripe_size))
+        self._creation_order = collections.deque()
+        self._creation_lock = threading.Lock()
+        self._next_sweep_stripe = 0
+        self._user_index = StripedDict(num_stripes)
+
+    def add_record(self, session_id, record):
+        """ Store a new session record """
+        self._records.set(session_id, record)
+        self._creation_lock.acquire()
+        try:
+            self._creation_order.append((record[_CREATED], session_id))
+        finally:
+            self._creation_lock.release()
+
+    def get_record(self, session_id):
+        """ Get the record for a session ID, or None """
+        return self._records.get(session_id)
+
+    def has_record(self, session_id):
+        """ Report whether a record exists for a session ID """
+        return (session_id in self._records)
+
+    def touch_record(self, session_id, record, now):
+        """ Note that the session was accessed at time `now` """
+        record[_ACCESSED] = now
+
+    def save_session(self, session_id, session):
+        """ Store changes made to the session contents """
+
+    def remove_record(self, session_id):
+        """ Remove a session record, reporting whether it existed """
+        record = self._records.pop(session_id)
+        if record is None:
+            return False
+        self._unindex_records([(session_id, record)])
+        return True
+
+    def index_user(self, session_id, username):
+        """ Note that a session is authenticated as a user """
+        stripe = self._user_index.stripe_for(username)
+        stripe.acquire()
+        try:
+            session_ids = stripe.mapping.get(username)
+            if session_ids is None:
+                session_ids = stripe.mapping[username] = set()
+            stale_ids = [
+                stale_id for stale_id in session_ids
+                if stale_id not in self._records]
+            session_ids.difference_update(stale_ids)
+            session_ids.add(session_id)
+        finally:
+            stripe.release()
+
+    def _unindex_records(self, items):
+        """ Drop removed (session_id, record) pairs from the user index """
+        for (session_id, record) in items:
+            username = record[_SESSION].get('username')
+            if username is None:
+                continue
+            stripe = self._user_index.stripe_for(username)
+            stripe.acquire()
+            try:
+                session_ids = stripe.mapping.get(username)
+                if session_ids is not None:
+                    session_ids.discard(session_id)
+                    if not session_ids:
+                        del stripe.mapping[username]
+            finally:
+                stripe.release()
+
+    def _get_user_records(self, username):
+        """ Get a dict of the records of a user's sessions """
+        stripe = self._user_index.stripe_for(username)
+        stripe.acquire()
+        try:
+            session_ids = list(stripe.mapping.get(username, ()))
+        finally:
+            stripe.release()
+        records = self._records.get_many(session_ids)
+        for (session_id, record) in records.items():
+            if record[_SESSION].get('username') != username:
+                del records[session_id]
+        return records
+
+    def user_session_ids(self, username):
+        """ Get the IDs of stored sessions authenticated as a user """
+        return self._get_user_records(username).keys()
+
+    def remove_user_records(self, username):
+        """ Remove the records of a user's sessions, returning how many """
+        records = self._get_user_records(username)
+        self._user_index.pop(username)
+        removed = self._records.pop_many(records.keys())
+        return len(removed)
+
+    def sample_records(self, count):
+        """ Get up to `count` records, drawn from every stripe """
+        stripes = self._records.stripes
+        per_stripe = max(1, count // len(stripes))
+        records = []
+        for stripe in stripes:
+            stripe.acquire()
+            try:
+                items = stripe.mapping.sample(per_stripe)
+            finally:
+                stripe.release()
+            records.extend([record for (session_id, record) in items])
+        return records[:count]
+
+    def _expire_idle_records(self, now, idle_timeout):
+        """ Remove idle records from the front of the next stripe """
+        stripes = self._records.stripes
+        index = self._next_sweep_stripe
+        self._next_sweep_stripe = (index + 1) % len(stripes)
+        stripe = stripes[index]
+        expired = []
+        stripe.acquire()
+        try:
+            records = stripe.mapping
+            for i in xrange(expire_batch):
+                oldest = records.oldest()
+                if oldest is None:
+                    break
+                (session_id, record) = oldest
+                if now - record[_ACCESSED] < idle_timeout:
+                    break
+                records.pop(session_id)
+                expired.append(oldest)
+        finally:
+            stripe.release()
+        self._unindex_records(expired)
+        return len(expired)
+
+    def _expire_old_records(self, now, lifetime):
+        """ Remove records past their lifetime, oldest first """
+        expired = []
+        self._creation_lock.acquire()
+        try:
+            for i in xrange(expire_batch):
+                if not self._creation_order:
+                    break
+                (created, session_id) = self._creation_order[0]
+                if now - created < lifetime:
+                    break
+                self._creation_order.popleft()
+                stripe = self._records.stripe_for(session_id)
+                stripe.acquire()
+                try:
+                    record = stripe.mapping.peek(session_id)
+                    if record is not None and record[_CREATED] == created:
+                        stripe.mapping.pop(session_id)
+                        expired.append((session_id, record))
+                finally:
+                    stripe.release()
+        finally:
+            self._creation_lock.release()
+        self._unindex_records(expired)
+        return len(expired)
+
+    def expire_records(self, now, idle_timeout, lifetime):
+        """ Remove a bounded number of the oldest expired records
+
+            Each stripe keeps records in order of last access, and
+            records are separately kept in order of creation, so the
+            candidates for idle and for absolute expiry are always at
+            the front. At most `expire_batch` of each are examined per
+            call, idle records from one stripe in turn.
+
+            """
+        num_expired = (
+            self._expire_idle_records(now, idle_timeout)
+            + self._expire_old_records(now, lifetime))
+        return num_expired
+
+    def get_stats(self):
+        """ Get a dict of the backend counters """
+        stripes = self._records.stripes
+        stats = dict(
+            sessions = len(self._records),
+            evicted = sum([
+                stripe.mapping.evictions for stripe in stripes]),
+            lock_contentions = sum([
+                stripe.contentions for stripe in stripes]),
+            )
+        return stats
+
+
+class SqliteSessionBackend(SessionBackend):
+    """ Session records stored in an SQLite database
+
+        The database is opened in write-ahead log mode so that
+        several worker processes can share it. Records read are
+        kept in an in-process cache for `cache_ttl` seconds, after
+        which they are read again to pick up changes made by other
+        processes. Changes are queued and written in a single
+        transaction by `flush`; session contents are only written
+        when their serialised form has changed.
+
+        The username of each session is stored alongside its
+        contents, so the sessions of a user are found by an indexed
+        query rather than by a separate index.
+
+        """
+
+    def __init__(
+        self, path,
+        cache_size=default_max_sessions,
+        cache_ttl=default_cache_ttl,
+        ):
+        """ Set up a new instance """
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._cache = LRUCache(cache_size)
+        self._connection = None
+        self._connection_pid = None
+        self._inserts = dict()
+        self._saves = dict()
+        self._touches = dict()
+        self._removes = set()
+        self._last_expiry = 0
+        self.writes = 0
+
+    def _get_connection(self):
+        """ Get the database connection for this process
+
+            The connection is opened on first use in each process, so
+            that workers forked after setup do not share one.
+
+            """
+        pid = os.getpid()
+        if self._connection is None or self._connection_pid != pid:
+            connection = sqlite3.connect(
+                self.path, timeout=30.0, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY,"
+                " created REAL NOT NULL,"
+                " accessed REAL NOT NULL,"
+                " data BLOB NOT NULL,"
+                " username TEXT)")
+            columns = [
+                row[1] for row in
+                connection.execute("PRAGMA table_info(sessions)")]
+            if 'username' not in columns:
+                connection.execute(
+                    "ALTER TABLE sessions ADD COLUMN username TEXT")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_accessed"
+                " ON sessions (accessed)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_created"
+                " ON sessions (created)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_username"
+                " ON sessions (username)")
+            connection.commit()
+            self._connection = connection
+            self._connection_pid = pid
+        return self._connection
+
+    def _serialise(self, session):
+        """ Serialise session contents for storage """
+        data = cPickle.dumps(session, cPickle.HIGHEST_PROTOCOL)
+        return data
+
+    def _deserialise(self, data):
+        """ Get session contents from their stored form """
+        session = cPickle.loads(str(data))
+        return session
+
+    def add_record(self, session_id, record):
+        """ Store a new session record """
+        self._lock.acquire()
+        try:
+            self._inserts[session_id] = record
+            self._cache.set(session_id, [time.time(), record, None])
+        finally:
+            self._lock.release()
+
+    def get_record(self, session_id):
+        """ Get the record for a session ID, or None """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            cached = self._cache.get(session_id)
+            if cached is not None:
+                (loaded, record, data) = cached
+                pending = (
+                    session_id in self._inserts
+                    or session_id in self._saves)
+                if pending or now - loaded < self.cache_ttl:
+                    return record
+            if session_id in self._removes:
+                return None
+            cursor = self._get_connection().execute(
+                "SELECT created, accessed, data FROM sessions"
+                " WHERE session_id = ?", (session_id,))
+            row = cursor.fetchone()
+            if row is None:
+                self._cache.pop(session_id)
+                return None
+            (created, accessed, data) = row
+            session = self._deserialise(data)
+            record = [session, created, accessed]
+            self._cache.set(session_id, [now, record, str(data)])
+        finally:
+            self._lock.release()
+        return record
+
+    def has_record(self, session_id):
+        """ Report whether a record exists for a session ID """
+        self._lock.acquire()
+        try:
+            if session_id in self._cache or session_id in self._inserts:
+                return True
+            if session_id in self._removes:
+                return False
+            cursor = self._get_connection().execute(
+                "SELECT 1 FROM sessions WHERE session_id = ?",
+                (session_id,))
+            found = (cursor.fetchone() is not None)
+        finally:
+            self._lock.release()
+        return found
+
+    def touch_record(self, session_id, record, now):
+        """ Note that the session was accessed at time `now`
+
+            To avoid a write on every request, the stored access time
+            is only updated once it is `touch_interval` seconds old.
+
+            """
+        if now - record[_ACCESSED] < touch_interval:
+            return
+        record[_ACCESSED] = now
+        self._lock.acquire()
+        try:
+            if session_id not in self._inserts:
+                self._touches[session_id] = now
+        finally:
+            self._lock.release()
+
+    def save_session(self, session_id, session):
+        """ Store changes made to the session contents """
+        self._lock.acquire()
+        try:
+            if session_id not in self._inserts:
+                self._saves[session_id] = session
+        finally:
+            self._lock.release()
+
+    def remove_record(self, session_id):
+        """ Remove a session record, reporting whether it existed """
+        record = self.get_record(session_id)
+        self._lock.acquire()
+        try:
+            self._cache.pop(session_id)
+            self._inserts.pop(session_id, None)
+            self._saves.pop(session_id, None)
+            self._touches.pop(session_id, None)
+            self._removes.add(session_id)
+        finally:
+            self._lock.release()
+        return (record is not None)
+
+    def user_session_ids(self, username):
+        """ Get the IDs of stored sessions authenticated as a user """
+        self._lock.acquire()
+        try:
+            session_ids = self._user_session_ids(username)
+        finally:
+            self._lock.release()
+        return list(session_ids)
+
+    def _user_session_ids(self, username):
+        """ Get the set of a user's session IDs, with the lock held """
+        cursor = self._get_connection().execute(
+            "SELECT session_id FROM sessions WHERE username = ?",
+            (username,))
+        session_ids = set([row[0] for row in cursor])
+        pending = [
+            (session_id, record[_SESSION])
+            for (session_id, record) in self._inserts.items()]
+        pending.extend(self._saves.items())
+        for (session_id, session) in pending:
+            if session.get('username') == username:
+                session_ids.add(session_id)
+            else:
+                session_ids.discard(session_id)
+        session_ids.difference_update(self._removes)
+        return session_ids
+
+    def remove_user_records(self, username):
+        """ Queue removal of a user's sessions, returning how many """
+        self._lock.acquire()
+        try:
+            session_ids = self._user_session_ids(username)
+            for session_id in session_ids:
+                self._cache.pop(session_id)
+                self._inserts.pop(session_id, None)
+                self._saves.pop(session_id, None)
+                self._touches.pop(session_id, None)
+                self._removes.add(session_id)
+        finally:
+            self._lock.release()
+        return len(session_ids)
+
+    def expire_records(self, now, idle_timeout, lifetime):
+        """ Remove expired records, at most every `expiry_interval`
+
+            The expired records are also dropped from the cache, so
+            that they are not served from it. Records with changes
+            queued by this process are left for a later run.
+
+            """
+        if now - self._last_expiry < expiry_interval:
+            return 0
+        self._last_expiry = now
+        cutoffs = (now - idle_timeout, now - lifetime)
+        self._lock.acquire()
+        try:
+            connection = self._get_connection()
+            cursor = connection.execute(
+                "SELECT session_id FROM sessions"
+                " WHERE accessed <= ? OR created <= ?", cutoffs)
+            session_ids = [
+                row[0] for row in cursor
+                if row[0] not in self._saves
+                and row[0] not in self._touches]
+            num_expired = 0
+            if session_ids:
+                cursor = connection.executemany(
+                    "DELETE FROM sessions WHERE session_id = ?"
+                    " AND (accessed <= ? OR created <= ?)",
+                    [(session_id,) + cutoffs
+                     for session_id in session_ids])
+                connection.commit()
+                num_expired = cursor.rowcount
+            for session_id in session_ids:
+                self._cache.pop(session_id)
+        finally:
+            self._lock.release()
+        return num_expired
+
+    def flush(self):
+        """ Write out all queued changes in one transaction """
+        self._lock.acquire()
+        try:
+            if not (self._inserts or self._saves
+                    or self._touches or self._removes):
+                return
+            inserts = []
+            for (session_id, record) in self._inserts.items():
+                (session, created, accessed) = record
+                data = self._serialise(session)
+                inserts.append((
+                    session_id, created, accessed, buffer(data),
+                    session.get('username')))
+                self._cache_data(session_id, data)
+            saves = []
+            for (session_id, session) in self._saves.items():
+                data = self._serialise(session)
+                cached = self._cache.peek(session_id)
+                if cached is not None and cached[2] == data:
+                    continue
+                saves.append(
+                    (buffer(data), session.get('username'), session_id))
+                self._cache_data(session_id, data)
+            touches = [
+                (touched, session_id)
+                for (session_id, touched) in self._touches.items()]
+            removes = [(session_id,) for session_id in self._removes]
+            self._inserts.clear()
+            self._saves.clear()
+            self._touches.clear()
+            self._removes.clear()
+            if not (inserts or saves or touches or removes):
+                return
+
+            connection = self._get_connection()
+            try:
+                connection.executemany(
+                    "DELETE FROM sessions WHERE session_id = ?", removes)
+                connection.executemany(
+                    "INSERT OR REPLACE INTO sessions"
+                    " (session_id, created, accessed, data, username)"
+                    " VALUES (?, ?, ?, ?, ?)", inserts)
+                connection.executemany(
+                    "UPDATE sessions SET data = ?, username = ?"
+                    " WHERE session_id = ?", saves)
+                connection.executemany(
+                    "UPDATE sessions SET accessed = ?"
+                    " WHERE session_id = ?", touches)
+                connection.commit()
+            except sqlite3.Error, e:
+                connection.rollback()
+                message = str(e)
+                _logger.error(
+                    "Failed to write sessions: %(message)s" % vars())
+            self.writes += 1
+        finally:
+            self._lock.release()
+
+    def sample_records(self, count):
+        """ Get up to `count` of the cached records """
+        items = self._cache.sample(count)
+        return [record for (session_id, (_, record, _)) in items]
+
+    def _cache_data(self, session_id, data):
+        """ Note the stored form of a cached session """
+        cached = self._cache.peek(session_id)
+        if cached is not None:
+            cached[2] = data
+
+    def get_stats(self):
+        """ Get a dict of the backend counters """
+        stats = dict(
+            cached_sessions = len(self._cache),
+            cache_hits = self._cache.hits,
+            cache_misses = self._cache.misses,
+            writes = self.writes,
+            )
+        return stats
+
 
 class SessionManager(object):
     """ Manage user sessions across transactions """
 
-    def __init__(self):
+    def __init__(
+        self,
+        backend=None,
+        idle_timeout=default_idle_timeout,
+        lifetime=default_lifetime,
+        request_decoder=None,
+        ):
         """ Set up a new instance """
+        if backend is None:
+            backend = MemorySessionBackend()
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.lifetime = lifetime
+        self.request_decoder = request_decoder
+        self._count_lock = threading.Lock()
+        self.expired = 0
+        self.id_collisions = 0
+        self.revoked = 0
         self._init_session_generator()
 
     def _init_session_generator(self):
         """ Initialise the session ID generator """
-        self._rng = random.Random()
-        self._rng.seed()
-        self._sessions = dict()
+        self._id_generator = SessionIDGenerator()
 
     def _generate_session_id(self):
-        """ Generate a unique session ID """
-        randnum = self._rng.random()
-        message = "%(randnum)s" % vars()
-        message_hash = sha.sha(message)
-        session_id = message_hash.hexdigest()
-        return session_id
+        """ Generate a session ID not used by any stored session """
+        for i in xrange(max_id_attempts):
+            session_id = self._id_generator.next_id()
+            if not self.backend.has_record(session_id):
+                return session_id
+            self._count("id_collisions")
+            _logger.warn("Generated session ID already in use")
+        raise RuntimeError("Unable to generate an unused session ID")
+
+    def _count(self, name, increment=1):
+        """ Add to one of the session counters """
+        self._count_lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + increment)
+        finally:
+            self._count_lock.release()
+
+    def _is_expired(self, record, now):
+        """ Report whether a session record has expired """
+        (session, created, accessed) = record
+        expired = (
+            now - accessed >= self.idle_timeout
+            or now - created >= self.lifetime)
+        return expired
+
+    def _expire_sessions(self, now):
+        """ Expire some of the sessions past their timeouts """
+        num_expired = self.backend.expire_records(
+            now, self.idle_timeout, self.lifetime)
+        if num_expired:
+            self._count("expired", num_expired)
+            _logger.debug("Expired %(num_expired)d sessions" % vars())
+        return num_expired
+
+    def expire_sessions(self):
+        """ Expire a batch of sessions, returning how many """
+        num_expired = self._expire_sessions(time.time())
+        self.backend.flush()
+        return num_expired
+
+    def _attach_decoder(self, session):
+        """ Give a session this manager's OpenID request decoder """
+        if isinstance(session, Session):
+            session.request_decoder = self.request_decoder
 
     def create_session(self, session=None):
         """ Create a new session for supplied session dict """
         if session is None:
             session = dict()
+        now = time.time()
+        self._expire_sessions(now)
         session_id = self._generate_session_id()
         session['session_id'] = session_id
-        self._sessions[session_id] = session
+        self._attach_decoder(session)
+        self.backend.add_record(session_id, [session, now, now])
         return session_id
 
     def get_session(self, session_id):
         """ Get the session for specified session ID """
-        session = self._sessions[session_id]
+        now = time.time()
+        self._expire_sessions(now)
+        record = self.backend.get_record(session_id)
+        if record is None:
+            raise KeyError(session_id)
+        if self._is_expired(record, now):
+            if self.backend.remove_record(session_id):
+                self._count("expired")
+            raise KeyError(session_id)
+        self.backend.touch_record(session_id, record, now)
+        session = record[_SESSION]
+        self._attach_decoder(session)
         return session
 
+    def save_session(self, session):
+        """ Store changes made to a session during a request """
+        session_id = session.get('session_id')
+        if session_id is not None:
+            if isinstance(session, Session):
+                session.compact()
+            self.backend.save_session(session_id, session)
+
     def remove_session(self, session_id):
         """ Remove the specified session """
-        del self._sessions[session_id]
+        if not self.backend.remove_record(session_id):
+            raise KeyError(session_id)
+
+    def flush(self):
+        """ Write out session changes not yet stored """
+        self.backend.flush()
+
+    def index_session(self, session):
+        """ Note the user an authenticated session belongs to """
+        session_id = session.get('session_id')
+        username = session.get('username')
+        if session_id is not None and username is not None:
+            self.backend.index_user(session_id, username)
+
+    def count_user_sessions(self, username):
+        """ Count the stored sessions authenticated as a user """
+        return len(self.backend.user_session_ids(username))
+
+    def revoke_user(self, username):
+        """ Remove every session of a user, returning how many """
+        return self.revoke_users([username])
+
+    def revoke_users(self, usernames):
+        """ Remove every session of each user, returning how many
+
+            Each user's sessions are removed separately, so other
+            requests are not held up for the whole operation, and
+            removals are written to the store every `revoke_batch`
+            users.
+
+            """
+        num_revoked = 0
+        for (i, username) in enumerate(usernames):
+            num_revoked += self.backend.remove_user_records(username)
+            if (i + 1) % revoke_batch == 0:
+                self.backend.flush()
+        self.backend.flush()
+        self._count("revoked", num_revoked)
+        _logger.info("Revoked %(num_revoked)d sessions" % vars())
+        return num_revoked
+
+    def memory_report(self, sample_size=default_report_sample):
+        """ Estimate the memory used by each session
+
+            The sizes of a sample of sessions are measured, counting
+            in each session any objects it shares with others.
+
+            """
+        records = self.backend.sample_records(sample_size)
+        sizes = [deep_size(record[_SESSION]) for record in records]
+        bytes_per_session = 0
+        if sizes:
+            bytes_per_session = sum(sizes) // len(sizes)
+        report = dict(
+            sessions = self.backend.get_stats().get('sessions'),
+            sampled = len(sizes),
+            bytes_per_session = bytes_per_session,
+            )
+        return report
+
+    def get_stats(self):
+        """ Get a dict of the session counters """
+        stats = dict(
+            expired = self.expired,
+            id_collisions = self.id_collisions,
+            revoked = self.revoked,
+            )
+        stats.update(self.backend.get_stats())
+        return stats
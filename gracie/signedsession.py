@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+# gracie/signedsession.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Sessions carried in signed cookies instead of server storage
+"""
+
+import os
+import time
+import hmac
+import hashlib
+import base64
+import cgi
+import urllib
+import logging
+
+from session import default_idle_timeout, default_lifetime
+
+# Get the Python logger instance for this module
+_logger = logging.getLogger("gracie.signedsession")
+
+# Bytes of random secret in a generated signing key
+key_size = 32
+
+# Seconds between checks of the key file for changes
+key_check_interval = 10
+
+# Seconds before a session token is reissued to record access
+touch_interval = 60
+
+# Prefix of payload fields holding the pending OpenID request
+_request_prefix = "r."
+
+# Longest token issued, leaving room within the 4096 bytes a browser
+# keeps for a cookie for the cookie name and attributes
+max_token_size = 3800
+
+
+class SessionKeyError(Exception):
+    """ Raised when no usable session signing key is available """
+
+
+class SessionTooLargeError(ValueError):
+    """ Raised when session values are too large to carry in a cookie """
+
+
+def constant_time_equal(left, right):
+    """ Compare two strings in time independent of their contents """
+    if len(left) != len(right):
+        return False
+    result = 0
+    for (left_char, right_char) in zip(left, right):
+        result |= ord(left_char) ^ ord(right_char)
+    return (result == 0)
+
+
+def _b64encode(data):
+    """ Encode data as unpadded URL-safe base64 """
+    return base64.urlsafe_b64encode(data).rstrip("=")
+
+
+def _b64decode(text):
+    """ Decode unpadded URL-safe base64 """
+    padding = "=" * (-len(text) % 4)
+    return base64.urlsafe_b64decode(text + padding)
+
+
+def generate_key_file(path):
+    """ Create a key file holding a single new random key """
+    key_id = os.urandom(4).encode('hex')
+    secret = os.urandom(key_size).encode('hex')
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    key_file = os.fdopen(fd, 'w')
+    try:
+        key_file.write("%(key_id)s %(secret)s\n" % vars())
+    finally:
+        key_file.close()
+    _logger.info("Generated session key file %(path)r" % vars())
+
+
+class SessionKeyRing(object):
+    """ Set of keys for signing and verifying session tokens
+
+        Keys are read from a file of lines ``KEY_ID SECRET_HEX``.
+        The first key signs new tokens; every key listed is accepted
+        when verifying, so a key is rotated by adding a new first
+        line and later removing the old one. The file is re-read
+        when it changes.
+
+        """
+
+    def __init__(self, path):
+        """ Set up a new instance """
+        self.path = path
+        self._mtime = None
+        self._last_check = 0
+        self.keys = dict()
+        self.signing_key_id = None
+        self.reload_if_changed(force=True)
+
+    def reload_if_changed(self, force=False):
+        """ Re-read the key file if it has changed since last read """
+        now = time.time()
+        if not force and now - self._last_check < key_check_interval:
+            return
+        self._last_check = now
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self._mtime:
+            self._load()
+            self._mtime = mtime
+
+    def _load(self):
+        """ Read the keys from the key file """
+        keys = dict()
+        signing_key_id = None
+        for line in open(self.path):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            (key_id, secret) = line.split()
+            keys[key_id] = secret.decode('hex')
+            if signing_key_id is None:
+                signing_key_id = key_id
+        if signing_key_id is None:
+            path = self.path
+            raise SessionKeyError(
+                "No session keys in %(path)r" % vars())
+        self.keys = keys
+        self.signing_key_id = signing_key_id
+        num_keys = len(keys)
+        _logger.info("Loaded %(num_keys)d session keys" % vars())
+
+    def _signature(self, key_id, message):
+        """ Compute the signature of a message with a key """
+        digest = hmac.new(self.keys[key_id], message, hashlib.sha256)
+        return _b64encode(digest.digest())
+
+    def sign(self, payload):
+        """ Make a signed token carrying a payload """
+        self.reload_if_changed()
+        key_id = self.signing_key_id
+        encoded_payload = _b64encode(payload)
+        message = "%(key_id)s.%(encoded_payload)s" % vars()
+        signature = self._signature(key_id, message)
+        token = "%(message)s.%(signature)s" % vars()
+        return token
+
+    def verify(self, token):
+        """ Get the payload of a signed token, or None if not valid """
+        self.reload_if_changed()
+        try:
+            (message, signature) = token.rsplit(".", 1)
+            (key_id, encoded_payload) = message.split(".", 1)
+        except (AttributeError, ValueError):
+            return None
+        if key_id not in self.keys:
+            return None
+        expect_signature = self._signature(key_id, message)
+        if not constant_time_equal(signature, expect_signature):
+            return None
+        try:
+            payload = _b64decode(encoded_payload)
+        except TypeError:
+            return None
+        return payload
+
+
+class SignedCookieSessionManager(object):
+    """ Manage sessions held entirely in signed cookie tokens
+
+        The session ID is the token itself, so any process holding
+        the keys can serve any request. Only the username, creation
+        and access times, and the arguments of a pending OpenID
+        request are carried; other session values are derived again
+        on each request. A single token cannot be revoked, so
+        removing a session only stops its cookie being sent. Revoking
+        a user rejects, in this process, every token issued to that
+        user up to the time of revocation.
+
+        """
+
+    def __init__(
+        self, key_ring, request_decoder,
+        idle_timeout=default_idle_timeout,
+        lifetime=default_lifetime,
+        ):
+        """ Set up a new instance """
+        self.key_ring = key_ring
+        self.request_decoder = request_decoder
+        self.idle_timeout = idle_timeout
+        self.lifetime = lifetime
+        self._revoked_users = dict()
+        self.rejected = 0
+        self.expired = 0
+        self.revoked = 0
+        self.oversized = 0
+
+    def _encode(self, session, created, accessed):
+        """ Encode the carried session values as a payload """
+        fields = [("c", "%d" % created), ("a", "%d" % accessed)]
+        username = session.get('username')
+        if username is not None:
+            fields.append(("u", username))
+        openid_request = session.get('last_openid_request')
+        if openid_request is not None:
+            request_args = openid_request.message.toPostArgs()
+            for (name, value) in sorted(request_args.items()):
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                fields.append((_request_prefix + name, value))
+        payload = urllib.urlencode(fields)
+        return payload
+
+    def _decode(self, payload):
+        """ Decode a payload to (session, created, accessed) """
+        fields = cgi.parse_qsl(payload, keep_blank_values=True)
+        session = dict()
+        created = accessed = None
+        request_args = dict()
+        for (name, value) in fields:
+            if name == "c":
+                created = int(value)
+            elif name == "a":
+                accessed = int(value)
+            elif name == "u":
+                session['username'] = value
+            elif name.startswith(_request_prefix):
+                request_args[name[len(_request_prefix):]] = value
+        if request_args:
+            session['last_openid_request'] = self._decode_request(
+                request_args)
+        return (session, created, accessed)
+
+    def _decode_request(self, request_args):
+        """ Reconstruct the pending OpenID request, or None """
+        try:
+            openid_request = self.request_decoder(request_args)
+        except Exception, e:
+            message = str(e)
+            _logger.warn(
+                "Dropped undecodable pending request: %(message)s"
+                % vars())
+            openid_request = None
+        return openid_request
+
+    def _sign(self, payload):
+        """ Sign a payload, refusing a token too large for a cookie
+
+            A browser silently drops a cookie over its size limit, so
+            a session too large to carry is refused here instead.
+
+            """
+        token = self.key_ring.sign(payload)
+        size = len(token)
+        if size > max_token_size:
+            self.oversized += 1
+            raise SessionTooLargeError(
+                "Session of %(size)d bytes is too large for a cookie"
+                % vars())
+        return token
+
+    def _issue_token(self, session, created, accessed):
+        """ Sign a token for the session and record it as its ID """
+        payload = self._encode(session, created, accessed)
+        session_id = self._sign(payload)
+        session['session_id'] = session_id
+        return session_id
+
+    def create_session(self, session=None):
+        """ Create a new session for supplied session dict """
+        if session is None:
+            session = dict()
+        now = int(time.time())
+        session_id = self._issue_token(session, now, now)
+        return session_id
+
+    def get_session(self, session_id):
+        """ Get the session carried by a token """
+        payload = None
+        if session_id is not None:
+            payload = self.key_ring.verify(session_id)
+        if payload is None:
+            if session_id is not None:
+                self.rejected += 1
+            raise KeyError(session_id)
+        (session, created, accessed) = self._decode(payload)
+        if created is None or accessed is None:
+            self.rejected += 1
+            raise KeyError(session_id)
+        now = time.time()
+        if (now - accessed >= self.idle_timeout
+                or now - created >= self.lifetime):
+            self.expired += 1
+            raise KeyError(session_id)
+        revoked_time = self._revoked_users.get(session.get('username'))
+        if revoked_time is not None and created <= revoked_time:
+            self.rejected += 1
+            raise KeyError(session_id)
+        session['session_id'] = session_id
+        return session
+
+    def save_session(self, session):
+        """ Reissue the session token if its carried values changed """
+        session_id = session.get('session_id')
+        if session_id is None:
+            return
+        payload = self.key_ring.verify(session_id)
+        now = int(time.time())
+        if payload is None:
+            self._issue_token(session, now, now)
+            return
+        (created, accessed) = self._decode_times(payload)
+        if now - accessed >= touch_interval:
+            accessed = now
+        new_payload = self._encode(session, created, accessed)
+        if new_payload != payload:
+            session['session_id'] = self._sign(new_payload)
+
+    def _decode_times(self, payload):
+        """ Get the creation and access times from a payload """
+        created = accessed = 0
+        for (name, value) in cgi.parse_qsl(payload):
+            if name == "c":
+                created = int(value)
+            elif name == "a":
+                accessed = int(value)
+        return (created, accessed)
+
+    def remove_session(self, session_id):
+        """ Remove the specified session """
+
+    def flush(self):
+        """ Write out session changes not yet stored """
+
+    def expire_sessions(self):
+        """ Expire stored sessions, of which there are none """
+        return 0
+
+    def index_session(self, session):
+        """ Note the user an authenticated session belongs to """
+
+    def count_user_sessions(self, username):
+        """ Count the sessions of a user, which tokens cannot report """
+        return None
+
+    def revoke_user(self, username):
+        """ Reject every token issued to a user until now """
+        return self.revoke_users([username])
+
+    def revoke_users(self, usernames):
+        """ Reject every token issued to each user until now
+
+            Revocations older than the session lifetime are dropped,
+            since any token they would reject has expired anyway.
+            Return the number of users revoked.
+
+            """
+        now = int(time.time())
+        for (username, revoked_time) in self._revoked_users.items():
+            if now - revoked_time >= self.lifetime:
+                del self._revoked_users[username]
+        num_users = 0
+        for username in usernames:
+            self._revoked_users[username] = now
+            num_users += 1
+        self.revoked += num_users
+        _logger.info("Revoked sessions of %(num_users)d users" % vars())
+        return num_users
+
+    def get_stats(self):
+        """ Get a dict of the session counters """
+        stats = dict(
+            rejected = self.rejected,
+            expired = self.expired,
+            revoked = self.revoked,
+            oversized = self.oversized,
+            )
+        return stats
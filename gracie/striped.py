@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# gracie/striped.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Mappings split into independently locked stripes
+"""
+
+import threading
+
+default_num_stripes = 16
+
+
+class _Missing(object):
+    """ Marker for a key with no value """
+
+    def __repr__(self):
+        return "missing"
+
+missing = _Missing()
+
+
+class Stripe(object):
+    """ One independently locked part of a striped mapping """
+
+    def __init__(self, mapping):
+        """ Set up a new instance """
+        self.mapping = mapping
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contentions = 0
+
+    def acquire(self):
+        """ Lock the stripe, counting waits for another holder """
+        if not self._lock.acquire(False):
+            self.contentions += 1
+            self._lock.acquire()
+        self.acquisitions += 1
+
+    def release(self):
+        """ Unlock the stripe """
+        self._lock.release()
+
+
+class StripedDict(object):
+    """ Mapping whose keys hash to separately locked stripes
+
+        Operations on keys in different stripes do not wait for each
+        other. Each stripe's mapping is made by `mapping_factory`,
+        and must support ``get``, ``pop``, ``in``, ``len`` and item
+        assignment.
+
+        """
+
+    def __init__(
+        self, num_stripes=default_num_stripes, mapping_factory=dict):
+        """ Set up a new instance """
+        self.stripes = [
+            Stripe(mapping_factory()) for i in xrange(num_stripes)]
+
+    def stripe_for(self, key):
+        """ Get the stripe holding a key """
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def _group_by_stripe(self, keys):
+        """ Group keys into a dict of stripe index to key list """
+        num_stripes = len(self.stripes)
+        groups = dict()
+        for key in keys:
+            groups.setdefault(hash(key) % num_stripes, []).append(key)
+        return groups
+
+    def __len__(self):
+        return sum([len(stripe.mapping) for stripe in self.stripes])
+
+    def __contains__(self, key):
+        stripe = self.stripe_for(key)
+        stripe.acquire()
+        try:
+            result = key in stripe.mapping
+        finally:
+            stripe.release()
+        return result
+
+    def get(self, key, default=None):
+        """ Get the value for a key, or the default """
+        stripe = self.stripe_for(key)
+        stripe.acquire()
+        try:
+            value = stripe.mapping.get(key, default)
+        finally:
+            stripe.release()
+        return value
+
+    def set(self, key, value):
+        """ Store a value for a key """
+        stripe = self.stripe_for(key)
+        stripe.acquire()
+        try:
+            stripe.mapping[key] = value
+        finally:
+            stripe.release()
+
+    def pop(self, key, default=None):
+        """ Remove a key and return its value, or the default """
+        stripe = self.stripe_for(key)
+        stripe.acquire()
+        try:
+            value = stripe.mapping.pop(key, default)
+        finally:
+            stripe.release()
+        return value
+
+    def get_or_create(self, key, factory):
+        """ Get the value for a key, storing ``factory()`` if absent
+
+            Return a tuple (value, created).
+
+            """
+        stripe = self.stripe_for(key)
+        stripe.acquire()
+        try:
+            value = stripe.mapping.get(key, missing)
+            created = (value is missing)
+            if created:
+                value = factory()
+                stripe.mapping[key] = value
+        finally:
+            stripe.release()
+        return (value, created)
+
+    def compare_and_set(self, key, expect_value, value):
+        """ Store a value only if the key holds the expected value
+
+            An expected value of `missing` requires the key to be
+            absent. Return True if the value was stored.
+
+            """
+        stripe = self.stripe_for(key)
+        stripe.acquire()
+        try:
+            current_value = stripe.mapping.get(key, missing)
+            if current_value is missing or expect_value is missing:
+                matched = (current_value is expect_value)
+            else:
+                matched = (current_value == expect_value)
+            if matched:
+                stripe.mapping[key] = value
+        finally:
+            stripe.release()
+        return matched
+
+    def get_many(self, keys):
+        """ Get a dict of the values for those keys present """
+        result = dict()
+        for (index, stripe_keys) in self._group_by_stripe(keys).items():
+            stripe = self.stripes[index]
+            stripe.acquire()
+            try:
+                for key in stripe_keys:
+                    value = stripe.mapping.get(key, missing)
+                    if value is not missing:
+                        result[key] = value
+            finally:
+                stripe.release()
+        return result
+
+    def set_many(self, items):
+        """ Store each (key, value) pair """
+        items = dict(items)
+        for (index, stripe_keys) in self._group_by_stripe(items).items():
+            stripe = self.stripes[index]
+            stripe.acquire()
+            try:
+                for key in stripe_keys:
+                    stripe.mapping[key] = items[key]
+            finally:
+                stripe.release()
+
+    def pop_many(self, keys):
+        """ Remove the keys, returning a dict of those present """
+        result = dict()
+        for (index, stripe_keys) in self._group_by_stripe(keys).items():
+            stripe = self.stripes[index]
+            stripe.acquire()
+            try:
+                for key in stripe_keys:
+                    value = stripe.mapping.pop(key, missing)
+                    if value is not missing:
+                        result[key] = value
+            finally:
+                stripe.release()
+        return result
+
+    def get_stats(self):
+        """ Get a dict of counters, with per-stripe lists """
+        stats = dict(
+            size = len(self),
+            acquisitions = [
+                stripe.acquisitions for stripe in self.stripes],
+            contentions = [
+                stripe.contentions for stripe in self.stripes],
+            )
+        return stats
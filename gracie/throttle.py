@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+# gracie/throttle.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Throttling of failed logins shared between server processes
+"""
+
+import fcntl
+import hashlib
+import mmap
+import struct
+import tempfile
+import threading
+import time
+import logging
+
+# Get the Python logging instance for this module
+_logger = logging.getLogger("gracie.throttle")
+
+# Seconds over which failed logins are counted
+default_window = 5 * 60
+
+# Failed logins for one username allowed within the window
+default_max_user_failures = 10
+
+# Failed logins from one client address allowed within the window
+default_max_address_failures = 100
+
+# Counters in the shared table
+default_num_slots = 65536
+
+# Neighbouring slots searched for a key before one is replaced
+probe_length = 4
+
+# Slot: key digest, window number, failures in that window and before
+_slot_format = "!8sIII"
+_slot_size = struct.calcsize(_slot_format)
+
+_empty_digest = "\0" * 8
+
+
+def _key_digest(kind, key):
+    """ Get the digest identifying a key of a kind """
+    if key is None:
+        key = ""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    digest = hashlib.md5("%(kind)s:%(key)s" % vars()).digest()[:8]
+    if digest == _empty_digest:
+        digest = "\0" * 7 + "\1"
+    return digest
+
+
+class LoginThrottle(object):
+    """ Sliding window counts of failed logins per username and address
+
+        Counts are kept in a fixed table of slots in shared memory, so
+        the table is the same size however many keys an attacker
+        uses, and is shared by worker processes forked after it is
+        made. Each slot counts failures in the current window and the
+        one before; the count over the last `window` seconds is
+        estimated by weighting the previous window's count by how
+        much of it still overlaps. When the table is crowded, the
+        least used of a key's neighbouring slots is replaced, which
+        only ever forgets failures.
+
+        """
+
+    def __init__(
+        self,
+        window=default_window,
+        max_user_failures=default_max_user_failures,
+        max_address_failures=default_max_address_failures,
+        num_slots=default_num_slots,
+        ):
+        """ Set up a new instance """
+        self.window = window
+        self.max_user_failures = max_user_failures
+        self.max_address_failures = max_address_failures
+        self.num_slots = num_slots
+        self._file = tempfile.TemporaryFile(prefix="gracie-throttle-")
+        size = num_slots * _slot_size
+        self._file.truncate(size)
+        self._table = mmap.mmap(self._file.fileno(), size)
+        self._thread_lock = threading.Lock()
+        self.checks = 0
+        self.rejected_users = 0
+        self.rejected_addresses = 0
+        self.failures = 0
+        self.evictions = 0
+
+    def _acquire(self):
+        """ Lock the table against other threads and processes """
+        self._thread_lock.acquire()
+        try:
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX)
+        except:
+            self._thread_lock.release()
+            raise
+
+    def _release(self):
+        """ Unlock the table """
+        try:
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+    def _read_slot(self, index):
+        """ Get the fields of a slot """
+        return struct.unpack_from(
+            _slot_format, self._table, index * _slot_size)
+
+    def _write_slot(self, index, digest, window_number, current, previous):
+        """ Set the fields of a slot """
+        struct.pack_into(
+            _slot_format, self._table, index * _slot_size,
+            digest, window_number, current, previous)
+
+    def _probe_indexes(self, digest):
+        """ Get the indexes of the slots a key may occupy """
+        (start,) = struct.unpack("!Q", digest)
+        return [
+            (start + offset) % self.num_slots
+            for offset in xrange(probe_length)]
+
+    def _now(self):
+        """ Get the current window number and the fraction elapsed """
+        (window_number, remainder) = divmod(time.time(), self.window)
+        return (int(window_number), remainder / self.window)
+
+    def _estimate(self, slot, window_number, fraction):
+        """ Estimate the failures a slot counts in the last window """
+        (_, slot_window, current, previous) = slot
+        if slot_window == window_number:
+            return previous * (1.0 - fraction) + current
+        if slot_window == window_number - 1:
+            return current * (1.0 - fraction)
+        return 0.0
+
+    def _count(self, digest, window_number, fraction):
+        """ Estimate the recent failures of a key """
+        for index in self._probe_indexes(digest):
+            slot = self._read_slot(index)
+            if slot[0] == digest:
+                return self._estimate(slot, window_number, fraction)
+        return 0.0
+
+    def is_allowed(self, username, address):
+        """ Report whether a login attempt may go to the auth service """
+        user_digest = _key_digest("user", username)
+        address_digest = _key_digest("address", address)
+        (window_number, fraction) = self._now()
+        self._acquire()
+        try:
+            self.checks += 1
+            user_count = self._count(user_digest, window_number, fraction)
+            address_count = self._count(
+                address_digest, window_number, fraction)
+            if (self.max_user_failures
+                    and user_count >= self.max_user_failures):
+                self.rejected_users += 1
+                return False
+            if (self.max_address_failures
+                    and address_count >= self.max_address_failures):
+                self.rejected_addresses += 1
+                return False
+        finally:
+            self._release()
+        return True
+
+    def _add_failure(self, digest, window_number, fraction):
+        """ Count a failure for a key, taking a slot if needed """
+        found_index = None
+        victim_index = None
+        victim_count = None
+        for index in self._probe_indexes(digest):
+            slot = self._read_slot(index)
+            if slot[0] == digest:
+                found_index = index
+                break
+            count = self._estimate(slot, window_number, fraction)
+            if victim_count is None or count < victim_count:
+                (victim_index, victim_count) = (index, count)
+        if found_index is None:
+            if victim_count:
+                self.evictions += 1
+            self._write_slot(victim_index, digest, window_number, 1, 0)
+            return
+        (_, slot_window, current, previous) = slot
+        if slot_window == window_number:
+            current += 1
+        elif slot_window == window_number - 1:
+            (current, previous) = (1, current)
+        else:
+            (current, previous) = (1, 0)
+        self._write_slot(
+            found_index, digest, window_number, current, previous)
+
+    def record_failure(self, username, address):
+        """ Count a failed login for a username and client address """
+        user_digest = _key_digest("user", username)
+        address_digest = _key_digest("address", address)
+        (window_number, fraction) = self._now()
+        self._acquire()
+        try:
+            self.failures += 1
+            self._add_failure(user_digest, window_number, fraction)
+            self._add_failure(address_digest, window_number, fraction)
+        finally:
+            self._release()
+
+    def get_stats(self):
+        """ Get a dict of this process's throttle counters """
+        stats = dict(
+            checks = self.checks,
+            rejected_users = self.rejected_users,
+            rejected_addresses = self.rejected_addresses,
+            failures = self.failures,
+            evictions = self.evictions,
+            )
+        return stats
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# gracie/workerpool.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Bounded pool of worker threads
+"""
+
+import logging
+import threading
+import Queue
+
+# Get the Python logging instance for this module
+_logger = logging.getLogger("gracie.workerpool")
+
+default_queue_size = 64
+
+
+class WorkerPool(object):
+    """ Fixed set of threads consuming jobs from a bounded queue """
+
+    def __init__(self, num_threads, queue_size=default_queue_size,
+        name="worker",
+        ):
+        """ Set up a new instance """
+        self.num_threads = num_threads
+        self.name = name
+        self._queue = Queue.Queue(queue_size)
+        self._threads = []
+
+    def start(self):
+        """ Start the worker threads
+
+            Threads do not survive a fork, so this should be called
+            in the process that will submit the jobs.
+
+            """
+        name = self.name
+        num_threads = self.num_threads
+        for index in range(num_threads):
+            thread_name = "%(name)s-%(index)d" % vars()
+            thread = threading.Thread(
+                target=self._run_worker, name=thread_name)
+            thread.setDaemon(True)
+            self._threads.append(thread)
+            thread.start()
+        _logger.info(
+            "Started %(num_threads)d %(name)s threads" % vars())
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue a job, blocking while the queue is full """
+        job = (func, args, kwargs)
+        self._queue.put(job)
+
+    def try_submit(self, func, *args, **kwargs):
+        """ Queue a job unless the queue is full
+
+            Return ``True`` if the job was queued.
+
+            """
+        job = (func, args, kwargs)
+        try:
+            self._queue.put_nowait(job)
+        except Queue.Full:
+            return False
+        return True
+
+    def queue_depth(self):
+        """ Report the number of jobs waiting for a worker """
+        return self._queue.qsize()
+
+    def stop(self):
+        """ Ask every worker to exit once the queue drains """
+        for thread in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+    def _run_worker(self):
+        """ Take jobs from the queue and run them until stopped """
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            (func, args, kwargs) = job
+            try:
+                func(*args, **kwargs)
+            except Exception, e:
+                message = str(e)
+                _logger.error(message)
@@ -43,7 +43,6 @@ setup(
     test_suite = "test.suite.suite",
     install_requires = [
         "python-openid >= 1.2",
-        "Routes >= 1.6.3",
         ],
 
     # PyPI metadata
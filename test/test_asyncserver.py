@@ -0,0 +1,264 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# test/test_asyncserver.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for asyncserver module
+"""
+
+import sys
+import socket
+import asyncore
+import time
+import SocketServer
+
+import scaffold
+
+from gracie import asyncserver
+from gracie import httprequest
+import test_httprequest
+
+
+class Test_find_request_end(scaffold.TestCase):
+    """ Test cases for find_request_end function """
+
+    def test_incomplete_header_returns_none(self):
+        """ find_request_end should return None for partial header """
+        data = "GET / HTTP/1.1\r\nHost: example.org\r\n"
+        self.failUnlessEqual(None, asyncserver.find_request_end(data))
+
+    def test_complete_header_returns_header_end(self):
+        """ find_request_end should return end of a bodiless request """
+        request = "GET / HTTP/1.1\r\nHost: example.org\r\n\r\n"
+        data = request + "GET /next"
+        self.failUnlessEqual(
+            len(request), asyncserver.find_request_end(data))
+
+    def test_bare_newline_header_accepted(self):
+        """ find_request_end should accept LF-terminated header lines """
+        request = "GET / HTTP/1.0\nHost: example.org\n\n"
+        self.failUnlessEqual(
+            len(request), asyncserver.find_request_end(request))
+
+    def test_waits_for_full_body(self):
+        """ find_request_end should wait for Content-Length body """
+        header = "POST /login HTTP/1.1\r\nContent-Length: 10\r\n\r\n"
+        self.failUnlessEqual(
+            None, asyncserver.find_request_end(header + "spam"))
+        request = header + "spam=eggs!"
+        self.failUnlessEqual(
+            len(request), asyncserver.find_request_end(request))
+    def _failUnlessRequestError(self, code, data):
+        """ Fail unless find_request_end raises RequestError(code) """
+        try:
+            asyncserver.find_request_end(data)
+        except asyncserver.RequestError, e:
+            self.failUnlessEqual(code, e.code)
+        else:
+            self.fail("RequestError not raised")
+
+    def test_negative_content_length_rejected(self):
+        """ find_request_end should reject a negative Content-Length """
+        data = "POST /login HTTP/1.1\r\nContent-Length: -5\r\n\r\n"
+        self._failUnlessRequestError(400, data)
+
+    def test_invalid_content_length_rejected(self):
+        """ find_request_end should reject a non-numeric Content-Length """
+        data = "POST /login HTTP/1.1\r\nContent-Length: spam\r\n\r\n"
+        self._failUnlessRequestError(400, data)
+
+    def test_conflicting_content_length_rejected(self):
+        """ find_request_end should reject differing Content-Lengths """
+        data = (
+            "POST /login HTTP/1.1\r\n"
+            "Content-Length: 4\r\nContent-Length: 6\r\n\r\n")
+        self._failUnlessRequestError(400, data)
+
+    def test_transfer_encoding_rejected(self):
+        """ find_request_end should reject a Transfer-Encoding """
+        data = (
+            "POST /login HTTP/1.1\r\n"
+            "Transfer-Encoding: chunked\r\n\r\n4\r\nspam\r\n0\r\n\r\n")
+        self._failUnlessRequestError(400, data)
+
+    def test_large_header_rejected(self):
+        """ find_request_end should reject an oversized header """
+        data = "GET / HTTP/1.1\r\nX-Spam: " + (
+            "x" * asyncserver.max_header_size)
+        self._failUnlessRequestError(400, data)
+
+    def test_large_body_rejected(self):
+        """ find_request_end should reject an oversized body """
+        body_size = asyncserver.max_body_size + 1
+        data = (
+            "POST /login HTTP/1.1\r\n"
+            "Content-Length: %(body_size)d\r\n\r\n" % vars())
+        self._failUnlessRequestError(413, data)
+
+
+class Stub_RequestHandler(SocketServer.StreamRequestHandler):
+    """ Stub request handler echoing the request line """
+
+    close_connection = True
+
+    def handle(self):
+        request_line = self.rfile.readline().strip()
+        self.wfile.write("echo: %(request_line)s" % vars())
+
+
+class Stub_GracieServer(object):
+    """ Stub class for GracieServer """
+
+    version = "3.14.test"
+
+
+class Test_AsyncHTTPServer(scaffold.TestCase):
+    """ Test cases for AsyncHTTPServer class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.server_class = asyncserver.AsyncHTTPServer
+        self.instance = self.server_class(
+            ("127.0.0.1", 0), Stub_RequestHandler, Stub_GracieServer(),
+            2, 4
+            )
+        self.instance._waker = asyncserver._Waker(self.instance)
+        self.instance.executor.start()
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        self.instance.executor.stop()
+        asyncore.close_all(self.instance.socket_map)
+
+    def _exchange(self, request_text):
+        """ Send a request and pump the event loop for the response """
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(self.instance.server_address)
+        client.sendall(request_text)
+        client.setblocking(False)
+        response = ""
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            asyncore.loop(
+                timeout=0.05, count=1, map=self.instance.socket_map)
+            try:
+                data = client.recv(1024)
+            except socket.error:
+                continue
+            if not data:
+                break
+            response += data
+        client.close()
+        return response
+
+    def test_instantiate(self):
+        """ New AsyncHTTPServer instance should be created """
+        self.failIfIs(None, self.instance)
+
+    def test_server_location_is_set(self):
+        """ AsyncHTTPServer should have a server location """
+        self.failUnless(self.instance.server_location)
+
+    def test_request_handled_by_handler_class(self):
+        """ A complete request should get the handler's response """
+        response = self._exchange("GET /spam HTTP/1.0\r\n\r\n")
+        self.failUnlessEqual("echo: GET /spam HTTP/1.0", response)
+
+    def test_bad_request_gets_error_response(self):
+        """ A request that cannot be framed should get a 400 response """
+        response = self._exchange(
+            "POST /spam HTTP/1.1\r\nContent-Length: -1\r\n\r\n")
+        self.failUnless(response.startswith("HTTP/1.1 400 "))
+        self.failUnless("Connection: close\r\n" in response)
+
+    def test_full_queue_gets_unavailable_response(self):
+        """ A request finding the executor queue full should get a 503 """
+        self.instance.executor.try_submit = lambda *args: False
+        response = self._exchange("GET /spam HTTP/1.1\r\n\r\n")
+        self.failUnless(response.startswith("HTTP/1.1 503 "))
+
+    def test_busy_channel_stops_reading_when_buffer_full(self):
+        """ A busy channel should stop reading once its buffer is full """
+        channel = asyncserver.AsyncHTTPChannel(
+            None, ("127.0.0.1", 0), self.instance)
+        channel.busy = True
+        channel.in_buffer = "x" * (asyncserver.max_buffer_size - 1)
+        self.failUnless(channel.readable())
+        channel.in_buffer += "x"
+        self.failIf(channel.readable())
+
+    def test_pipelined_requests_answered_by_request_handler(self):
+        """ Pipelined requests should each get a response in order """
+        opts = test_httprequest.Stub_OptionValues(dict(
+            host = "example.org", port = 0,
+            root_url = "http://example.org:0/",
+            keepalive_timeout = 15, max_keepalive_requests = 100,
+            ))
+        self.instance.gracie_server = test_httprequest.Stub_GracieServer(
+            opts)
+        self.instance.RequestHandlerClass = httprequest.HTTPRequestHandler
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(self.instance.server_address)
+        client.sendall(
+            "GET / HTTP/1.1\r\nHost: example.org\r\n\r\n"
+            "GET /bogus HTTP/1.1\r\nHost: example.org\r\n\r\n"
+            "GET / HTTP/1.1\r\nHost: example.org\r\n\r\n")
+        client.setblocking(False)
+        response = ""
+        deadline = time.time() + 5
+        while time.time() < deadline and response.count("HTTP/1.1") < 3:
+            asyncore.loop(
+                timeout=0.05, count=1, map=self.instance.socket_map)
+            try:
+                response += client.recv(65536)
+            except socket.error:
+                pass
+        client.close()
+        status_lines = []
+        while response:
+            (header, _, response) = response.partition("\r\n\r\n")
+            header_lines = header.split("\r\n")
+            status_lines.append(header_lines[0])
+            for line in header_lines[1:]:
+                (name, _, value) = line.partition(":")
+                if name.lower() == "content-length":
+                    response = response[int(value):]
+        self.failUnlessEqual(
+            ["HTTP/1.1 200 OK", "HTTP/1.1 404 Not Found",
+             "HTTP/1.1 200 OK"],
+            status_lines)
+        self.failIf("Connection: close" in response)
+        channels = [
+            channel for channel in self.instance.socket_map.values()
+            if isinstance(channel, asyncserver.AsyncHTTPChannel)]
+        self.failUnlessEqual(3, channels[0].requests_served)
+        self.failIf(channels[0].closing)
+
+    def test_close_idle_channels_closes_idle_connection(self):
+        """ close_idle_channels should close channels idle too long """
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(self.instance.server_address)
+        asyncore.loop(timeout=0.5, count=1, map=self.instance.socket_map)
+        channels = [
+            channel for channel in self.instance.socket_map.values()
+            if isinstance(channel, asyncserver.AsyncHTTPChannel)]
+        self.failUnlessEqual(1, len(channels))
+        channels[0].last_activity -= 60
+        self.instance.close_idle_channels(30)
+        self.failIf(channels[0] in self.instance.socket_map.values())
+        client.close()
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
@@ -13,6 +13,10 @@
 """
 
 import sys
+import os
+import stat
+import shutil
+import tempfile
 
 import scaffold
 
@@ -69,6 +73,178 @@ class Test_ConsumerAuthStore(scaffold.TestCase):
         got_status = instance.is_authorised(auth_tuple)
         self.failUnlessEqual(False, got_status)
 
+    def test_get_stats_reports_size(self):
+        """ get_stats should report number of stored authorisations """
+        instance = self.store_class()
+        instance.store_authorisation(("/id/fred", "http://a/"), True)
+        instance.store_authorisation(("/id/fred", "http://b/"), True)
+        self.failUnlessEqual(2, instance.get_stats()['size'])
+
+    def test_remove_identity_removes_all_its_authorisations(self):
+        """ remove_identity should remove every root for the identity """
+        instance = self.store_class()
+        instance.store_authorisation(("/id/fred", "http://a/"), True)
+        instance.store_authorisation(("/id/fred", "http://b/"), False)
+        instance.store_authorisation(("/id/bill", "http://a/"), True)
+        num_removed = instance.remove_identity("/id/fred")
+        self.failUnlessEqual(2, num_removed)
+        self.failIf(instance.is_authorised(("/id/fred", "http://a/")))
+        self.failUnless(instance.is_authorised(("/id/bill", "http://a/")))
+
+    def test_remove_identities_skips_removed_authorisations(self):
+        """ remove_identities should not count removed authorisations """
+        instance = self.store_class()
+        instance.store_authorisation(("/id/fred", "http://a/"), True)
+        instance.store_authorisation(("/id/fred", "http://b/"), True)
+        instance.remove_authorisation(("/id/fred", "http://a/"))
+        num_removed = instance.remove_identities(
+            ["/id/fred", "/id/bogus"])
+        self.failUnlessEqual(1, num_removed)
+        self.failUnlessEqual(0, instance.get_stats()['size'])
+
+    def test_expired_authorisation_is_not_authorised(self):
+        """ An authorisation past its TTL should no longer apply """
+        instance = self.store_class(default_ttl=60)
+        auth_tuple = ("/id/fred", "http://a/")
+        instance.store_authorisation(auth_tuple, True)
+        instance.store_authorisation(("/id/fred", "http://b/"), True, -1)
+        self.failUnless(instance.is_authorised(auth_tuple))
+        self.failIf(instance.is_authorised(("/id/fred", "http://b/")))
+        self.failUnlessEqual(1, instance.get_stats()['expired'])
+        self.failUnlessEqual(1, instance.get_stats()['size'])
+
+    def test_unicode_values_match_byte_strings(self):
+        """ Unicode and UTF-8 values should name the same authorisation """
+        instance = self.store_class()
+        instance.store_authorisation((u"/id/fred", u"http://a/"), True)
+        self.failUnless(instance.is_authorised(("/id/fred", "http://a/")))
+
+    def test_identity_cap_evicts_nearest_expiry(self):
+        """ Storing past the cap should evict the soonest to expire """
+        instance = self.store_class(max_per_identity=2)
+        instance.store_authorisation(("/id/fred", "http://a/"), True)
+        instance.store_authorisation(("/id/fred", "http://b/"), True, 10)
+        instance.store_authorisation(("/id/fred", "http://c/"), True, 20)
+        self.failUnless(instance.is_authorised(("/id/fred", "http://a/")))
+        self.failIf(instance.is_authorised(("/id/fred", "http://b/")))
+        self.failUnless(instance.is_authorised(("/id/fred", "http://c/")))
+        self.failUnlessEqual(1, instance.get_stats()['evicted'])
+
+    def test_identity_cap_allows_replacing_known_root(self):
+        """ Storing a known root again should not evict another """
+        instance = self.store_class(max_per_identity=1)
+        instance.store_authorisation(("/id/fred", "http://a/"), True)
+        instance.store_authorisation(("/id/fred", "http://a/"), False)
+        self.failUnlessEqual(0, instance.get_stats()['evicted'])
+
+
+class Test_LoggedConsumerAuthStore(scaffold.TestCase):
+    """ Test cases for LoggedConsumerAuthStore class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.temp_dir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.temp_dir, "authorisations")
+        self.store_class = authorisation.LoggedConsumerAuthStore
+        self.instance = self.store_class(self.store_path)
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        shutil.rmtree(self.temp_dir)
+
+    def test_authorisations_survive_reopen(self):
+        """ Stored authorisations should be replayed on reopen """
+        self.instance.store_authorisation(("/id/fred", "http://a/"), True)
+        self.instance.store_authorisation(("/id/fred", "http://b/"), True)
+        self.instance.remove_authorisation(("/id/fred", "http://b/"))
+        self.instance.store_authorisation(("/id/bill", "http://a/"), True)
+        self.instance.remove_identity("/id/bill")
+        instance = self.store_class(self.store_path)
+        self.failUnless(instance.is_authorised(("/id/fred", "http://a/")))
+        self.failIf(instance.is_authorised(("/id/fred", "http://b/")))
+        self.failIf(instance.is_authorised(("/id/bill", "http://a/")))
+        self.failUnlessEqual(5, instance.get_stats()['log_records'])
+
+    def test_compact_writes_snapshot_and_empties_log(self):
+        """ Compaction should keep live entries and empty the log """
+        self.instance.store_authorisation(("/id/fred", "http://a/"), True)
+        self.instance.store_authorisation(
+            ("/id/fred", "http://b/"), True, -1)
+        self.instance.compact()
+        self.failUnlessEqual(0, os.path.getsize(self.instance.log_path))
+        self.instance.store_authorisation(("/id/bill", "http://a/"), True)
+        instance = self.store_class(self.store_path)
+        self.failUnlessEqual(2, instance.get_stats()['size'])
+        self.failUnless(instance.is_authorised(("/id/fred", "http://a/")))
+        self.failUnless(instance.is_authorised(("/id/bill", "http://a/")))
+
+    def test_snapshot_readable_only_by_owner(self):
+        """ Compaction should write a snapshot only its owner can read """
+        self.instance.store_authorisation(("/id/fred", "http://a/"), True)
+        umask_prev = os.umask(022)
+        try:
+            self.instance.compact()
+        finally:
+            os.umask(umask_prev)
+        mode = stat.S_IMODE(os.stat(self.store_path).st_mode)
+        self.failUnlessEqual(0600, mode)
+
+    def test_log_compacted_when_threshold_reached(self):
+        """ Appending enough records should compact the log """
+        prev_min_records = authorisation.compact_min_records
+        authorisation.compact_min_records = 3
+        try:
+            for root in ["http://a/", "http://b/", "http://c/"]:
+                self.instance.store_authorisation(("/id/fred", root), True)
+        finally:
+            authorisation.compact_min_records = prev_min_records
+        stats = self.instance.get_stats()
+        self.failUnlessEqual(1, stats['compactions'])
+        self.failUnlessEqual(0, stats['log_records'])
+
+    def test_incomplete_record_discarded_on_open(self):
+        """ A partly written final record should be cut from the log """
+        self.instance.store_authorisation(("/id/fred", "http://a/"), True)
+        log_file = open(self.instance.log_path, 'ab')
+        log_file.write("(\x05\x00")
+        log_file.close()
+        instance = self.store_class(self.store_path)
+        instance.store_authorisation(("/id/bill", "http://a/"), True)
+        instance = self.store_class(self.store_path)
+        self.failUnlessEqual(2, instance.get_stats()['size'])
+
+    def test_own_records_not_replayed_on_refresh(self):
+        """ Refresh should not apply or count this store's records again """
+        for root in ["http://a/", "http://b/", "http://c/"]:
+            self.instance.store_authorisation(("/id/fred", root), True)
+        self.failUnlessEqual(3, self.instance.get_stats()['log_records'])
+        self.instance.refresh(force=True)
+        self.failUnlessEqual(3, self.instance.get_stats()['log_records'])
+
+    def test_records_counted_once_after_other_writer(self):
+        """ Records after another store's should be counted on replay """
+        other = self.store_class(self.store_path)
+        other.store_authorisation(("/id/fred", "http://a/"), True)
+        self.instance.store_authorisation(("/id/fred", "http://b/"), True)
+        self.failUnlessEqual(0, self.instance.get_stats()['log_records'])
+        self.instance.refresh(force=True)
+        self.failUnlessEqual(2, self.instance.get_stats()['log_records'])
+        self.failUnless(
+            self.instance.is_authorised(("/id/fred", "http://a/")))
+
+    def test_refresh_picks_up_other_writers(self):
+        """ Changes by another store on the same files should be seen """
+        other = self.store_class(self.store_path)
+        other.store_authorisation(("/id/fred", "http://a/"), True)
+        self.instance.refresh(force=True)
+        self.failUnless(
+            self.instance.is_authorised(("/id/fred", "http://a/")))
+        other.compact()
+        other.remove_authorisation(("/id/fred", "http://a/"))
+        self.instance.refresh(force=True)
+        self.failIf(
+            self.instance.is_authorised(("/id/fred", "http://a/")))
+
 
 suite = scaffold.suite(__name__)
 
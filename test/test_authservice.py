@@ -12,6 +12,11 @@
 """ Unit test for authservice module
 """
 
+import os
+import tempfile
+import threading
+import time
+
 import scaffold
 
 from gracie import authservice
@@ -117,6 +122,8 @@ class Stub_AuthService(object):
 class Stub_PwdModule(object):
     """ Stub class for a pwd module """
 
+    lookups = 0
+
     _entries = [
         (e['name'], "*", e['id'], 500, e['comment'],
          "/home/"+e['name'], "/bin/sh")
@@ -127,6 +134,7 @@ class Stub_PwdModule(object):
 
     def getpwnam(self, name):
         """ Get an entry by account name """
+        self.lookups += 1
         try:
             entry = self._entries_by_name[name]
         except KeyError:
@@ -141,6 +149,17 @@ class Stub_PwdModule(object):
             raise KeyError("uid not found: %(uid)s" % vars())
         return entry
 
+class Stub_TimeModule(object):
+    """ Stub class for a time module """
+
+    def __init__(self, now):
+        """ Set up a new instance """
+        self.now = now
+
+    def time(self):
+        """ Get the current time """
+        return self.now
+
 class Test_PosixAuthService(scaffold.TestCase):
     """ Test cases for PosixAuthService class """
 
@@ -153,9 +172,21 @@ class Test_PosixAuthService(scaffold.TestCase):
         self.pwd_module = Stub_PwdModule()
         authservice.pwd = self.pwd_module
 
+        self.passwd_path_prev = authservice.passwd_path
+        (fd, self.passwd_path) = tempfile.mkstemp()
+        os.close(fd)
+        authservice.passwd_path = self.passwd_path
+
+        self.time_module_prev = authservice.time
+        self.time_module = Stub_TimeModule(1000000.0)
+        authservice.time = self.time_module
+
     def tearDown(self):
         """ Tear down test fixtures """
         authservice.pwd = self.pwd_module_prev
+        authservice.passwd_path = self.passwd_path_prev
+        authservice.time = self.time_module_prev
+        os.remove(self.passwd_path)
 
     def test_instantiate(self):
         """ New PosixAuthService instance should be created """
@@ -198,6 +229,73 @@ class Test_PosixAuthService(scaffold.TestCase):
         entry = instance.get_entry(name)
         self.failUnlessEqual(expect_entry, entry)
 
+    def test_get_entry_repeated_uses_cache(self):
+        """ get_entry for a name again within the TTL should not look up """
+        instance = self.service_class(entry_ttl=60)
+        entry = instance.get_entry("fred")
+        self.time_module.now += 59
+        self.failUnlessEqual(entry, instance.get_entry("fred"))
+        self.failUnlessEqual(1, self.pwd_module.lookups)
+
+    def test_get_entry_after_ttl_looks_up_again(self):
+        """ get_entry for a name after the TTL should look it up again """
+        instance = self.service_class(entry_ttl=60)
+        instance.get_entry("fred")
+        self.time_module.now += 60
+        instance.get_entry("fred")
+        self.failUnlessEqual(2, self.pwd_module.lookups)
+
+    def test_get_entry_unknown_name_is_cached(self):
+        """ get_entry for an unknown name again should not look up """
+        instance = self.service_class(negative_ttl=30)
+        for i in range(2):
+            self.failUnlessRaises(
+                KeyError,
+                instance.get_entry, "nosuchuser"
+                )
+        self.failUnlessEqual(1, self.pwd_module.lookups)
+        self.time_module.now += 30
+        self.failUnlessRaises(
+            KeyError,
+            instance.get_entry, "nosuchuser"
+            )
+        self.failUnlessEqual(2, self.pwd_module.lookups)
+
+    def test_unknown_names_do_not_evict_entries(self):
+        """ Looking up many unknown names should keep known entries """
+        instance = self.service_class(entry_cache_size=2)
+        instance.get_entry("fred")
+        for i in range(5):
+            self.failUnlessRaises(
+                KeyError,
+                instance.get_entry, "nosuchuser%(i)d" % vars()
+                )
+        instance.get_entry("fred")
+        self.failUnlessEqual(6, self.pwd_module.lookups)
+
+    def test_trim_caches_removes_expired_entries(self):
+        """ trim_caches should remove entries past their TTL """
+        instance = self.service_class(entry_ttl=300, negative_ttl=30)
+        instance.get_entry("fred")
+        self.failUnlessRaises(KeyError, instance.get_entry, "bogus")
+        self.failUnlessEqual(0, instance.trim_caches())
+        self.time_module.now += 300
+        self.failUnlessEqual(2, instance.trim_caches())
+        stats = instance.get_stats()
+        self.failUnlessEqual(0, stats['entries']['size'])
+        self.failUnlessEqual(0, stats['missing']['size'])
+
+    def test_passwd_file_change_discards_cache(self):
+        """ Changing the password file should discard cached entries """
+        instance = self.service_class(entry_ttl=60)
+        instance.get_entry("fred")
+        mtime = os.stat(self.passwd_path).st_mtime
+        os.utime(self.passwd_path, (mtime + 10, mtime + 10))
+        self.time_module.now += authservice.passwd_check_interval
+        instance.get_entry("fred")
+        self.failUnlessEqual(2, self.pwd_module.lookups)
+        self.failUnlessEqual(1, instance.get_stats()['invalidations'])
+
 
 class Stub_PamError(Exception):
     def __init__(self, code, reason):
@@ -292,6 +390,172 @@ class Stub_PamModule(object):
 stub_pam_module = Stub_PamModule()
 PAM = stub_pam_module
 
+class Test_PamHandlePool(scaffold.TestCase):
+    """ Test cases for PamHandlePool class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.pool_class = authservice.PamHandlePool
+        self.pam_module_prev = authservice.PAM
+        authservice.PAM = stub_pam_module
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        authservice.PAM = self.pam_module_prev
+
+    def test_checkout_creates_handle(self):
+        """ Checkout from an empty pool should create a handle """
+        instance = self.pool_class()
+        handle = instance.checkout()
+        self.failUnless(isinstance(handle.pam_auth, Stub_PamAuth))
+        stats = instance.get_stats()
+        self.failUnlessEqual(1, stats['created'])
+        self.failUnlessEqual(1, stats['handles'])
+
+    def test_checked_in_handle_is_reused(self):
+        """ A checked in handle should be lent again """
+        instance = self.pool_class()
+        handle = instance.checkout()
+        instance.checkin(handle)
+        self.failUnlessIs(handle, instance.checkout())
+        self.failUnlessEqual(1, instance.get_stats()['created'])
+
+    def test_concurrent_checkouts_get_distinct_handles(self):
+        """ Handles checked out together should not be shared """
+        instance = self.pool_class(max_handles=2)
+        handle_a = instance.checkout()
+        handle_b = instance.checkout()
+        self.failIfIs(handle_a, handle_b)
+
+    def test_handle_recycled_after_max_uses(self):
+        """ A handle used `max_uses` times should be replaced """
+        instance = self.pool_class(max_uses=2)
+        handle = instance.checkout()
+        instance.checkin(handle)
+        self.failUnlessIs(handle, instance.checkout())
+        instance.checkin(handle)
+        self.failIfIs(handle, instance.checkout())
+        self.failUnlessEqual(1, instance.get_stats()['recycled'])
+
+    def test_unhealthy_handle_recycled(self):
+        """ A handle checked in as unhealthy should be replaced """
+        instance = self.pool_class()
+        handle = instance.checkout()
+        instance.checkin(handle, healthy=False)
+        self.failIfIs(handle, instance.checkout())
+        self.failUnlessEqual(1, instance.get_stats()['recycled'])
+
+    def test_checkout_at_limit_waits_for_checkin(self):
+        """ Checkout with every handle lent should wait for a checkin """
+        instance = self.pool_class(max_handles=1)
+        handle = instance.checkout()
+        got_handles = []
+        thread = threading.Thread(
+            target=lambda: got_handles.append(instance.checkout()))
+        thread.start()
+        time.sleep(0.05)
+        self.failUnlessEqual([], got_handles)
+        instance.checkin(handle)
+        thread.join()
+        self.failUnlessEqual([handle], got_handles)
+        stats = instance.get_stats()
+        self.failUnlessEqual(1, stats['waits'])
+        self.failUnless(stats['max_wait'] > 0)
+
+class Test_CircuitBreaker(scaffold.TestCase):
+    """ Test cases for CircuitBreaker class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.breaker_class = authservice.CircuitBreaker
+        self.time_module_prev = authservice.time
+        self.time_module = Stub_TimeModule(1000.0)
+        authservice.time = self.time_module
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        authservice.time = self.time_module_prev
+
+    def _make_open_breaker(self):
+        """ Make a breaker opened by failures """
+        instance = self.breaker_class(threshold=2, reset_timeout=30)
+        instance.record_failure()
+        instance.record_failure()
+        return instance
+
+    def test_closed_breaker_allows_calls(self):
+        """ A new breaker should allow calls """
+        instance = self.breaker_class()
+        self.failUnless(instance.allow())
+        self.failUnlessEqual("closed", instance.state)
+
+    def test_failures_below_threshold_keep_breaker_closed(self):
+        """ Fewer failures than the threshold should not open it """
+        instance = self.breaker_class(threshold=2)
+        instance.record_failure()
+        self.failUnless(instance.allow())
+
+    def test_success_resets_failure_count(self):
+        """ A success should reset the consecutive failures """
+        instance = self.breaker_class(threshold=2)
+        instance.record_failure()
+        instance.record_success()
+        instance.record_failure()
+        self.failUnless(instance.allow())
+
+    def test_failures_at_threshold_open_breaker(self):
+        """ Failures reaching the threshold should refuse calls """
+        instance = self._make_open_breaker()
+        self.failUnlessEqual("open", instance.state)
+        self.failIf(instance.allow())
+        stats = instance.get_stats()
+        self.failUnlessEqual(1, stats['opens'])
+        self.failUnlessEqual(1, stats['rejected'])
+
+    def test_open_breaker_allows_one_probe_after_reset(self):
+        """ After the reset timeout one probe call should be allowed """
+        instance = self._make_open_breaker()
+        self.time_module.now += 30
+        self.failUnless(instance.allow())
+        self.failUnlessEqual("half-open", instance.state)
+        self.failIf(instance.allow())
+
+    def test_successful_probe_closes_breaker(self):
+        """ A successful probe should close the breaker """
+        instance = self._make_open_breaker()
+        self.time_module.now += 30
+        instance.allow()
+        instance.record_success()
+        self.failUnlessEqual("closed", instance.state)
+        self.failUnless(instance.allow())
+
+    def test_failed_probe_reopens_breaker(self):
+        """ A failed probe should open the breaker again """
+        instance = self._make_open_breaker()
+        self.time_module.now += 30
+        instance.allow()
+        instance.record_failure()
+        self.failUnlessEqual("open", instance.state)
+        self.failIf(instance.allow())
+        self.time_module.now += 30
+        self.failUnless(instance.allow())
+
+
+class Test_LatencyHistogram(scaffold.TestCase):
+    """ Test cases for LatencyHistogram class """
+
+    def test_record_counts_duration_in_bucket(self):
+        """ Each duration should be counted in the first bucket fitting """
+        instance = authservice.LatencyHistogram(bounds=(0.1, 1.0))
+        for duration in [0.05, 0.1, 0.5, 3.0]:
+            instance.record(duration)
+        stats = instance.get_stats()
+        expect_buckets = [(0.1, 2), (1.0, 1), (None, 1)]
+        self.failUnlessEqual(expect_buckets, stats['buckets'])
+        self.failUnlessEqual(4, stats['count'])
+        self.failUnlessEqual(3.0, stats['max'])
+
+
 class Test_PamAuthService(scaffold.TestCase):
     """ Test cases for PamAuthService class """
 
@@ -352,6 +616,80 @@ class Test_PamAuthService(scaffold.TestCase):
         result = instance.authenticate(credentials)
         self.failUnlessEqual(username, result)
 
+    def test_authenticate_returns_handle_to_pool(self):
+        """ Authentication should check its PAM handle back in """
+        instance = self.service_class()
+        credentials = dict(username = "fred", password = "bogus")
+        for i in range(3):
+            self.failUnlessRaises(
+                authservice.AuthenticationError,
+                instance.authenticate, credentials
+                )
+        stats = instance.get_stats()['pam_handles']
+        self.failUnlessEqual(1, stats['created'])
+        self.failUnlessEqual(1, stats['idle'])
+
+    def test_authenticate_abort_recycles_handle(self):
+        """ A PAM abort should cause the handle to be replaced """
+        instance = self.service_class()
+        def abort(flags=0):
+            raise PAM.error(PAM.PAM_ABORT, "Critical error")
+        handle = instance.handle_pool.checkout()
+        handle.pam_auth.authenticate = abort
+        instance.handle_pool.checkin(handle)
+        credentials = dict(username = "fred", password = "password1")
+        self.failUnlessRaises(
+            authservice.AuthenticationError,
+            instance.authenticate, credentials
+            )
+        stats = instance.get_stats()['pam_handles']
+        self.failUnlessEqual(1, stats['recycled'])
+        self.failUnlessEqual("fred", instance.authenticate(credentials))
+
+    def test_authenticate_past_deadline_raises_unavailable(self):
+        """ Authentication missing its deadline should fail as unavailable """
+        instance = self.service_class(deadline=0.05)
+        release = threading.Event()
+        def hang(flags=0):
+            release.wait()
+        handle = instance.handle_pool.checkout()
+        handle.pam_auth.authenticate = hang
+        instance.handle_pool.checkin(handle)
+        credentials = dict(username = "fred", password = "password1")
+        try:
+            self.failUnlessRaises(
+                authservice.AuthServiceUnavailableError,
+                instance.authenticate, credentials
+                )
+        finally:
+            release.set()
+        stats = instance.get_stats()
+        self.failUnlessEqual(1, stats['breaker']['failures'])
+        self.failUnlessEqual(1, stats['latency']['count'])
+
+    def test_authenticate_with_open_breaker_fails_fast(self):
+        """ Authentication with the breaker open should not reach PAM """
+        instance = self.service_class(breaker_threshold=1)
+        instance.breaker.record_failure()
+        credentials = dict(username = "fred", password = "password1")
+        self.failUnlessRaises(
+            authservice.AuthServiceUnavailableError,
+            instance.authenticate, credentials
+            )
+        stats = instance.get_stats()
+        self.failUnlessEqual(0, stats['pam_handles']['checkouts'])
+        self.failUnlessEqual(0, stats['latency']['count'])
+
+    def test_authenticate_refusal_counts_as_backend_answer(self):
+        """ A refusal by PAM should not count as a backend failure """
+        instance = self.service_class(breaker_threshold=1)
+        credentials = dict(username = "fred", password = "bogus")
+        self.failUnlessRaises(
+            authservice.AuthenticationError,
+            instance.authenticate, credentials
+            )
+        self.failUnlessEqual("closed", instance.breaker.state)
+
 
 suite = scaffold.suite(__name__)
 
@@ -0,0 +1,96 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# test/test_cache.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for cache module
+"""
+
+import sys
+
+import scaffold
+
+from gracie import cache
+
+
+class Test_LRUCache(scaffold.TestCase):
+    """ Test cases for LRUCache class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.cache_class = cache.LRUCache
+        self.instance = self.cache_class(3)
+
+    def test_instantiate(self):
+        """ New LRUCache instance should be created """
+        self.failIfIs(None, self.instance)
+
+    def test_get_returns_stored_value(self):
+        """ get should return the value stored for a key """
+        self.instance.set('spam', 1)
+        self.failUnlessEqual(1, self.instance.get('spam'))
+
+    def test_get_unknown_key_returns_default(self):
+        """ get should return the default for an unknown key """
+        marker = object()
+        self.failUnlessIs(marker, self.instance.get('spam', marker))
+
+    def test_set_beyond_size_evicts_least_recently_used(self):
+        """ set beyond max size should evict least recently used """
+        for key in ['spam', 'eggs', 'beans']:
+            self.instance.set(key, key)
+        self.instance.get('spam')
+        self.instance.set('ham', 'ham')
+        self.failUnlessEqual(3, len(self.instance))
+        self.failIf('eggs' in self.instance)
+        self.failUnless('spam' in self.instance)
+        self.failUnlessEqual(('beans', 'beans'), self.instance.oldest())
+
+    def test_pop_removes_entry(self):
+        """ pop should remove the key and return its value """
+        self.instance.set('spam', 1)
+        self.failUnlessEqual(1, self.instance.pop('spam'))
+        self.failIf('spam' in self.instance)
+        self.failUnlessEqual(None, self.instance.oldest())
+
+    def test_get_stats_counts_hits_and_misses(self):
+        """ get_stats should report hits, misses and evictions """
+        for key in ['spam', 'eggs', 'beans', 'ham']:
+            self.instance.set(key, key)
+        self.instance.get('ham')
+        self.instance.get('spam')
+        expect_stats = dict(size=3, hits=1, misses=1, evictions=1)
+        self.failUnlessEqual(expect_stats, self.instance.get_stats())
+
+    def test_trim_removes_stale_entries_from_oldest(self):
+        """ trim should remove stale entries until a fresh one """
+        for (key, value) in [('spam', 1), ('eggs', 5), ('beans', 2)]:
+            self.instance.set(key, value)
+        num_removed = self.instance.trim(lambda key, value: value < 3)
+        self.failUnlessEqual(1, num_removed)
+        self.failIf('spam' in self.instance)
+        self.failUnless('beans' in self.instance)
+
+    def test_trim_removes_at_most_max_count(self):
+        """ trim should remove no more than the specified count """
+        for key in ['spam', 'eggs', 'beans']:
+            self.instance.set(key, 0)
+        num_removed = self.instance.trim(
+            lambda key, value: True, max_count=2)
+        self.failUnlessEqual(2, num_removed)
+        self.failUnlessEqual(1, len(self.instance))
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
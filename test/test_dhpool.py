@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# test/test_dhpool.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for dhpool module
+"""
+
+import time
+
+from openid import cryptutil
+from openid.dh import DiffieHellman
+from openid.message import Message
+from openid.server.server import AssociateRequest
+from openid.consumer.consumer import DiffieHellmanSHA1ConsumerSession
+
+import scaffold
+
+from gracie import dhpool
+
+
+def make_associate_message(consumer_session):
+    """ Make an associate request message for a consumer session """
+    args = dict(
+        mode = "associate",
+        assoc_type = "HMAC-SHA1",
+        session_type = consumer_session.session_type,
+        )
+    args.update(consumer_session.getRequest())
+    return Message.fromOpenIDArgs(args)
+
+
+class Test_DHKeyPool(scaffold.TestCase):
+    """ Test cases for DHKeyPool class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.pool_class = dhpool.DHKeyPool
+
+    def _fill(self, instance):
+        """ Fill a pool using its producer thread """
+        instance.start()
+        try:
+            deadline = time.time() + 30.0
+            while instance.get_stats()['depth'] < instance.size:
+                self.failUnless(time.time() < deadline)
+                time.sleep(0.01)
+        finally:
+            instance.stop()
+
+    def test_take_from_empty_pool_generates_keypair(self):
+        """ Taking from an empty pool should generate a keypair inline """
+        instance = self.pool_class(4)
+        dh = instance.take()
+        self.failUnless(isinstance(dh, DiffieHellman))
+        self.failUnless(dh.usingDefaultValues())
+        stats = instance.get_stats()
+        self.failUnlessEqual(1, stats['fallbacks'])
+        self.failUnlessEqual(0, stats['taken'])
+
+    def test_producer_fills_pool_to_size(self):
+        """ The producer should fill the pool, and no further """
+        instance = self.pool_class(3)
+        self._fill(instance)
+        stats = instance.get_stats()
+        self.failUnlessEqual(3, stats['depth'])
+        self.failUnless(stats['generated'] <= 4)
+        self.failUnless(stats['refill_rate'] > 0)
+
+    def test_take_uses_each_pooled_keypair_once(self):
+        """ Taking should use pooled keypairs, each only once """
+        instance = self.pool_class(3)
+        self._fill(instance)
+        keys = [instance.take() for i in range(3)]
+        public_keys = set(dh.public for dh in keys)
+        self.failUnlessEqual(3, len(public_keys))
+        stats = instance.get_stats()
+        self.failUnlessEqual(3, stats['taken'])
+        self.failUnlessEqual(0, stats['fallbacks'])
+        self.failUnlessEqual(0, stats['depth'])
+
+    def test_take_after_fork_discards_inherited_keypairs(self):
+        """ Keypairs made by another process should not be used """
+        instance = self.pool_class(2)
+        self._fill(instance)
+        instance._pid = -1
+        instance.take()
+        stats = instance.get_stats()
+        self.failUnlessEqual(0, stats['depth'])
+        self.failUnlessEqual(1, stats['fallbacks'])
+
+
+class Test_PooledDHServerSession(scaffold.TestCase):
+    """ Test cases for the pooled DH server session classes """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.session_classes_prev = AssociateRequest.session_classes.copy()
+        self.key_pool = dhpool.DHKeyPool(2)
+        self.pooled_key = self.key_pool._generate()
+        self.key_pool._keys.put(self.pooled_key)
+        dhpool.install_key_pool(self.key_pool)
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        AssociateRequest.session_classes.clear()
+        AssociateRequest.session_classes.update(self.session_classes_prev)
+        dhpool.PooledDHSHA1ServerSession.key_pool = None
+        dhpool.PooledDHSHA256ServerSession.key_pool = None
+
+    def test_install_registers_session_classes(self):
+        """ Installing a pool should register the pooled sessions """
+        session_classes = AssociateRequest.session_classes
+        self.failUnlessIs(
+            dhpool.PooledDHSHA1ServerSession, session_classes['DH-SHA1'])
+        self.failUnlessIs(
+            dhpool.PooledDHSHA256ServerSession,
+            session_classes['DH-SHA256'])
+
+    def test_default_group_uses_pooled_keypair(self):
+        """ A request for the default group should use a pooled keypair """
+        consumer_session = DiffieHellmanSHA1ConsumerSession()
+        message = make_associate_message(consumer_session)
+        request = AssociateRequest.fromMessage(message)
+        self.failUnlessIs(self.pooled_key, request.session.dh)
+        self.failUnlessEqual(1, self.key_pool.get_stats()['taken'])
+
+    def test_pooled_keypair_answers_consumer(self):
+        """ A session with a pooled keypair should share the secret """
+        consumer_session = DiffieHellmanSHA1ConsumerSession()
+        message = make_associate_message(consumer_session)
+        request = AssociateRequest.fromMessage(message)
+        secret = cryptutil.randomString(20)
+        response = Message.fromOpenIDArgs(request.session.answer(secret))
+        self.failUnlessEqual(
+            secret, consumer_session.extractSecret(response))
+
+    def test_custom_group_generates_keypair(self):
+        """ A request for another group should not use the pool """
+        dh = DiffieHellman(23, 5)
+        consumer_session = DiffieHellmanSHA1ConsumerSession(dh)
+        message = make_associate_message(consumer_session)
+        request = AssociateRequest.fromMessage(message)
+        self.failUnlessEqual(23, request.session.dh.modulus)
+        self.failUnlessEqual(1, self.key_pool.get_stats()['depth'])
+        self.failUnlessEqual(0, self.key_pool.get_stats()['taken'])
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
@@ -161,6 +161,34 @@ class Test_Gracie(scaffold.TestCase):
                 expect_stdout, self.stdout_test.getvalue()
                 )
 
+    def test_workers_with_memory_sessions_invokes_parser_error(self):
+        """ Workers without shared sessions should invoke parser error """
+        gracied.OptionParser.error = Mock(
+            "OptionParser.error",
+            )
+        argv = ["progname", "--workers", "2"]
+        args = dict(argv=argv)
+        expect_stdout = """\
+            Called OptionParser.error(
+                'Workers cannot share sessions...')
+            """
+        instance = self.app_class(**args)
+        self.failUnlessOutputCheckerMatch(
+            expect_stdout, self.stdout_test.getvalue()
+            )
+
+    def test_workers_with_shared_sessions_accepted(self):
+        """ Workers with shared sessions should be accepted """
+        valid_argv_params = [
+            ["--workers", "2", "--session-store", "sqlite"],
+            ["--workers", "2", "--session-mode", "signed"],
+            ]
+        for options in valid_argv_params:
+            argv = ["progname"] + options
+            args = dict(argv=argv)
+            instance = self.app_class(**args)
+            self.failUnlessEqual(2, instance.opts.workers)
+
     def test_opts_version_performs_version_action(self):
         """ Gracie instance should perform version action """
         argv = ["progname", "--version"]
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# test/test_housekeeping.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for housekeeping module
+"""
+
+import sys
+import threading
+
+import scaffold
+from test_authservice import Stub_TimeModule
+
+from gracie import housekeeping
+
+
+class Stub_Task(object):
+    """ Stub cleanup function removing items from a backlog """
+
+    def __init__(self, time_module, backlog, batch=10, cost=0.0):
+        """ Set up a new instance """
+        self.time_module = time_module
+        self.backlog = backlog
+        self.batch = batch
+        self.cost = cost
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        self.time_module.now += self.cost
+        num_removed = min(self.batch, self.backlog)
+        self.backlog -= num_removed
+        return num_removed
+
+
+class Test_Housekeeper(scaffold.TestCase):
+    """ Test cases for Housekeeper class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.housekeeper_class = housekeeping.Housekeeper
+        self.time_module_prev = housekeeping.time
+        self.time_module = Stub_TimeModule(1000.0)
+        housekeeping.time = self.time_module
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        housekeeping.time = self.time_module_prev
+
+    def _make_task(self, backlog, **kwargs):
+        """ Make a stub task function """
+        return Stub_Task(self.time_module, backlog, **kwargs)
+
+    def test_incremental_task_runs_until_done(self):
+        """ An incremental task should be called until it finds nothing """
+        instance = self.housekeeper_class(budget=1.0)
+        task = self._make_task(25)
+        instance.add_task("spam", task, incremental=True)
+        instance.run_tick()
+        self.failUnlessEqual(0, task.backlog)
+        self.failUnlessEqual(4, task.calls)
+        stats = instance.get_stats()['tasks']['spam']
+        self.failUnlessEqual(25, stats['removed'])
+
+    def test_incremental_task_stops_at_budget(self):
+        """ An incremental task should stop when the budget is spent """
+        instance = self.housekeeper_class(budget=1.0)
+        task = self._make_task(100, cost=0.4)
+        instance.add_task("spam", task, incremental=True)
+        instance.run_tick()
+        self.failUnlessEqual(3, task.calls)
+        instance.run_tick()
+        self.failUnlessEqual(6, task.calls)
+
+    def test_periodic_task_waits_for_period(self):
+        """ A task with a period should not run again until it passes """
+        instance = self.housekeeper_class()
+        task = self._make_task(100)
+        instance.add_task("spam", task, period=600)
+        instance.run_tick()
+        self.failUnlessEqual(1, task.calls)
+        self.time_module.now += 300
+        instance.run_tick()
+        self.failUnlessEqual(1, task.calls)
+        self.time_module.now += 300
+        instance.run_tick()
+        self.failUnlessEqual(2, task.calls)
+
+    def test_spent_budget_leaves_tasks_for_next_tick(self):
+        """ Tasks not reached within the budget should be run next tick """
+        instance = self.housekeeper_class(budget=1.0)
+        slow_task = self._make_task(1, cost=2.0)
+        other_task = self._make_task(1)
+        instance.add_task("slow", slow_task, period=600)
+        instance.add_task("other", other_task, period=600)
+        instance.run_tick()
+        self.failUnlessEqual(0, other_task.calls)
+        self.failUnlessEqual(1, instance.get_stats()['overruns'])
+        instance.run_tick()
+        self.failUnlessEqual(1, other_task.calls)
+        self.failUnlessEqual(1, slow_task.calls)
+
+    def test_failing_task_does_not_stop_others(self):
+        """ A task raising an exception should be counted and skipped """
+        instance = self.housekeeper_class()
+        def fail():
+            raise IOError("Disk on fire")
+        task = self._make_task(5)
+        instance.add_task("fail", fail)
+        instance.add_task("spam", task)
+        instance.run_tick()
+        self.failUnlessEqual(1, task.calls)
+        stats = instance.get_stats()['tasks']
+        self.failUnlessEqual(1, stats['fail']['failures'])
+
+    def test_started_thread_runs_ticks_until_stopped(self):
+        """ A started housekeeper should run ticks in a thread """
+        housekeeping.time = self.time_module_prev
+        instance = self.housekeeper_class(interval=0.01)
+        ran = threading.Event()
+        def task():
+            ran.set()
+            return 0
+        instance.add_task("spam", task)
+        instance.start()
+        ran.wait(5)
+        instance.stop()
+        self.failUnless(ran.isSet())
+        self.failUnless(instance.get_stats()['ticks'] >= 1)
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
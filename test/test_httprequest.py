@@ -13,6 +13,7 @@
 """
 
 import sys
+import errno
 from StringIO import StringIO
 import logging
 import urllib
@@ -23,9 +24,13 @@ from test_authservice import Stub_AuthService
 from test_server import (
     Stub_OpenIDStore, Stub_OpenIDServer, Stub_OpenIDError,
     Stub_OpenIDRequest, Stub_OpenIDResponse, Stub_OpenIDWebResponse,
+    Stub_ConsumerAuthStore, Stub_LoginThrottle,
     )
 
 from gracie import httprequest
+from gracie.httpserver import ConnectionStats
+from gracie.authservice import AuthServiceUnavailableError
+from gracie.signedsession import SessionTooLargeError
 
 
 class Stub_Logger(object):
@@ -45,6 +50,7 @@ class Stub_SessionManager(object):
     def __init__(self):
         """ Set up a new instance """
         self._sessions = dict()
+        self.indexed = []
 
     def create_session(self, session):
         username = session.get('username')
@@ -64,14 +70,27 @@ class Stub_SessionManager(object):
     def remove_session(self, session_id):
         del self._sessions[session_id]
 
+    def save_session(self, session):
+        pass
+
+    def flush(self):
+        pass
+
+    def index_session(self, session):
+        self.indexed.append(
+            (session.get('username'), session.get('session_id')))
+
 class Stub_HTTPServer(object):
     """ Stub class for HTTPServer """
 
+    persistent_connections = True
+
     def __init__(self, server_address, handler_class, gracie_server):
         """ Set up a new instance """
         self.gracie_server = gracie_server
         (host, port) = server_address
         self.server_location = "%(host)s:%(port)s" % vars()
+        self.connection_stats = ConnectionStats()
 
 class Stub_HTTPRequestHandler(object):
     """ Stub class for HTTPRequestHandler """
@@ -101,6 +120,8 @@ class Stub_GracieServer(object):
         self.openid_server = Stub_OpenIDServer(store)
         self.auth_service = Stub_AuthService()
         self.sess_manager = Stub_SessionManager()
+        self.consumer_auth_store = Stub_ConsumerAuthStore()
+        self.login_throttle = Stub_LoginThrottle()
 
 
 class Stub_TCPConnection(object):
@@ -110,6 +131,10 @@ class Stub_TCPConnection(object):
         """ Set up a new instance """
         self._text = text
 
+    def settimeout(self, timeout):
+        """ Set the socket timeout """
+        self.timeout = timeout
+
     def makefile(self, mode, bufsize):
         """ Make a file handle to the connection stream """
         conn_file = None
@@ -207,6 +232,16 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
             'get-root': dict(
                 request = Stub_Request("GET", "/"),
                 ),
+            'get-root-http-1.0': dict(
+                request = Stub_Request("GET", "/", version="HTTP/1.0"),
+                ),
+            'get-root-keep-alive-http-1.0': dict(
+                request = Stub_Request("GET", "/", version="HTTP/1.0",
+                    header = [
+                        ("Connection", "keep-alive"),
+                        ],
+                    ),
+                ),
             'no-cookie': dict(
                 request = Stub_Request("GET", "/"),
                 ),
@@ -477,6 +512,8 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
                 host = "example.org",
                 port = 0,
                 root_url = "http://example.org:0/",
+                keepalive_timeout = 15,
+                max_keepalive_requests = 100,
                 ))
             gracie_server = Stub_GracieServer(opts)
             sess_manager = gracie_server.sess_manager
@@ -621,27 +658,46 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
             expect_stdout, self.stdout_test.getvalue()
             )
 
-    def test_request_with_no_cookie_response_creates_session(self):
-        """ With no session cookie, response should create new session """
+    def test_request_with_no_cookie_creates_no_session(self):
+        """ With no session cookie, unchanged session is not created """
         params = self.valid_requests['no-cookie']
+        sess_manager = params['server'].gracie_server.sess_manager
+        sessions_prev = sess_manager._sessions.copy()
+        instance = self.handler_class(**params['args'])
+        self.failUnlessEqual(sessions_prev, sess_manager._sessions)
+        self.failIf("Set-Cookie" in self.stdout_test.getvalue())
+
+    def test_request_with_unknown_cookie_expires_cookie(self):
+        """ With unknown session cookie, response should expire it """
+        params = self.valid_requests['unknown-cookie']
         instance = self.handler_class(**params['args'])
         expect_stdout = """\
             Called ResponseHeader_class(200)
             ...
             Called Response.header.fields.append(
-                ('Set-Cookie', 'TEST_session=DEADBEEF'))
+                ('Set-Cookie',
+                 'TEST_session=;Expires=Thu, 01-Jan-70 00:00:00 GMT'))
             Called Response.send_to_handler(...)
             """
         self.failUnlessOutputCheckerMatch(
             expect_stdout, self.stdout_test.getvalue()
             )
 
-    def test_request_with_unknown_cookie_creates_new_session(self):
-        """ With unknown username, response should create new session """
-        params = self.valid_requests['unknown-cookie']
+    def test_request_with_good_cookie_sends_no_cookie(self):
+        """ With good session cookie, response should not set cookie """
+        params = self.valid_requests['good-cookie']
         instance = self.handler_class(**params['args'])
+        self.failUnlessEqual("fred", instance.session['username'])
+        self.failIf("Set-Cookie" in self.stdout_test.getvalue())
+
+    def test_session_write_creates_session_and_sets_cookie(self):
+        """ Writing to a new session should create it and set cookie """
+        params = self.valid_requests['openid-query-checkid_setup-no-session']
+        sess_manager = params['server'].gracie_server.sess_manager
+        sess_manager._sessions.clear()
+        instance = self.handler_class(**params['args'])
+        self.failUnless("DEADBEEF" in sess_manager._sessions)
         expect_stdout = """\
-            Called ResponseHeader_class(200)
             ...
             Called Response.header.fields.append(
                 ('Set-Cookie', 'TEST_session=DEADBEEF'))
@@ -651,21 +707,24 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
             expect_stdout, self.stdout_test.getvalue()
             )
 
-    def test_request_with_good_cookie_response_logged_in(self):
-        """ With good session cookie, response should send Logged In """
-        params = self.valid_requests['good-cookie']
-        identity_name = params['identity_name']
+    def test_session_too_large_sends_protocol_error(self):
+        """ A session too large to store should send an error page """
+        params = self.valid_requests['openid-query-checkid_setup-no-session']
+        sess_manager = params['server'].gracie_server.sess_manager
+        def raise_SessionTooLargeError(session):
+            raise SessionTooLargeError("Testing error")
+        sess_manager.create_session = raise_SessionTooLargeError
         instance = self.handler_class(**params['args'])
         expect_stdout = """\
-            Called ResponseHeader_class(200)
             ...
-            Called Response.header.fields.append(
-                ('Set-Cookie', 'TEST_session=DEADBEEF-%(identity_name)s'))
+            Called Page_class('Protocol Error')
+            ...
             Called Response.send_to_handler(...)
-            """ % vars()
+            """
         self.failUnlessOutputCheckerMatch(
             expect_stdout, self.stdout_test.getvalue()
             )
+        self.failIf("Set-Cookie" in self.stdout_test.getvalue())
 
     def test_get_root_sends_ok_response(self):
         """ Request to GET root document should send OK response """
@@ -680,6 +739,28 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
             expect_stdout, self.stdout_test.getvalue()
             )
 
+    def test_blocking_server_closes_connection_after_response(self):
+        """ A server holding a thread per connection should not keep it """
+        params = self.valid_requests['get-root']
+        params['server'].persistent_connections = False
+        instance = self.handler_class(**params['args'])
+        expect_stdout = """\
+            Called ResponseHeader_class(200)
+            ...
+            Called Response.header.fields.append(('Connection', 'close'))
+            Called Response.send_to_handler(...)
+            """
+        self.failUnlessOutputCheckerMatch(
+            expect_stdout, self.stdout_test.getvalue()
+            )
+
+    def test_persistent_server_keeps_connection_after_response(self):
+        """ A server allowing persistent connections should keep them """
+        params = self.valid_requests['get-root']
+        instance = self.handler_class(**params['args'])
+        self.failIf(
+            "'Connection'" in self.stdout_test.getvalue())
+
     def test_get_bogus_url_sends_not_found_response(self):
         """ Request to GET unknown URL should send Not Found response """
         params = self.valid_requests['get-bogus']
@@ -724,15 +805,16 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
             expect_stdout, self.stdout_test.getvalue()
             )
 
-    def get_logout_creates_new_session_and_redirects(self):
-        """ Request to logout should create new session and logout """
+    def get_logout_expires_session_and_redirects(self):
+        """ Request to logout should expire session and redirect """
         params = self.valid_requests['logout']
         instance = self.handler_class(**params['args'])
         expect_stdout = """\
             Called ResponseHeader_class(302)
             Called Response.header.fields.append('Location', ...)
             Called Response.header.fields.append(
-                ('Set-Cookie', 'TEST_session=DEADBEEF'))
+                ('Set-Cookie',
+                 'TEST_session=;Expires=Thu, 01-Jan-70 00:00:00 GMT'))
             Called Response.send_to_handler(...)
             """
         self.failUnlessOutputCheckerMatch(
@@ -828,6 +910,53 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
             expect_stdout, self.stdout_test.getvalue()
             )
 
+    def test_post_login_wrong_password_records_failure(self):
+        """ POST login with wrong password should count a failure """
+        params = self.valid_requests['login-fred-wrong']
+        login_throttle = params['server'].gracie_server.login_throttle
+        instance = self.handler_class(**params['args'])
+        address = params['args']['client_address'][0]
+        self.failUnlessEqual([("fred", address)], login_throttle.failures)
+
+    def test_post_login_throttled_sends_refusal_without_auth(self):
+        """ POST login over the failure limit should be refused at once """
+        params = self.valid_requests['login-fred-okay']
+        gracie_server = params['server'].gracie_server
+        gracie_server.login_throttle.refuse = True
+        def authenticate(credentials):
+            raise AssertionError("Authentication attempted")
+        gracie_server.auth_service.authenticate = authenticate
+        instance = self.handler_class(**params['args'])
+        expect_stdout = """\
+            Called ResponseHeader_class(429, content_type='text/plain')
+            Called Response_class(
+                <Mock ... ResponseHeader>,
+                %(text)r)
+            Called Response.send_to_handler(...)
+            """ % dict(text=httprequest.login_throttled_text)
+        self.failUnlessOutputCheckerMatch(
+            expect_stdout, self.stdout_test.getvalue()
+            )
+
+    def test_post_login_auth_unavailable_sends_unavailable_response(self):
+        """ Login the backend cannot answer should send 503 response """
+        params = self.valid_requests['login-fred-okay']
+        def authenticate(credentials):
+            raise AuthServiceUnavailableError(
+                errno.ETIMEDOUT, "Authentication timed out")
+        auth_service = params['server'].gracie_server.auth_service
+        auth_service.authenticate = authenticate
+        instance = self.handler_class(**params['args'])
+        expect_stdout = """\
+            Called ResponseHeader_class(503)
+            Called Page_class('Login Failed')
+            ...
+            Called Response.send_to_handler(...)
+            """ % vars()
+        self.failUnlessOutputCheckerMatch(
+            expect_stdout, self.stdout_test.getvalue()
+            )
+
     def test_post_login_auth_correct_no_openid_redirects_to_root(self):
         """ Login with no OpenID, correct details should redirect to root """
         params = self.valid_requests['login-fred-okay']
@@ -845,6 +974,15 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
             expect_stdout, self.stdout_test.getvalue()
             )
 
+    def test_post_login_auth_correct_indexes_session_by_user(self):
+        """ Login with correct details should index the session """
+        params = self.valid_requests['login-fred-okay']
+        sess_manager = params['server'].gracie_server.sess_manager
+        instance = self.handler_class(**params['args'])
+        (username, session_id) = sess_manager.indexed[-1]
+        self.failUnlessEqual("fred", username)
+        self.failIfEqual(None, session_id)
+
     def test_post_openid_login_auth_correct_redirects_to_openid_url(self):
         """ Login correct with OpenID should redirect to OpenID URL """
         params = self.valid_requests['openid-login-fred-okay']
@@ -862,6 +1000,16 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
             expect_stdout, self.stdout_test.getvalue()
             )
 
+    def test_post_openid_login_auth_correct_remembers_trust(self):
+        """ Login correct with OpenID should remember the trust root """
+        params = self.valid_requests['openid-login-fred-okay']
+        openid_request = params['session']['last_openid_request']
+        gracie_server = params['server'].gracie_server
+        instance = self.handler_class(**params['args'])
+        auth_tuple = (openid_request.identity, openid_request.trust_root)
+        self.failUnless(
+            gracie_server.consumer_auth_store.is_authorised(auth_tuple))
+
     def test_post_openid_login_auth_other_sends_wrong_auth(self):
         """ Login wrong auth with OpenID should send Auth Required """
         params = self.valid_requests['openid-login-bill-other']
@@ -927,13 +1075,21 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
             Called ResponseHeader_class(200)
             Called ResponseHeader.fields.append(('openid', 'yes'))
             Called Response_class(..., 'OpenID response')
-            ...
             Called Response.send_to_handler(...)
             """
         self.failUnlessOutputCheckerMatch(
             expect_stdout, self.stdout_test.getvalue()
             )
 
+    def test_get_server_assoc_query_creates_no_session(self):
+        """ OpenID associate query should not create a session """
+        params = self.valid_requests['openid-query-associate']
+        sess_manager = params['server'].gracie_server.sess_manager
+        sessions_prev = sess_manager._sessions.copy()
+        instance = self.handler_class(**params['args'])
+        self.failUnlessEqual(sessions_prev, sess_manager._sessions)
+        self.failIf("Set-Cookie" in self.stdout_test.getvalue())
+
     def test_checkid_immediate_no_session_returns_failure(self):
         """ OpenID check_immediate with no session should reject """
         params_key = 'openid-query-checkid_immediate-no-session'
@@ -994,6 +1150,65 @@ class Test_HTTPRequestHandler(scaffold.TestCase):
                 expect_stdout, self.stdout_test.getvalue()
                 )
 
+    def test_checkid_with_session_remembers_trust(self):
+        """ OpenID checkid answered positively should remember trust """
+        for params_key in [
+            'openid-query-checkid_immediate-right-session',
+            'openid-query-checkid_setup-right-session',
+            ]:
+            params = self.valid_requests[params_key]
+            args = params['args']
+            gracie_server = args['server'].gracie_server
+            instance = self.handler_class(**args)
+            auth_tuple = ("http://example.org:0/id/fred", None)
+            self.failUnless(
+                gracie_server.consumer_auth_store.is_authorised(
+                    auth_tuple))
+
+    def test_checkid_with_remembered_trust_answers_directly(self):
+        """ OpenID checkid with remembered trust should not store again """
+        params_key = 'openid-query-checkid_setup-right-session'
+        params = self.valid_requests[params_key]
+        args = params['args']
+        consumer_auth_store = args['server'].gracie_server.consumer_auth_store
+        auth_tuple = ("http://example.org:0/id/fred", None)
+        consumer_auth_store.store_authorisation(auth_tuple, True)
+        stored = []
+        def store_authorisation(auth_tuple, status):
+            stored.append(auth_tuple)
+        consumer_auth_store.store_authorisation = store_authorisation
+        instance = self.handler_class(**args)
+        expect_stdout = """\
+            Called openid_server.decodeRequest(...)
+            Called OpenIDRequest.answer(True)
+            Called openid_server.encodeResponse(...)
+            ...
+            Called Response.send_to_handler(...)
+            """
+        self.failUnlessOutputCheckerMatch(
+            expect_stdout, self.stdout_test.getvalue()
+            )
+        self.failUnlessEqual([], stored)
+
+    def test_checkid_other_session_does_not_use_remembered_trust(self):
+        """ Remembered trust should not answer for another session """
+        params_key = 'openid-query-checkid_setup-other-session'
+        params = self.valid_requests[params_key]
+        args = params['args']
+        consumer_auth_store = args['server'].gracie_server.consumer_auth_store
+        auth_tuple = ("http://example.org:0/id/fred", None)
+        consumer_auth_store.store_authorisation(auth_tuple, True)
+        instance = self.handler_class(**args)
+        expect_stdout = """\
+            Called openid_server.decodeRequest(...)
+            Called ResponseHeader_class(200)
+            Called Page_class('Authentication Required')
+            ...
+            """
+        self.failUnlessOutputCheckerMatch(
+            expect_stdout, self.stdout_test.getvalue()
+            )
+
 
 suite = scaffold.suite(__name__)
 
@@ -39,10 +39,6 @@ class Test_ResponseHeader(scaffold.TestCase):
             'ok': dict(
                 code = 200,
                 ),
-            'ok-protocol': dict(
-                code = 200,
-                protocol = "HTTP/1.1",
-                ),
             'content-type-bogus': dict(
                 code = 200,
                 content_type = "BoGuS",
@@ -53,9 +49,6 @@ class Test_ResponseHeader(scaffold.TestCase):
             args = params.get('args', dict())
             code = params['code']
             args['code'] = code
-            protocol = params.get('protocol')
-            if protocol is not None:
-                args['protocol'] = protocol
             content_type = params.get('content_type')
             if content_type is not None:
                 args['content_type'] = content_type
@@ -80,22 +73,6 @@ class Test_ResponseHeader(scaffold.TestCase):
             instance = params['instance']
             self.failUnlessEqual(code, instance.code)
 
-    def test_protocol_default_http_1_0(self):
-        """ ResponseHeader protocol should default to HTTP/1.0 """
-        params = self.valid_headers['simple']
-        instance = params['instance']
-        protocol = "HTTP/1.0"
-        self.failUnlessEqual(protocol, instance.protocol)
-
-    def test_protocol_as_specified(self):
-        """ ResponseHeader should have specified response protocol """
-        for key, params in self.iterate_params():
-            protocol = params.get('protocol')
-            if protocol is None:
-                continue
-            instance = params['instance']
-            self.failUnlessEqual(protocol, instance.protocol)
-
     def test_content_type_default_xhtml(self):
         """ ResponseHeader should default to Content-Type of XHTML """
         params = self.valid_headers['simple']
@@ -114,14 +91,28 @@ class Test_ResponseHeader(scaffold.TestCase):
             self.failUnless(expect_field in instance.fields)
 
 
+class Stub_WriteFile(object):
+    """ Stub class for a connection's write file """
+
+    def __init__(self):
+        self.writes = []
+    def write(self, data):
+        self.writes.append(data)
+    def flush(self):
+        pass
+
 class Stub_RequestHandler(object):
     """ Stub class for BaseHTTPRequestHandler """
 
+    protocol_version = "HTTP/1.1"
+    request_version = "HTTP/1.1"
+    close_connection = 0
+
     def __init__(self):
-        self.wfile = StringIO("")
-    def send_response(self, code, message=None):
-        pass
-    def end_headers(self):
+        self.wfile = Stub_WriteFile()
+    def version_string(self):
+        return "Gracie/3.14.test"
+    def log_request(self, code):
         pass
 
 class Test_Response(scaffold.TestCase):
@@ -138,7 +129,7 @@ class Test_Response(scaffold.TestCase):
                 ),
             'payload': dict(
                 header = Stub_ResponseHeader(code = 200),
-                data = object(),
+                data = "Lorem ipsum",
                 ),
             }
 
@@ -187,10 +178,9 @@ class Test_Response(scaffold.TestCase):
             handler = Mock('HTTPRequestHandler')
             instance.send_to_handler(handler)
             expect_stdout = """\
-                Called HTTPRequestHandler.send_response(...)
-                ...Called HTTPRequestHandler.end_headers()
-                Called HTTPRequestHandler.wfile.write(...)
-                Called HTTPRequestHandler.wfile.close()
+                Called HTTPRequestHandler.log_request(200)
+                ...Called HTTPRequestHandler.wfile.write(...)
+                Called HTTPRequestHandler.wfile.flush()
                 """
             self.failUnlessOutputCheckerMatch(
                 expect_stdout, self.stdout_test.getvalue()
@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# test/test_interning.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for interning module
+"""
+
+import sys
+
+import scaffold
+
+from gracie import interning
+
+
+class Test_intern_value(scaffold.TestCase):
+    """ Test cases for intern_value function """
+
+    def test_bytes_value_is_interned(self):
+        """ intern_value should return the interned byte string """
+        value = "".join(["fr", "ed"])
+        self.failUnlessIs(intern("fred"), interning.intern_value(value))
+
+    def test_text_value_is_interned_as_bytes(self):
+        """ intern_value should encode text and intern the bytes """
+        value = u"fréd"
+        expect_value = intern("fr\xc3\xa9d")
+        self.failUnlessIs(expect_value, interning.intern_value(value))
+
+    def test_other_value_is_unchanged(self):
+        """ intern_value should return other values unchanged """
+        for value in [None, 42, ("fred",)]:
+            self.failUnlessIs(value, interning.intern_value(value))
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
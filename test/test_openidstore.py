@@ -0,0 +1,279 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# test/test_openidstore.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for openidstore module
+"""
+
+import sys
+import os
+import shutil
+import tempfile
+
+import scaffold
+from test_authservice import Stub_TimeModule
+from openid.association import Association
+from openid.store import nonce
+from openid.store.memstore import MemoryStore
+
+from gracie import openidstore
+
+
+class Test_SqliteOpenIDStore(scaffold.TestCase):
+    """ Test cases for SqliteOpenIDStore class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.store_class = openidstore.SqliteOpenIDStore
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "openid.db")
+        self.time_module_prev = openidstore.time
+        self.time_module = Stub_TimeModule(1200000000)
+        openidstore.time = self.time_module
+        self.server_url = "http://example.org/openidserver"
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        openidstore.time = self.time_module_prev
+        shutil.rmtree(self.temp_dir)
+
+    def _make_association(self, handle, issued=None, lifetime=600):
+        """ Make an association issued at a time """
+        if issued is None:
+            issued = self.time_module.now
+        association = Association(
+            handle, "secret\0%(handle)s" % vars(),
+            issued, lifetime, "HMAC-SHA1")
+        return association
+
+    def test_get_association_by_handle_returns_stored(self):
+        """ An association stored should be got by its handle """
+        instance = self.store_class(self.path)
+        association = self._make_association("handle1")
+        instance.storeAssociation(self.server_url, association)
+        got = instance.getAssociation(self.server_url, "handle1")
+        self.failUnlessEqual(association, got)
+
+    def test_get_association_unknown_returns_none(self):
+        """ An unknown association should be got as None """
+        instance = self.store_class(self.path)
+        self.failUnlessIs(
+            None, instance.getAssociation(self.server_url, "bogus"))
+        self.failUnlessIs(None, instance.getAssociation(self.server_url))
+
+    def test_get_association_without_handle_returns_newest(self):
+        """ Without a handle, the newest association should be got """
+        instance = self.store_class(self.path)
+        now = self.time_module.now
+        older = self._make_association("handle1", issued=now - 100)
+        newer = self._make_association("handle2", issued=now - 10)
+        instance.storeAssociation(self.server_url, newer)
+        instance.storeAssociation(self.server_url, older)
+        instance.storeAssociation(
+            "http://example.com/other",
+            self._make_association("handle3", issued=now))
+        self.failUnlessEqual(newer, instance.getAssociation(self.server_url))
+
+    def test_get_association_expired_returns_none(self):
+        """ An expired association should not be got """
+        instance = self.store_class(self.path)
+        association = self._make_association("handle1", lifetime=60)
+        instance.storeAssociation(self.server_url, association)
+        self.time_module.now += 60
+        self.failUnlessIs(
+            None, instance.getAssociation(self.server_url, "handle1"))
+        self.failUnlessIs(None, instance.getAssociation(self.server_url))
+
+    def test_remove_association_reports_existence(self):
+        """ Removing an association should report whether it existed """
+        instance = self.store_class(self.path)
+        association = self._make_association("handle1")
+        instance.storeAssociation(self.server_url, association)
+        self.failUnless(
+            instance.removeAssociation(self.server_url, "handle1"))
+        self.failIf(
+            instance.removeAssociation(self.server_url, "handle1"))
+        self.failUnlessIs(
+            None, instance.getAssociation(self.server_url, "handle1"))
+
+    def test_cleanup_associations_removes_expired(self):
+        """ Cleanup should remove only expired associations """
+        instance = self.store_class(self.path)
+        instance.storeAssociation(
+            self.server_url,
+            self._make_association("handle1", lifetime=60))
+        instance.storeAssociation(
+            self.server_url,
+            self._make_association("handle2", lifetime=600))
+        self.time_module.now += 100
+        self.failUnlessEqual(1, instance.cleanupAssociations())
+        self.failIfIs(
+            None, instance.getAssociation(self.server_url, "handle2"))
+
+    def test_use_nonce_only_once(self):
+        """ A nonce should be usable only once """
+        instance = self.store_class(self.path)
+        timestamp = self.time_module.now
+        self.failUnless(
+            instance.useNonce(self.server_url, timestamp, "salt1"))
+        self.failIf(
+            instance.useNonce(self.server_url, timestamp, "salt1"))
+        self.failUnless(
+            instance.useNonce(self.server_url, timestamp, "salt2"))
+
+    def test_use_nonce_outside_skew_refused(self):
+        """ A nonce too far from the current time should be refused """
+        instance = self.store_class(self.path)
+        timestamp = self.time_module.now - nonce.SKEW - 1
+        self.failIf(
+            instance.useNonce(self.server_url, timestamp, "salt1"))
+
+    def test_cleanup_nonces_removes_old_buckets(self):
+        """ Cleanup should remove nonces too old to be accepted """
+        instance = self.store_class(self.path)
+        old_timestamp = self.time_module.now
+        instance.useNonce(self.server_url, old_timestamp, "salt1")
+        self.time_module.now += nonce.SKEW
+        instance.useNonce(self.server_url, self.time_module.now, "salt2")
+        self.failUnlessEqual(0, instance.cleanupNonces())
+        self.time_module.now += 2 * openidstore.nonce_bucket_seconds
+        self.failUnlessEqual(1, instance.cleanupNonces())
+
+    def test_store_shared_with_forked_process(self):
+        """ An association stored by another process should be got """
+        instance = self.store_class(self.path)
+        instance.getAssociation(self.server_url)
+        association = self._make_association("handle1")
+        pid = os.fork()
+        if pid == 0:
+            try:
+                instance.storeAssociation(self.server_url, association)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.failUnlessEqual(
+            association, instance.getAssociation(self.server_url))
+
+class Stub_BackingStore(MemoryStore):
+    """ Stub class for a backing store, counting association reads """
+
+    def __init__(self):
+        """ Set up a new instance """
+        MemoryStore.__init__(self)
+        self.reads = 0
+
+    def getAssociation(self, server_url, handle=None):
+        self.reads += 1
+        return MemoryStore.getAssociation(self, server_url, handle)
+
+
+class Test_CachingOpenIDStore(scaffold.TestCase):
+    """ Test cases for CachingOpenIDStore class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.store_class = openidstore.CachingOpenIDStore
+        self.backing_store = Stub_BackingStore()
+        self.time_module_prev = openidstore.time
+        self.time_module = Stub_TimeModule(1200000000)
+        openidstore.time = self.time_module
+        self.server_url = "http://localhost/|normal"
+        self.association = Association(
+            "handle1", "secret", self.time_module.now, 600, "HMAC-SHA1")
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        openidstore.time = self.time_module_prev
+
+    def test_stored_association_got_from_memory(self):
+        """ An association stored should be got without a store read """
+        instance = self.store_class(self.backing_store)
+        instance.storeAssociation(self.server_url, self.association)
+        got = instance.getAssociation(self.server_url, "handle1")
+        self.failUnlessEqual(self.association, got)
+        self.failUnlessEqual(0, self.backing_store.reads)
+        self.failUnlessEqual(1, instance.get_stats()['hits'])
+
+    def test_stored_association_written_through(self):
+        """ An association stored should be written to the store """
+        instance = self.store_class(self.backing_store)
+        instance.storeAssociation(self.server_url, self.association)
+        got = self.backing_store.getAssociation(self.server_url, "handle1")
+        self.failUnlessEqual(self.association, got)
+
+    def test_miss_reads_store_once(self):
+        """ An association not in memory should be read and kept """
+        self.backing_store.storeAssociation(
+            self.server_url, self.association)
+        instance = self.store_class(self.backing_store)
+        for i in range(3):
+            got = instance.getAssociation(self.server_url, "handle1")
+            self.failUnlessEqual(self.association, got)
+        self.failUnlessEqual(1, self.backing_store.reads)
+        stats = instance.get_stats()
+        self.failUnlessEqual(1, stats['misses'])
+        self.failUnlessEqual(2, stats['hits'])
+
+    def test_expired_association_not_returned(self):
+        """ An association past its expiry should not be got """
+        instance = self.store_class(self.backing_store)
+        instance.storeAssociation(self.server_url, self.association)
+        self.time_module.now += 600
+        self.failUnlessIs(
+            None, instance.getAssociation(self.server_url, "handle1"))
+        self.failUnlessEqual(1, instance.get_stats()['expired'])
+
+    def test_removed_association_not_returned(self):
+        """ A removed association should be gone from memory and store """
+        instance = self.store_class(self.backing_store)
+        instance.storeAssociation(self.server_url, self.association)
+        self.failUnless(
+            instance.removeAssociation(self.server_url, "handle1"))
+        self.failUnlessIs(
+            None, instance.getAssociation(self.server_url, "handle1"))
+        self.failUnlessIs(None,
+            self.backing_store.getAssociation(self.server_url, "handle1"))
+
+    def test_cached_association_read_again_after_ttl(self):
+        """ A cached association should be checked against the store """
+        instance = self.store_class(self.backing_store, cache_ttl=60)
+        instance.storeAssociation(self.server_url, self.association)
+        self.backing_store.removeAssociation(self.server_url, "handle1")
+        self.time_module.now += 60
+        self.failUnlessIs(
+            None, instance.getAssociation(self.server_url, "handle1"))
+
+    def test_trim_cache_removes_expired_associations(self):
+        """ trim_cache should remove associations past their expiry """
+        instance = self.store_class(self.backing_store)
+        instance.storeAssociation(self.server_url, self.association)
+        self.failUnlessEqual(0, instance.trim_cache())
+        self.time_module.now += 600
+        self.failUnlessEqual(1, instance.trim_cache())
+        self.failUnlessEqual(0, instance.get_stats()['size'])
+
+    def test_dumb_mode_association_not_cached(self):
+        """ A dumb-mode association should always be read from the store """
+        server_url = "http://localhost/|dumb"
+        instance = self.store_class(self.backing_store)
+        instance.storeAssociation(server_url, self.association)
+        instance.getAssociation(server_url, "handle1")
+        self.failUnlessEqual(1, self.backing_store.reads)
+        self.failUnlessEqual(0, instance.get_stats()['size'])
+
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
@@ -0,0 +1,285 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# test/test_pamhelper.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for pamhelper module
+"""
+
+import sys
+import os
+import socket
+import struct
+import marshal
+import shutil
+import tempfile
+import threading
+
+import scaffold
+from test_authservice import stub_pam_module
+
+from gracie import pamhelper
+from gracie import authservice
+
+
+class Stub_HelperService(object):
+    """ Stub class for the PAM service used by a helper """
+
+    def __init__(self):
+        """ Set up a new instance """
+        self.requests = []
+
+    def _authenticate_creds(self, username, password):
+        self.requests.append(username)
+        if password != "password1":
+            raise stub_pam_module.error(
+                stub_pam_module.PAM_AUTH_ERR, "Authentication failed")
+        return username
+
+
+class Test_Messages(scaffold.TestCase):
+    """ Test cases for helper protocol messages """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        (self.client, self.server) = socket.socketpair()
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        self.client.close()
+        self.server.close()
+
+    def test_message_roundtrip(self):
+        """ A sent message should be received unchanged """
+        message = ("error", "Authentication failed", 7)
+        pamhelper.send_message(self.client, message)
+        self.failUnlessEqual(message, pamhelper.recv_message(self.server))
+
+    def test_request_roundtrip(self):
+        """ A sent request should be received unchanged """
+        pamhelper.send_request(self.client, "fred", "password1")
+        self.failUnlessEqual(
+            ("fred", "password1"), pamhelper.recv_request(self.server))
+
+    def test_request_read_as_two_strings(self):
+        """ A request should be split into strings by its lengths """
+        self.client.sendall(struct.pack("!II", 1, 3) + "abcd")
+        self.failUnlessEqual(
+            ("a", "bcd"), pamhelper.recv_request(self.server))
+
+    def test_request_non_string_field_rejected(self):
+        """ A request field other than a byte string should be refused """
+        for (username, password) in [("fred", 1), (5, "password1")]:
+            self.failUnlessRaises(
+                ValueError,
+                pamhelper.send_request, self.client, username, password
+                )
+
+    def test_oversize_request_rejected(self):
+        """ A request longer than the limit should raise ValueError """
+        size = pamhelper.max_message_size
+        self.client.sendall(struct.pack("!II", size, 1))
+        self.failUnlessRaises(
+            ValueError,
+            pamhelper.recv_request, self.server
+            )
+
+    def test_oversize_message_rejected(self):
+        """ A message longer than the limit should raise ValueError """
+        size = pamhelper.max_message_size + 1
+        self.client.sendall(struct.pack("!I", size))
+        self.failUnlessRaises(
+            ValueError,
+            pamhelper.recv_message, self.server
+            )
+
+    def test_closed_connection_raises_eoferror(self):
+        """ A connection closed mid-message should raise EOFError """
+        self.client.sendall(struct.pack("!I", 10) + "abc")
+        self.client.close()
+        self.failUnlessRaises(
+            EOFError,
+            pamhelper.recv_message, self.server
+            )
+
+
+class Test_handle_request(scaffold.TestCase):
+    """ Test cases for handle_request function """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.pam_module_prev = pamhelper.PAM
+        pamhelper.PAM = stub_pam_module
+        self.service = Stub_HelperService()
+        (self.client, self.server) = socket.socketpair()
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        pamhelper.PAM = self.pam_module_prev
+        self.client.close()
+        self.server.close()
+
+    def test_good_credentials_reply_ok(self):
+        """ Good credentials should get a reply with the username """
+        pamhelper.send_request(self.client, "fred", "password1")
+        pamhelper.handle_request(self.service, self.server)
+        reply = pamhelper.recv_message(self.client)
+        self.failUnlessEqual(("ok", "fred"), reply)
+
+    def test_bad_credentials_reply_error(self):
+        """ Bad credentials should get a reply with the PAM error """
+        pamhelper.send_request(self.client, "fred", "bogus")
+        pamhelper.handle_request(self.service, self.server)
+        reply = pamhelper.recv_message(self.client)
+        expect_reply = (
+            "error", "Authentication failed", stub_pam_module.PAM_AUTH_ERR)
+        self.failUnlessEqual(expect_reply, reply)
+
+    def test_marshalled_request_rejected(self):
+        """ A marshalled value should be refused, not decoded """
+        data = marshal.dumps(5)
+        self.client.sendall(struct.pack("!I", len(data)) + data)
+        self.failUnlessRaises(
+            ValueError,
+            pamhelper.handle_request, self.service, self.server
+            )
+        self.failUnlessEqual([], self.service.requests)
+
+    def test_cancelled_request_not_authenticated(self):
+        """ A request whose client has gone should be skipped """
+        pamhelper.send_request(self.client, "fred", "password1")
+        self.client.shutdown(socket.SHUT_WR)
+        pamhelper.handle_request(self.service, self.server)
+        self.failUnlessEqual([], self.service.requests)
+
+
+class Test_PamHelperPool(scaffold.TestCase):
+    """ Test cases for PamHelperPool class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.pam_module_prev = pamhelper.PAM
+        pamhelper.PAM = stub_pam_module
+        self.temp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.temp_dir, "helper.sock")
+        self.listen_socket = socket.socket(
+            socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listen_socket.bind(self.socket_path)
+        self.listen_socket.listen(4)
+        self.service = Stub_HelperService()
+        self.pool_class = pamhelper.PamHelperPool
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        pamhelper.PAM = self.pam_module_prev
+        self.listen_socket.close()
+        shutil.rmtree(self.temp_dir)
+
+    def _make_pool(self, **kwargs):
+        """ Make a pool connecting to the test socket """
+        pool = self.pool_class(**kwargs)
+        pool.socket_path = self.socket_path
+        return pool
+
+    def _serve_one(self, answer=True):
+        """ Accept one connection in a thread, answering if specified """
+        def serve():
+            (conn, _) = self.listen_socket.accept()
+            try:
+                if answer:
+                    pamhelper.handle_request(self.service, conn)
+                else:
+                    pamhelper.recv_request(conn)
+                    conn.recv(1)
+            finally:
+                conn.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        return thread
+
+    def test_authenticate_good_credentials_returns_username(self):
+        """ Good credentials should return the username from a helper """
+        pool = self._make_pool()
+        thread = self._serve_one()
+        self.failUnlessEqual("fred", pool.authenticate("fred", "password1"))
+        thread.join()
+        self.failUnlessEqual(1, pool.get_stats()['requests'])
+
+    def test_authenticate_bad_credentials_raises_autherror(self):
+        """ Bad credentials should raise AuthenticationError """
+        pool = self._make_pool()
+        thread = self._serve_one()
+        self.failUnlessRaises(
+            authservice.AuthenticationError,
+            pool.authenticate, "fred", "bogus"
+            )
+        thread.join()
+
+    def test_authenticate_unanswered_times_out(self):
+        """ A request not answered in time should raise AuthenticationError """
+        pool = self._make_pool(timeout=0.1)
+        thread = self._serve_one(answer=False)
+        self.failUnlessRaises(
+            authservice.AuthenticationError,
+            pool.authenticate, "fred", "password1"
+            )
+        thread.join()
+        self.failUnlessEqual(1, pool.get_stats()['timeouts'])
+
+    def test_authenticate_past_queue_depth_rejected(self):
+        """ A request beyond the queue depth should be rejected at once """
+        pool = self._make_pool(queue_depth=0)
+        self.failUnlessRaises(
+            authservice.AuthenticationError,
+            pool.authenticate, "fred", "password1"
+            )
+        self.failUnlessEqual(1, pool.get_stats()['rejected'])
+
+    def test_started_pool_authenticates_in_helper_process(self):
+        """ A started pool should answer from a forked helper """
+        pam_module_prev = authservice.PAM
+        authservice.PAM = stub_pam_module
+        pool = self._make_pool(num_helpers=1)
+        try:
+            pool.start()
+            try:
+                username = pool.authenticate("fred", "password1")
+            finally:
+                pool.stop()
+        finally:
+            authservice.PAM = pam_module_prev
+        self.failUnlessEqual("fred", username)
+        self.failIf(os.path.exists(pool.socket_dir))
+
+    def test_started_pool_detaches_from_session(self):
+        """ A started pool's supervisor should lead its own session """
+        pam_module_prev = authservice.PAM
+        authservice.PAM = stub_pam_module
+        pool = self._make_pool(num_helpers=1)
+        try:
+            pool.start()
+            try:
+                pool.authenticate("fred", "password1")
+                supervisor_sid = os.getsid(pool.supervisor_pid)
+                supervisor_pid = pool.supervisor_pid
+            finally:
+                pool.stop()
+        finally:
+            authservice.PAM = pam_module_prev
+        self.failUnlessEqual(supervisor_pid, supervisor_sid)
+        self.failIfEqual(os.getsid(0), supervisor_sid)
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
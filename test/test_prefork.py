@@ -0,0 +1,104 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# test/test_prefork.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for prefork module
+"""
+
+import sys
+from StringIO import StringIO
+
+import scaffold
+
+from gracie import prefork
+
+
+def stub_worker_func():
+    """ Stub function for a worker's serving loop """
+
+
+class Test_PreforkSupervisor(scaffold.TestCase):
+    """ Test cases for PreforkSupervisor class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.mock_outfile = StringIO()
+
+        self.supervisor_class = prefork.PreforkSupervisor
+
+        scaffold.mock("prefork.os.fork", returns_iter=[101, 102, 103],
+            outfile=self.mock_outfile)
+        scaffold.mock("prefork.os.kill",
+            outfile=self.mock_outfile)
+        scaffold.mock("prefork.os.waitpid",
+            outfile=self.mock_outfile)
+        scaffold.mock("prefork.time.sleep",
+            outfile=self.mock_outfile)
+
+        self.instance = self.supervisor_class(2, stub_worker_func)
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        scaffold.mock_restore()
+
+    def test_instantiate(self):
+        """ New PreforkSupervisor instance should be created """
+        self.failIfIs(None, self.instance)
+
+    def test_spawn_worker_records_child_pid(self):
+        """ _spawn_worker should record the forked child's PID """
+        pid = self.instance._spawn_worker()
+        self.failUnlessEqual(101, pid)
+        self.failUnless(101 in self.instance.workers)
+
+    def test_worker_exit_respawns_worker(self):
+        """ Exit of a worker should fork a replacement """
+        self.instance._spawn_worker()
+        self.instance._spawn_worker()
+        self.instance._handle_worker_exit(101, 1)
+        self.failUnlessEqual([102, 103], sorted(self.instance.workers))
+
+    def test_worker_exit_while_stopping_does_not_respawn(self):
+        """ Exit of a worker while stopping should not fork another """
+        self.instance._spawn_worker()
+        self.instance._stopping = True
+        self.instance._handle_worker_exit(101, 0)
+        self.failUnlessEqual({}, self.instance.workers)
+
+    def test_unknown_pid_exit_is_ignored(self):
+        """ Exit of an unknown child should not fork a worker """
+        self.instance._handle_worker_exit(999, 0)
+        self.failUnlessEqual({}, self.instance.workers)
+
+    def test_stop_terminates_all_workers(self):
+        """ stop should signal and reap every worker """
+        self.instance._spawn_worker()
+        self.instance._spawn_worker()
+        self.mock_outfile.truncate(0)
+        self.instance.stop()
+        expect_mock_output = """\
+            Called prefork.os.kill(..., 15)
+            Called prefork.os.kill(..., 15)
+            Called prefork.os.waitpid(..., 0)
+            Called prefork.os.waitpid(..., 0)
+            """
+        self.failUnlessOutputCheckerMatch(
+            expect_mock_output, self.mock_outfile.getvalue()
+            )
+        self.failUnlessEqual({}, self.instance.workers)
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
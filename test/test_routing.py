@@ -0,0 +1,88 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# test/test_routing.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for routing module
+"""
+
+import sys
+
+import scaffold
+
+from gracie import routing
+
+
+class Test_RouteTable(scaffold.TestCase):
+    """ Test cases for RouteTable class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.table_class = routing.RouteTable
+        self.instance = self.table_class()
+        self.instance.connect('root', '',
+            controller='about', action='view')
+        self.instance.connect('openid', 'openidserver',
+            controller='openid')
+        self.instance.connect('identity', 'id/:name',
+            controller='identity', action='view')
+
+    def test_instantiate(self):
+        """ New RouteTable instance should be created """
+        self.failIfIs(None, self.instance)
+
+    def test_match_root_path(self):
+        """ match should route the root path """
+        expect_map = dict(controller='about', action='view')
+        self.failUnlessEqual(expect_map, self.instance.match("/"))
+
+    def test_match_default_action(self):
+        """ match should give default action for route without one """
+        expect_map = dict(controller='openid', action='index')
+        self.failUnlessEqual(
+            expect_map, self.instance.match("/openidserver"))
+
+    def test_match_named_parameter(self):
+        """ match should extract named parameter from the path """
+        for name in ["fred", "a.b", "a%20b"]:
+            path = "/id/%(name)s" % vars()
+            expect_map = dict(
+                controller='identity', action='view', name=name)
+            self.failUnlessEqual(expect_map, self.instance.match(path))
+
+    def test_match_unknown_path_returns_none(self):
+        """ match should return None for paths with no route """
+        for path in ["/x", "/id/", "/id/fred/", "/openidserver/", ""]:
+            self.failUnlessEqual(None, self.instance.match(path))
+
+    def test_match_result_is_cached(self):
+        """ match should answer a repeated path from the cache """
+        self.instance.match("/id/fred")
+        self.instance.match("/id/fred")
+        self.instance.match("/x")
+        self.instance.match("/x")
+        stats = self.instance._cache.get_stats()
+        self.failUnlessEqual(2, stats['hits'])
+
+    def test_connect_clears_cache(self):
+        """ connect should discard results cached before it """
+        self.failUnlessEqual(None, self.instance.match("/login"))
+        self.instance.connect('login', 'login',
+            controller='login', action='view')
+        expect_map = dict(controller='login', action='view')
+        self.failUnlessEqual(expect_map, self.instance.match("/login"))
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
@@ -14,6 +14,8 @@
 
 import sys
 import os
+import shutil
+import tempfile
 from StringIO import StringIO
 import optparse
 
@@ -143,12 +145,22 @@ class Stub_HTTPServer(object):
     """ Stub class for HTTPServer """
     def __init__(
         self,
-        server_address, RequestHandlerClass, gracie_server
+        server_address, RequestHandlerClass, gracie_server,
+        reuse_port=False,
         ):
         """ Set up a new instance """
 
     server_bind = stub_server_bind
 
+class Stub_ThreadPoolHTTPServer(Stub_HTTPServer):
+    """ Stub class for ThreadPoolHTTPServer """
+    def __init__(
+        self,
+        server_address, RequestHandlerClass, gracie_server,
+        num_threads, queue_size, reuse_port=False,
+        ):
+        """ Set up a new instance """
+
 class Stub_ResponseHeader(object):
     """ Stub class for response header """
 
@@ -169,15 +181,49 @@ class Stub_Response(object):
 class Stub_ConsumerAuthStore(object):
     """ Stub class for ConsumerAuthStore """
 
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
         self._authorisations = dict()
 
-    def store_authorisation(self, auth_tuple, status):
+    def store_authorisation(self, auth_tuple, status, ttl=None):
         self._authorisations[auth_tuple] = status
 
     def is_authorised(self, auth_tuple):
         return self._authorisations.get(auth_tuple, False)
 
+class Stub_LoggedConsumerAuthStore(Stub_ConsumerAuthStore):
+    """ Stub class for LoggedConsumerAuthStore """
+
+    def __init__(self, path, *args, **kwargs):
+        super(Stub_LoggedConsumerAuthStore, self).__init__()
+        self.path = path
+
+class Stub_PamHelperPool(object):
+    """ Stub class for PamHelperPool """
+
+    def __init__(self, num_helpers, *args, **kwargs):
+        self.num_helpers = num_helpers
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.stopped = True
+
+class Stub_LoginThrottle(object):
+    """ Stub class for LoginThrottle """
+
+    def __init__(self, *args, **kwargs):
+        self.failures = []
+        self.refuse = False
+
+    def is_allowed(self, username, address):
+        return not self.refuse
+
+    def record_failure(self, username, address):
+        self.failures.append((username, address))
+
 class Stub_ConsumerAuthStore_always_auth(Stub_ConsumerAuthStore):
     """ ConsumerAuthStore stub that always authorises """
 
@@ -194,6 +240,9 @@ class Stub_ConsumerAuthStore_never_auth(Stub_ConsumerAuthStore):
 class Stub_SessionManager(object):
     """ Stub class for SessionManager """
 
+    def __init__(self, *args, **kwargs):
+        """ Set up a new instance """
+
     def store_session(self, session):
         pass
 
@@ -203,6 +252,9 @@ class Stub_SessionManager(object):
     def remove_session(self, session_id):
         pass
 
+    def expire_sessions(self):
+        return 0
+
 
 class Stub_HTTPRequestHandler(object):
     """ Stub class for HTTPRequestHandler """
@@ -217,11 +269,43 @@ class Stub_OpenIDStore(object):
     def __init__(self, _, *args, **kwargs):
         """ Set up a new instance """
 
+    def cleanupNonces(self):
+        return 0
+
+    def cleanupAssociations(self):
+        return 0
+
+class Stub_SqliteOpenIDStore(Stub_OpenIDStore):
+    """ Stub class for SqliteOpenIDStore """
+
+    def __init__(self, path):
+        """ Set up a new instance """
+        self.path = path
+
+class Stub_DHKeyPool(object):
+    """ Stub class for DHKeyPool """
+
+    def __init__(self, size):
+        """ Set up a new instance """
+        self.size = size
+        self.installed = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+def stub_install_key_pool(key_pool):
+    """ Stub function for install_key_pool """
+    key_pool.installed = True
+
 class Stub_OpenIDServer(object):
     """ Stub class for an OpenID protocol server """
 
     def __init__(self, store):
         """ Set up a new instance """
+        self.store = store
 
     def decodeRequest(self, request):
         return Stub_OpenIDResponse()
@@ -279,6 +363,21 @@ def make_default_opts():
     opts = optparse.Values(dict(
         datadir = "/tmp",
         host = "example.org", port = 9779,
+        threads = 0, request_queue = 64,
+        workers = 0, reuse_port = False,
+        event_loop = False,
+        session_idle_timeout = 3600, session_lifetime = 86400,
+        max_sessions = 10000, session_store = "memory",
+        session_mode = "server", session_key_file = None,
+        auth_store = "memory", auth_ttl = 2592000,
+        auth_max_per_identity = 100,
+        user = None, pam_handles = 4, pam_helpers = 0, pam_queue_depth = 32,
+        pam_timeout = 10.0, login_deadline = 10.0,
+        login_breaker_failures = 5, login_breaker_reset = 30.0,
+        login_throttle_window = 300, login_max_user_failures = 10,
+        login_max_address_failures = 100, openid_store = "file",
+        association_cache_size = 1000, housekeeping_interval = 60.0,
+        housekeeping_budget = 0.05, dh_pool_size = 32,
         ))
     return opts
 
@@ -298,16 +397,40 @@ class Test_GracieServer(scaffold.TestCase):
         scaffold.mock("server.OpenIDStore",
             mock_obj=Stub_OpenIDStore,
             outfile=self.mock_outfile)
+        scaffold.mock("server.SqliteOpenIDStore",
+            mock_obj=Stub_SqliteOpenIDStore,
+            outfile=self.mock_outfile)
+        scaffold.mock("server.DHKeyPool",
+            mock_obj=Stub_DHKeyPool,
+            outfile=self.mock_outfile)
+        scaffold.mock("server.install_key_pool",
+            mock_obj=stub_install_key_pool,
+            outfile=self.mock_outfile)
         scaffold.mock("server.ConsumerAuthStore",
             mock_obj=Stub_ConsumerAuthStore,
             outfile=self.mock_outfile)
+        scaffold.mock("server.LoggedConsumerAuthStore",
+            mock_obj=Stub_LoggedConsumerAuthStore,
+            outfile=self.mock_outfile)
         scaffold.mock("server.SessionManager",
             mock_obj=Stub_SessionManager,
             outfile=self.mock_outfile)
+        scaffold.mock("server.PamHelperPool",
+            mock_obj=Stub_PamHelperPool,
+            outfile=self.mock_outfile)
+        scaffold.mock("server.LoginThrottle",
+            mock_obj=Stub_LoginThrottle,
+            outfile=self.mock_outfile)
 
         scaffold.mock("server.HTTPServer",
             mock_obj=Stub_HTTPServer,
             outfile=self.mock_outfile)
+        scaffold.mock("server.ThreadPoolHTTPServer",
+            mock_obj=Stub_ThreadPoolHTTPServer,
+            outfile=self.mock_outfile)
+        scaffold.mock("server.AsyncHTTPServer",
+            mock_obj=Stub_ThreadPoolHTTPServer,
+            outfile=self.mock_outfile)
         scaffold.mock("server.HTTPRequestHandler",
             mock_obj=Stub_HTTPRequestHandler,
             outfile=self.mock_outfile)
@@ -327,6 +450,22 @@ class Test_GracieServer(scaffold.TestCase):
                     ),
                 datadir = "/foo/bar",
                 ),
+            'threads': dict(
+                opts = dict(
+                    threads = 4,
+                    request_queue = 16,
+                    ),
+                ),
+            'workers': dict(
+                opts = dict(
+                    workers = 3,
+                    ),
+                ),
+            'event-loop': dict(
+                opts = dict(
+                    event_loop = True,
+                    ),
+                ),
             }
 
         for key, params in self.valid_servers.items():
@@ -387,7 +526,49 @@ class Test_GracieServer(scaffold.TestCase):
             Called server.HTTPServer(
                 %(server_address)r,
                 <class '...HTTPRequestHandler'>,
-                <gracie.server.GracieServer object ...>)
+                <gracie.server.GracieServer object ...>,
+                reuse_port=False)
+            """ % vars()
+        instance = self.server_class(**params['args'])
+        self.failUnlessOutputCheckerMatch(
+            expect_mock_output, self.mock_outfile.getvalue()
+            )
+
+    def test_server_threads_creates_thread_pool_server(self):
+        """ GracieServer with threads should create a pooled server """
+        params = self.valid_servers['threads']
+        opts = params['opts']
+        server_address = (opts.host, opts.port)
+        scaffold.mock("server.ThreadPoolHTTPServer",
+            outfile=self.mock_outfile)
+        expect_mock_output = """\
+            Called server.ThreadPoolHTTPServer(
+                %(server_address)r,
+                <class '...HTTPRequestHandler'>,
+                <gracie.server.GracieServer object ...>,
+                4, 16,
+                reuse_port=False)
+            """ % vars()
+        instance = self.server_class(**params['args'])
+        self.failUnlessOutputCheckerMatch(
+            expect_mock_output, self.mock_outfile.getvalue()
+            )
+
+    def test_server_event_loop_creates_async_server(self):
+        """ GracieServer with event loop should create an async server """
+        params = self.valid_servers['event-loop']
+        opts = params['opts']
+        server_address = (opts.host, opts.port)
+        num_threads = server.default_executor_threads
+        scaffold.mock("server.AsyncHTTPServer",
+            outfile=self.mock_outfile)
+        expect_mock_output = """\
+            Called server.AsyncHTTPServer(
+                %(server_address)r,
+                <class '...HTTPRequestHandler'>,
+                <gracie.server.GracieServer object ...>,
+                %(num_threads)r, 64,
+                reuse_port=False)
             """ % vars()
         instance = self.server_class(**params['args'])
         self.failUnlessOutputCheckerMatch(
@@ -415,6 +596,37 @@ class Test_GracieServer(scaffold.TestCase):
             expect_mock_output, self.mock_outfile.getvalue()
             )
 
+    def test_sqlite_openid_store_created_in_datadir(self):
+        """ GracieServer with SQLite OpenID store should keep it in datadir """
+        opts = make_default_opts()
+        opts._update_loose(dict(openid_store = "sqlite"))
+        expect_path = os.path.join(opts.datadir, "openid.db")
+        scaffold.mock("server.SqliteOpenIDStore",
+            outfile=self.mock_outfile)
+        expect_mock_output = """\
+            Called server.SqliteOpenIDStore(%(expect_path)r)
+            """ % vars()
+        instance = self.server_class(None, opts)
+        self.failUnlessOutputCheckerMatch(
+            expect_mock_output, self.mock_outfile.getvalue()
+            )
+
+    def test_openid_store_wrapped_in_association_cache(self):
+        """ GracieServer should cache associations if configured """
+        opts = make_default_opts()
+        instance = self.server_class(None, opts)
+        store = instance.openid_server.store
+        self.failUnless(isinstance(store, server.CachingOpenIDStore))
+        self.failUnless(isinstance(store.store, Stub_OpenIDStore))
+
+    def test_zero_association_cache_size_uses_store_directly(self):
+        """ GracieServer with no association cache should use the store """
+        opts = make_default_opts()
+        opts._update_loose(dict(association_cache_size = 0))
+        instance = self.server_class(None, opts)
+        store = instance.openid_server.store
+        self.failUnless(isinstance(store, Stub_OpenIDStore))
+
     def test_server_has_auth_service(self):
         """ GracieServer should have an auth_service attribute """
         params = self.valid_servers['simple']
@@ -422,6 +634,16 @@ class Test_GracieServer(scaffold.TestCase):
         auth_service = instance.auth_service
         self.failIfIs(None, auth_service)
 
+    def test_pam_helpers_start_helper_pool(self):
+        """ GracieServer with PAM helpers should authenticate via them """
+        opts = make_default_opts()
+        opts._update_loose(dict(pam_helpers = 2))
+        instance = self.server_class(None, opts)
+        helper_pool = instance.auth_service.helper_pool
+        self.failUnless(isinstance(helper_pool, Stub_PamHelperPool))
+        self.failUnlessEqual(2, helper_pool.num_helpers)
+        self.failUnless(helper_pool.started)
+
     def test_server_has_session_manager(self):
         """ GracieServer should have a sess_manager attribute """
         params = self.valid_servers['simple']
@@ -429,6 +651,24 @@ class Test_GracieServer(scaffold.TestCase):
         sess_manager = instance.sess_manager
         self.failIfIs(None, sess_manager)
 
+    def test_signed_session_mode_uses_signed_cookie_sessions(self):
+        """ GracieServer in signed mode should sign session cookies """
+        temp_dir = tempfile.mkdtemp()
+        try:
+            key_path = os.path.join(temp_dir, "session-keys")
+            opts = make_default_opts()
+            opts._update_loose(dict(
+                session_mode = "signed",
+                session_key_file = key_path,
+                ))
+            instance = self.server_class(None, opts)
+            self.failUnless(os.path.exists(key_path))
+            self.failUnless(isinstance(
+                instance.sess_manager,
+                server.SignedCookieSessionManager))
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_server_has_authorisation_store(self):
         """ GracieServer should have a consumer_auth_store attribute """
         params = self.valid_servers['simple']
@@ -436,10 +676,98 @@ class Test_GracieServer(scaffold.TestCase):
         consumer_auth_store = instance.consumer_auth_store
         self.failIfIs(None, consumer_auth_store)
 
+    def test_server_has_login_throttle(self):
+        """ GracieServer should have a login_throttle attribute """
+        params = self.valid_servers['simple']
+        instance = params['instance']
+        login_throttle = instance.login_throttle
+        self.failIfIs(None, login_throttle)
+
+    def test_server_has_housekeeping_tasks(self):
+        """ GracieServer should have housekeeping for expired data """
+        params = self.valid_servers['simple']
+        instance = params['instance']
+        task_names = [task.name for task in instance.housekeeper.tasks]
+        expect_names = [
+            "sessions", "openid-associations", "openid-nonces",
+            "association-cache", "account-cache",
+            ]
+        self.failUnlessEqual(expect_names, task_names)
+
+    def test_server_installs_dh_key_pool(self):
+        """ GracieServer should draw DH keypairs from a pool """
+        params = self.valid_servers['simple']
+        instance = params['instance']
+        dh_key_pool = instance.dh_key_pool
+        self.failUnlessEqual(32, dh_key_pool.size)
+        self.failUnless(dh_key_pool.installed)
+
+    def test_server_without_dh_key_pool(self):
+        """ GracieServer with no DH pool size should not make a pool """
+        opts = make_default_opts()
+        opts._update_loose(dict(dh_pool_size = 0))
+        instance = self.server_class(None, opts)
+        self.failUnlessIs(None, instance.dh_key_pool)
+
+    def test_log_auth_store_created_in_datadir(self):
+        """ GracieServer with a log store should keep it in datadir """
+        opts = make_default_opts()
+        opts._update_loose(dict(auth_store = "log"))
+        expect_path = os.path.join(opts.datadir, "authorisations")
+        instance = self.server_class(None, opts)
+        consumer_auth_store = instance.consumer_auth_store
+        self.failUnless(isinstance(
+            consumer_auth_store, Stub_LoggedConsumerAuthStore))
+        self.failUnlessEqual(expect_path, consumer_auth_store.path)
+
     def test_serve_forever_is_callable(self):
         """ GracieServer.serve_forever should be callable """
         self.failUnless(callable(self.server_class.serve_forever))
 
+    def test_serve_forever_serves_from_http_server(self):
+        """ GracieServer.serve_forever should use its HTTP server """
+        params = self.valid_servers['simple']
+        instance = params['instance']
+        instance.httpserver = Mock('HTTPServer',
+            outfile=self.mock_outfile)
+        expect_mock_output = """\
+            Called HTTPServer.serve_forever()
+            """
+        instance.serve_forever()
+        self.failUnlessOutputCheckerMatch(
+            expect_mock_output, self.mock_outfile.getvalue()
+            )
+
+    def test_serve_forever_stops_helper_pool(self):
+        """ GracieServer.serve_forever should stop PAM helpers on exit """
+        opts = make_default_opts()
+        opts._update_loose(dict(pam_helpers = 2))
+        instance = self.server_class(None, opts)
+        instance.httpserver = Mock('HTTPServer',
+            outfile=self.mock_outfile)
+        instance.httpserver.serve_forever.mock_raises = KeyboardInterrupt
+        self.failUnlessRaises(KeyboardInterrupt, instance.serve_forever)
+        self.failUnless(instance.helper_pool.stopped)
+
+    def test_serve_forever_workers_runs_supervisor(self):
+        """ GracieServer with workers should run a prefork supervisor """
+        params = self.valid_servers['workers']
+        instance = params['instance']
+        mock_supervisor = Mock('PreforkSupervisor',
+            outfile=self.mock_outfile)
+        scaffold.mock("server.PreforkSupervisor",
+            returns=mock_supervisor,
+            outfile=self.mock_outfile)
+        expect_mock_output = """\
+            Called server.PreforkSupervisor(
+                3, <bound method GracieServer._serve_worker ...>)
+            Called PreforkSupervisor.run()
+            """
+        instance.serve_forever()
+        self.failUnlessOutputCheckerMatch(
+            expect_mock_output, self.mock_outfile.getvalue()
+            )
+
 
 suite = scaffold.suite(__name__)
 
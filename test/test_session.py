@@ -13,6 +13,11 @@
 """
 
 import sys
+import os
+import shutil
+import tempfile
+import cPickle
+import sqlite3
 
 import scaffold
 
@@ -27,6 +32,12 @@ class Test_SessionManager(scaffold.TestCase):
 
         self.manager_class = session.SessionManager
 
+    def _make_backend(self, max_sessions=session.default_max_sessions):
+        """ Make a single-stripe memory backend """
+        backend = session.MemorySessionBackend(
+            max_sessions=max_sessions, num_stripes=1)
+        return backend
+
     def test_create_session_should_return_session_id(self):
         """ Creating a session should return session ID """
         instance = self.manager_class()
@@ -103,6 +114,566 @@ class Test_SessionManager(scaffold.TestCase):
             KeyError,
             instance.get_session, session_id
             )
+    def test_idle_session_expires(self):
+        """ Getting a session unused past idle timeout should fail """
+        instance = self.manager_class(
+            self._make_backend(), idle_timeout=60)
+        session_id = instance.create_session()
+        entry = instance.backend._records.get(session_id)
+        entry[session._ACCESSED] -= 61
+        self.failUnlessRaises(
+            KeyError,
+            instance.get_session, session_id
+            )
+        self.failUnlessEqual(1, instance.get_stats()['expired'])
+
+    def test_expire_sessions_removes_expired(self):
+        """ expire_sessions should remove expired sessions unasked """
+        instance = self.manager_class(
+            self._make_backend(), idle_timeout=60)
+        session_id = instance.create_session()
+        entry = instance.backend._records.get(session_id)
+        entry[session._ACCESSED] -= 61
+        self.failUnlessEqual(1, instance.expire_sessions())
+        self.failIf(instance.backend.has_record(session_id))
+        self.failUnlessEqual(0, instance.expire_sessions())
+
+    def test_session_expires_after_lifetime(self):
+        """ Getting a session older than its lifetime should fail """
+        instance = self.manager_class(
+            self._make_backend(), lifetime=600)
+        session_id = instance.create_session()
+        entry = instance.backend._records.get(session_id)
+        entry[session._CREATED] -= 601
+        self.failUnlessRaises(
+            KeyError,
+            instance.get_session, session_id
+            )
+
+    def test_get_session_refreshes_idle_time(self):
+        """ Getting a session should reset its idle time """
+        instance = self.manager_class(
+            self._make_backend(), idle_timeout=60)
+        session_id = instance.create_session()
+        entry = instance.backend._records.get(session_id)
+        entry[session._ACCESSED] -= 30
+        instance.get_session(session_id)
+        entry[session._ACCESSED] -= 30
+        instance.get_session(session_id)
+
+    def test_expiry_is_incremental(self):
+        """ Each call should expire at most a batch of sessions """
+        instance = self.manager_class(
+            self._make_backend(), idle_timeout=60)
+        batch = session.expire_batch
+        session_ids = [instance.create_session() for i in range(batch * 2)]
+        for session_id in session_ids:
+            entry = instance.backend._records.get(session_id)
+            entry[session._ACCESSED] -= 61
+        instance.create_session()
+        self.failUnlessEqual(batch + 1, len(instance.backend._records))
+        self.failUnlessEqual(batch, instance.get_stats()['expired'])
+
+    def test_lifetime_expiry_skips_removed_sessions(self):
+        """ Lifetime expiry should not count already removed sessions """
+        instance = self.manager_class(
+            self._make_backend(), lifetime=600)
+        session_id = instance.create_session()
+        instance.remove_session(session_id)
+        creation_order = instance.backend._creation_order
+        (created, _) = creation_order.popleft()
+        creation_order.append((created - 601, session_id))
+        instance.create_session()
+        self.failUnlessEqual(0, instance.get_stats()['expired'])
+        self.failUnlessEqual(1, len(creation_order))
+
+    def test_generate_session_id_skips_ids_in_use(self):
+        """ Generating an ID already in use should draw another """
+        instance = self.manager_class()
+        session_id = instance.create_session()
+        instance._id_generator = Stub_SessionIDGenerator(
+            [session_id, "DECAFBAD"])
+        self.failUnlessEqual("DECAFBAD", instance.create_session())
+        self.failUnlessEqual(1, instance.get_stats()['id_collisions'])
+
+    def test_generate_session_id_gives_up_on_repeated_collision(self):
+        """ Generating IDs that always collide should raise an error """
+        instance = self.manager_class()
+        session_id = instance.create_session()
+        instance._id_generator = Stub_SessionIDGenerator(
+            [session_id] * session.max_id_attempts)
+        self.failUnlessRaises(
+            RuntimeError,
+            instance.create_session
+            )
+
+    def test_memory_report_measures_sessions(self):
+        """ memory_report should report bytes per sampled session """
+        instance = self.manager_class()
+        for i in range(10):
+            instance.create_session(dict(username="fred"))
+        report = instance.memory_report(sample_size=5)
+        self.failUnlessEqual(10, report['sessions'])
+        self.failUnlessEqual(5, report['sampled'])
+        self.failUnless(report['bytes_per_session'] > 0)
+
+    def test_max_sessions_evicts_least_recently_used(self):
+        """ Exceeding max sessions should evict least recently used """
+        backend = self._make_backend(max_sessions=2)
+        instance = self.manager_class(backend)
+        first_id = instance.create_session()
+        second_id = instance.create_session()
+        instance.get_session(first_id)
+        instance.create_session()
+        instance.get_session(first_id)
+        self.failUnlessRaises(
+            KeyError,
+            instance.get_session, second_id
+            )
+        expect_stats = dict(
+            sessions=2, expired=0, evicted=1, id_collisions=0,
+            lock_contentions=0, revoked=0)
+        self.failUnlessEqual(expect_stats, instance.get_stats())
+
+    def _create_user_session(self, manager, username):
+        """ Create a session and index it as authenticated """
+        sess = dict(username=username)
+        manager.create_session(sess)
+        manager.index_session(sess)
+        return sess['session_id']
+
+    def test_count_user_sessions_counts_indexed_sessions(self):
+        """ count_user_sessions should count each user's sessions """
+        instance = self.manager_class()
+        for i in range(3):
+            self._create_user_session(instance, "fred")
+        self._create_user_session(instance, "bill")
+        self.failUnlessEqual(3, instance.count_user_sessions("fred"))
+        self.failUnlessEqual(1, instance.count_user_sessions("bill"))
+        self.failUnlessEqual(0, instance.count_user_sessions("bogus"))
+
+    def test_count_user_sessions_skips_removed_sessions(self):
+        """ Removed and expired sessions should not be counted """
+        instance = self.manager_class(
+            self._make_backend(), idle_timeout=60)
+        removed_id = self._create_user_session(instance, "fred")
+        idle_id = self._create_user_session(instance, "fred")
+        self._create_user_session(instance, "fred")
+        instance.remove_session(removed_id)
+        entry = instance.backend._records.get(idle_id)
+        entry[session._ACCESSED] -= 61
+        self.failUnlessRaises(
+            KeyError,
+            instance.get_session, idle_id
+            )
+        self.failUnlessEqual(1, instance.count_user_sessions("fred"))
+        user_index = instance.backend._user_index
+        self.failUnlessEqual(1, len(user_index.get("fred")))
+
+    def test_count_user_sessions_follows_username_change(self):
+        """ A session authenticated as another user should move """
+        instance = self.manager_class()
+        session_id = self._create_user_session(instance, "fred")
+        sess = instance.get_session(session_id)
+        sess['username'] = "bill"
+        instance.index_session(sess)
+        self.failUnlessEqual(0, instance.count_user_sessions("fred"))
+        self.failUnlessEqual(1, instance.count_user_sessions("bill"))
+
+    def test_revoke_user_removes_only_that_users_sessions(self):
+        """ revoke_user should remove every session of the user """
+        instance = self.manager_class()
+        fred_ids = [
+            self._create_user_session(instance, "fred")
+            for i in range(3)]
+        bill_id = self._create_user_session(instance, "bill")
+        num_revoked = instance.revoke_user("fred")
+        self.failUnlessEqual(3, num_revoked)
+        for session_id in fred_ids:
+            self.failUnlessRaises(
+                KeyError,
+                instance.get_session, session_id
+                )
+        instance.get_session(bill_id)
+        self.failUnlessEqual(3, instance.get_stats()['revoked'])
+
+    def test_revoke_users_removes_sessions_of_many_users(self):
+        """ revoke_users should remove the sessions of every user """
+        instance = self.manager_class()
+        usernames = ["user%(i)d" % vars() for i in range(250)]
+        for username in usernames:
+            self._create_user_session(instance, username)
+        keep_id = self._create_user_session(instance, "fred")
+        num_revoked = instance.revoke_users(usernames)
+        self.failUnlessEqual(250, num_revoked)
+        self.failUnlessEqual(1, len(instance.backend._records))
+        instance.get_session(keep_id)
+
+
+
+class Stub_SessionIDGenerator(object):
+    """ Stub class for SessionIDGenerator """
+
+    def __init__(self, session_ids):
+        """ Set up a new instance """
+        self.session_ids = list(session_ids)
+
+    def next_id(self):
+        return self.session_ids.pop(0)
+
+
+class Test_SessionIDGenerator(scaffold.TestCase):
+    """ Test cases for SessionIDGenerator class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.generator_class = session.SessionIDGenerator
+        self.instance = self.generator_class(id_bytes=16, block_size=4)
+
+    def test_ids_are_fixed_width_hex(self):
+        """ Generated IDs should be fixed-width hexadecimal strings """
+        for i in range(10):
+            session_id = self.instance.next_id()
+            self.failUnlessEqual(32, len(session_id))
+            int(session_id, 16)
+
+    def test_ids_are_unique(self):
+        """ Generated IDs should not repeat across blocks """
+        session_ids = [self.instance.next_id() for i in range(1000)]
+        self.failUnlessEqual(len(session_ids), len(set(session_ids)))
+
+    def test_block_read_once_per_block_size(self):
+        """ Random source should be read once per block of IDs """
+        urandom_prev = session.os.urandom
+        reads = []
+        def stub_urandom(size):
+            reads.append(size)
+            return urandom_prev(size)
+        session.os.urandom = stub_urandom
+        try:
+            for i in range(8):
+                self.instance.next_id()
+        finally:
+            session.os.urandom = urandom_prev
+        self.failUnlessEqual([64, 64], reads)
+
+    def test_buffer_discarded_in_forked_process(self):
+        """ A buffer filled before a fork should not be reused after """
+        self.instance.next_id()
+        buffer_prev = self.instance._buffer
+        self.instance._pid = -1
+        self.instance.next_id()
+        self.failIfEqual(buffer_prev, self.instance._buffer)
+
+    def test_measure_id_rate_returns_positive_rate(self):
+        """ measure_id_rate should report IDs generated per second """
+        rate = session.measure_id_rate(self.instance, count=100)
+        self.failUnless(rate > 0)
+
+
+
+class Stub_OpenIDMessage(object):
+    """ Stub class for OpenID protocol message """
+
+    def __init__(self, args):
+        """ Set up a new instance """
+        self.args = args
+
+    def toPostArgs(self):
+        return dict(self.args)
+
+
+class Stub_OpenIDRequest(object):
+    """ Stub class for OpenID protocol request """
+
+    def __init__(self, args):
+        """ Set up a new instance """
+        self.message = Stub_OpenIDMessage(args)
+
+
+class Test_Session(scaffold.TestCase):
+    """ Test cases for Session class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.manager = session.SessionManager(
+            request_decoder=Stub_OpenIDRequest)
+        self.session_class = session.Session
+        self.instance = self.session_class(self.manager)
+        self.request_args = {
+            "openid.mode": "checkid_setup",
+            "openid.return_to": "http://example.com/?a=1&b=2",
+            }
+
+    def test_new_session_is_empty_and_not_created(self):
+        """ New Session should be empty and unknown to manager """
+        self.failIf(self.instance)
+        self.failUnlessEqual(0, len(self.manager.backend._records))
+
+    def test_read_does_not_create_session(self):
+        """ Reading from Session should not create it """
+        self.failUnlessEqual(None, self.instance.get('username'))
+        self.failUnlessEqual(0, len(self.manager.backend._records))
+
+    def test_setitem_creates_session(self):
+        """ Storing an item should create the session in the manager """
+        self.instance['username'] = "fred"
+        session_id = self.instance['session_id']
+        self.failUnlessIs(
+            self.instance, self.manager.get_session(session_id))
+        self.failUnlessEqual("fred", self.instance['username'])
+
+    def test_update_creates_session_once(self):
+        """ Updating should create the session only the first time """
+        self.instance.update(username="fred")
+        self.instance.update(username="bill")
+        self.failUnlessEqual(1, len(self.manager.backend._records))
+        self.failUnlessEqual("bill", self.instance['username'])
+
+    def test_behaves_as_mapping(self):
+        """ Session should behave as a mapping of its values """
+        instance = self.session_class(items=dict(
+            session_id="DEADBEEF", username="fred", colour="blue"))
+        expect_items = dict(
+            session_id="DEADBEEF", username="fred", colour="blue")
+        self.failUnlessEqual(expect_items, instance)
+        self.failUnless('colour' in instance)
+        self.failIf('openid_url' in instance)
+        self.failUnlessRaises(KeyError, instance.__getitem__, 'spam')
+
+    def test_username_is_interned(self):
+        """ Session should intern the username string """
+        username = "".join(["fr", "ed"])
+        self.instance['username'] = username
+        self.failUnlessIs(intern("fred"), self.instance['username'])
+
+    def test_compact_encodes_pending_request(self):
+        """ compact should keep only the pending request's arguments """
+        openid_request = Stub_OpenIDRequest(self.request_args)
+        self.instance.update(dict(
+            last_openid_request = openid_request,
+            openid_url = "http://example.org/id/fred",
+            ))
+        self.instance.compact()
+        self.failUnlessEqual(None, self.instance._request)
+        self.failUnlessEqual(None, self.instance.get('openid_url'))
+        got_request = self.instance['last_openid_request']
+        self.failUnlessEqual(self.request_args, got_request.message.args)
+
+    def test_pickle_keeps_compact_state(self):
+        """ Pickled session should keep values but not its manager """
+        openid_request = Stub_OpenIDRequest(self.request_args)
+        self.instance.update(dict(
+            username = "fred",
+            last_openid_request = openid_request,
+            ))
+        data = cPickle.dumps(self.instance, cPickle.HIGHEST_PROTOCOL)
+        got_session = cPickle.loads(data)
+        self.failUnlessEqual(None, got_session.request_decoder)
+        self.failUnlessEqual(
+            self.instance['session_id'], got_session['session_id'])
+        self.failUnlessEqual("fred", got_session['username'])
+        got_session.request_decoder = Stub_OpenIDRequest
+        got_request = got_session['last_openid_request']
+        self.failUnlessEqual(self.request_args, got_request.message.args)
+
+    def test_decoder_not_shared_between_managers(self):
+        """ Each manager's sessions should use that manager's decoder """
+        other_manager = session.SessionManager()
+        other_session = self.session_class(other_manager)
+        other_session['username'] = "bill"
+        self.instance['username'] = "fred"
+        self.failUnlessEqual(None, other_session.request_decoder)
+        self.failUnlessEqual(
+            Stub_OpenIDRequest, self.instance.request_decoder)
+
+    def test_smaller_than_dict(self):
+        """ Session should take less memory than an equivalent dict """
+        values = dict(session_id="DEADBEEF", username="fred")
+        instance = self.session_class(items=values)
+        self.failUnless(
+            session.deep_size(instance) < session.deep_size(values))
+
+
+
+class Test_SqliteSessionBackend(scaffold.TestCase):
+    """ Test cases for SqliteSessionBackend class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.temp_dir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.temp_dir, "sessions.db")
+        self.backend_class = session.SqliteSessionBackend
+        self.instance = self.backend_class(self.store_path)
+        self.manager = session.SessionManager(self.instance)
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        shutil.rmtree(self.temp_dir)
+
+    def _reopen(self, request_decoder=None):
+        """ Make a new manager on the same database file """
+        backend = self.backend_class(self.store_path)
+        manager = session.SessionManager(
+            backend, request_decoder=request_decoder)
+        return manager
+
+    def test_database_uses_write_ahead_log(self):
+        """ SqliteSessionBackend should open the database in WAL mode """
+        connection = self.instance._get_connection()
+        cursor = connection.execute("PRAGMA journal_mode")
+        self.failUnlessEqual("wal", cursor.fetchone()[0])
+
+    def test_flushed_session_survives_reopen(self):
+        """ A flushed session should be readable by a new backend """
+        session_id = self.manager.create_session(dict(username="fred"))
+        self.manager.flush()
+        manager = self._reopen()
+        got_session = manager.get_session(session_id)
+        self.failUnlessEqual("fred", got_session['username'])
+
+    def test_stored_request_decoded_by_manager_decoder(self):
+        """ A stored pending request should use the manager's decoder """
+        request_args = {"openid.mode": "checkid_setup"}
+        instance = session.Session(self.manager)
+        instance['last_openid_request'] = Stub_OpenIDRequest(request_args)
+        self.manager.save_session(instance)
+        self.manager.flush()
+        manager = self._reopen(request_decoder=Stub_OpenIDRequest)
+        got_session = manager.get_session(instance['session_id'])
+        got_request = got_session['last_openid_request']
+        self.failUnlessEqual(request_args, got_request.message.args)
+
+    def test_unflushed_session_not_stored(self):
+        """ A session should not be written until flushed """
+        session_id = self.manager.create_session(dict(username="fred"))
+        manager = self._reopen()
+        self.failUnlessRaises(
+            KeyError,
+            manager.get_session, session_id
+            )
+
+    def test_saved_changes_survive_reopen(self):
+        """ Saved session changes should be readable after flush """
+        session_id = self.manager.create_session()
+        self.manager.flush()
+        got_session = self.manager.get_session(session_id)
+        got_session['username'] = "bill"
+        self.manager.save_session(got_session)
+        self.manager.flush()
+        manager = self._reopen()
+        self.failUnlessEqual(
+            "bill", manager.get_session(session_id)['username'])
+
+    def test_unchanged_session_not_written(self):
+        """ Saving an unchanged session should not write to database """
+        session_id = self.manager.create_session(dict(username="fred"))
+        self.manager.flush()
+        writes_prev = self.instance.writes
+        got_session = self.manager.get_session(session_id)
+        self.manager.save_session(got_session)
+        self.manager.flush()
+        self.failUnlessEqual(writes_prev, self.instance.writes)
+
+    def test_read_is_cached(self):
+        """ Reading a session again should be served from cache """
+        session_id = self.manager.create_session()
+        self.manager.flush()
+        manager = self._reopen()
+        manager.get_session(session_id)
+        manager.get_session(session_id)
+        stats = manager.get_stats()
+        self.failUnlessEqual(1, stats['cache_hits'])
+
+    def test_removed_session_not_readable_after_reopen(self):
+        """ A removed session should be gone from the database """
+        session_id = self.manager.create_session()
+        self.manager.flush()
+        self.manager.remove_session(session_id)
+        self.manager.flush()
+        manager = self._reopen()
+        self.failUnlessRaises(
+            KeyError,
+            manager.get_session, session_id
+            )
+
+    def test_expire_records_removes_idle_sessions(self):
+        """ expire_records should delete sessions past idle timeout """
+        session_id = self.manager.create_session()
+        self.manager.flush()
+        now = self.instance.get_record(session_id)[session._ACCESSED]
+        num_expired = self.instance.expire_records(now + 61, 60, 600)
+        self.failUnlessEqual(1, num_expired)
+
+    def test_expire_records_drops_expired_from_cache(self):
+        """ expire_records should not leave expired sessions cached """
+        session_id = self.manager.create_session()
+        self.manager.flush()
+        now = self.instance.get_record(session_id)[session._ACCESSED]
+        self.instance.expire_records(now + 61, 60, 600)
+        self.failUnlessEqual(None, self.instance.get_record(session_id))
+        self.failIf(self.instance.has_record(session_id))
+
+    def test_expire_records_keeps_sessions_with_queued_touch(self):
+        """ expire_records should keep a session this process touched """
+        session_id = self.manager.create_session()
+        self.manager.flush()
+        record = self.instance.get_record(session_id)
+        now = record[session._ACCESSED]
+        self.instance.touch_record(
+            session_id, record, now + session.touch_interval)
+        num_expired = self.instance.expire_records(now + 61, 60, 600)
+        self.failUnlessEqual(0, num_expired)
+        self.failIfIs(None, self.instance.get_record(session_id))
+
+    def test_user_sessions_found_after_reopen(self):
+        """ A user's stored sessions should be found by username """
+        for i in range(2):
+            self.manager.create_session(dict(username="fred"))
+        self.manager.create_session(dict(username="bill"))
+        self.manager.flush()
+        manager = self._reopen()
+        self.failUnlessEqual(2, manager.count_user_sessions("fred"))
+
+    def test_user_sessions_include_unflushed_changes(self):
+        """ Counting a user's sessions should see queued changes """
+        session_id = self.manager.create_session(dict(username="fred"))
+        self.manager.flush()
+        sess = self.manager.get_session(session_id)
+        sess['username'] = "bill"
+        self.manager.save_session(sess)
+        self.manager.create_session(dict(username="bill"))
+        self.failUnlessEqual(0, self.manager.count_user_sessions("fred"))
+        self.failUnlessEqual(2, self.manager.count_user_sessions("bill"))
+
+    def test_revoke_user_removes_stored_sessions(self):
+        """ Revoked sessions should be gone from the database """
+        fred_id = self.manager.create_session(dict(username="fred"))
+        bill_id = self.manager.create_session(dict(username="bill"))
+        self.manager.flush()
+        self.failUnlessEqual(1, self.manager.revoke_user("fred"))
+        manager = self._reopen()
+        self.failUnlessRaises(
+            KeyError,
+            manager.get_session, fred_id
+            )
+        manager.get_session(bill_id)
+
+    def test_database_without_username_column_is_upgraded(self):
+        """ A database from before the username column should work """
+        connection = sqlite3.connect(self.store_path)
+        connection.execute(
+            "CREATE TABLE sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL,"
+            " data BLOB NOT NULL)")
+        connection.commit()
+        connection.close()
+        self.manager.create_session(dict(username="fred"))
+        self.manager.flush()
+        self.failUnlessEqual(1, self.manager.count_user_sessions("fred"))
+
 
 
 suite = scaffold.suite(__name__)
@@ -0,0 +1,249 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# test/test_signedsession.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for signedsession module
+"""
+
+import sys
+import os
+import shutil
+import tempfile
+
+import scaffold
+
+from gracie import signedsession
+
+
+class Test_constant_time_equal(scaffold.TestCase):
+    """ Test cases for constant_time_equal function """
+
+    def test_equal_strings_compare_equal(self):
+        """ constant_time_equal should be True for equal strings """
+        self.failUnless(signedsession.constant_time_equal("spam", "spam"))
+
+    def test_different_strings_compare_unequal(self):
+        """ constant_time_equal should be False for different strings """
+        for other in ["spaM", "spa", "spams", ""]:
+            self.failIf(signedsession.constant_time_equal("spam", other))
+
+
+def write_key_file(path, keys):
+    """ Write (key_id, secret) pairs to a key file """
+    key_file = open(path, 'w')
+    for (key_id, secret) in keys:
+        key_file.write("%s %s\n" % (key_id, secret.encode('hex')))
+    key_file.close()
+
+
+class Test_SessionKeyRing(scaffold.TestCase):
+    """ Test cases for SessionKeyRing class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.temp_dir = tempfile.mkdtemp()
+        self.key_path = os.path.join(self.temp_dir, "session-keys")
+        write_key_file(self.key_path, [("old", "secret one")])
+        self.key_ring_class = signedsession.SessionKeyRing
+        self.instance = self.key_ring_class(self.key_path)
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        shutil.rmtree(self.temp_dir)
+
+    def _rotate_keys(self):
+        """ Add a new signing key to the key file and reload """
+        write_key_file(self.key_path, [
+            ("new", "secret two"), ("old", "secret one")])
+        self.instance._mtime = None
+        self.instance.reload_if_changed(force=True)
+
+    def test_verify_returns_signed_payload(self):
+        """ verify should return the payload of a signed token """
+        token = self.instance.sign("spam=eggs")
+        self.failUnlessEqual("spam=eggs", self.instance.verify(token))
+
+    def test_verify_rejects_tampered_token(self):
+        """ verify should reject a token with altered payload """
+        token = self.instance.sign("u=fred")
+        (key_id, payload, signature) = token.split(".")
+        forged_payload = signedsession._b64encode("u=root")
+        forged_token = ".".join([key_id, forged_payload, signature])
+        self.failUnlessEqual(None, self.instance.verify(forged_token))
+
+    def test_verify_rejects_malformed_token(self):
+        """ verify should reject tokens not in signed form """
+        for token in ["", "spam", "old.spam", None]:
+            self.failUnlessEqual(None, self.instance.verify(token))
+
+    def test_rotated_key_signs_and_old_key_verifies(self):
+        """ After rotation, new key should sign and old key verify """
+        old_token = self.instance.sign("spam")
+        self._rotate_keys()
+        new_token = self.instance.sign("eggs")
+        self.failUnless(new_token.startswith("new."))
+        self.failUnlessEqual("spam", self.instance.verify(old_token))
+        self.failUnlessEqual("eggs", self.instance.verify(new_token))
+
+    def test_removed_key_no_longer_verifies(self):
+        """ A token signed with a removed key should be rejected """
+        token = self.instance.sign("spam")
+        write_key_file(self.key_path, [("new", "secret two")])
+        self.instance._mtime = None
+        self.instance.reload_if_changed(force=True)
+        self.failUnlessEqual(None, self.instance.verify(token))
+
+    def test_generate_key_file_creates_private_file(self):
+        """ generate_key_file should create a readable private key file """
+        path = os.path.join(self.temp_dir, "generated-keys")
+        signedsession.generate_key_file(path)
+        self.failUnlessEqual(0600, os.stat(path).st_mode & 0777)
+        key_ring = self.key_ring_class(path)
+        self.failUnlessEqual(1, len(key_ring.keys))
+
+
+class Stub_OpenIDMessage(object):
+    """ Stub class for OpenID protocol message """
+
+    def __init__(self, args):
+        """ Set up a new instance """
+        self.args = args
+
+    def toPostArgs(self):
+        return dict(self.args)
+
+
+class Stub_OpenIDRequest(object):
+    """ Stub class for OpenID protocol request """
+
+    def __init__(self, args):
+        """ Set up a new instance """
+        self.message = Stub_OpenIDMessage(args)
+
+
+class Test_SignedCookieSessionManager(scaffold.TestCase):
+    """ Test cases for SignedCookieSessionManager class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.temp_dir = tempfile.mkdtemp()
+        key_path = os.path.join(self.temp_dir, "session-keys")
+        signedsession.generate_key_file(key_path)
+        self.key_ring = signedsession.SessionKeyRing(key_path)
+        self.manager_class = signedsession.SignedCookieSessionManager
+        self.instance = self.manager_class(
+            self.key_ring, Stub_OpenIDRequest,
+            idle_timeout=60, lifetime=600)
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_session_returns_created_session(self):
+        """ Getting a created session should return its username """
+        session_id = self.instance.create_session(dict(username="fred"))
+        session = self.instance.get_session(session_id)
+        self.failUnlessEqual("fred", session['username'])
+        self.failUnlessEqual(session_id, session['session_id'])
+
+    def test_get_session_unknown_id_raises_keyerror(self):
+        """ Getting an invalid or missing token should raise KeyError """
+        for session_id in [None, "DECAFBAD"]:
+            self.failUnlessRaises(
+                KeyError,
+                self.instance.get_session, session_id
+                )
+        self.failUnlessEqual(1, self.instance.get_stats()['rejected'])
+
+    def test_get_session_idle_expired_raises_keyerror(self):
+        """ Getting a token past idle timeout should raise KeyError """
+        session = dict(username="fred")
+        session_id = self.instance._issue_token(
+            session, signedsession.time.time() - 120,
+            signedsession.time.time() - 61)
+        self.failUnlessRaises(
+            KeyError,
+            self.instance.get_session, session_id
+            )
+        self.failUnlessEqual(1, self.instance.get_stats()['expired'])
+
+    def test_pending_request_carried_in_token(self):
+        """ Session should carry the pending OpenID request arguments """
+        request_args = {
+            "openid.mode": "checkid_setup",
+            "openid.return_to": "http://example.com/?a=1&b=2",
+            }
+        session = dict(last_openid_request=Stub_OpenIDRequest(request_args))
+        session_id = self.instance.create_session(session)
+        got_session = self.instance.get_session(session_id)
+        openid_request = got_session['last_openid_request']
+        self.failUnlessEqual(request_args, openid_request.message.args)
+
+    def test_oversized_pending_request_refused(self):
+        """ A session too large for a cookie should raise an error """
+        request_args = {
+            "openid.mode": "checkid_setup",
+            "openid.return_to": "http://example.com/?" + "a" * 4000,
+            }
+        session = dict(last_openid_request=Stub_OpenIDRequest(request_args))
+        self.failUnlessRaises(
+            signedsession.SessionTooLargeError,
+            self.instance.create_session, session
+            )
+        self.failIf('session_id' in session)
+        self.failUnlessEqual(1, self.instance.get_stats()['oversized'])
+
+    def test_save_unchanged_session_keeps_token(self):
+        """ Saving an unchanged session should keep its token """
+        session_id = self.instance.create_session(dict(username="fred"))
+        session = self.instance.get_session(session_id)
+        session['auth_entry'] = dict(name="fred")
+        self.instance.save_session(session)
+        self.failUnlessEqual(session_id, session['session_id'])
+
+    def test_save_changed_session_reissues_token(self):
+        """ Saving a changed session should issue a new token """
+        session_id = self.instance.create_session(dict())
+        session = self.instance.get_session(session_id)
+        session['username'] = "bill"
+        self.instance.save_session(session)
+        new_session_id = session['session_id']
+        self.failIfEqual(session_id, new_session_id)
+        got_session = self.instance.get_session(new_session_id)
+        self.failUnlessEqual("bill", got_session['username'])
+
+    def test_revoke_user_rejects_issued_tokens(self):
+        """ Tokens issued to a revoked user should be rejected """
+        fred_id = self.instance.create_session(dict(username="fred"))
+        bill_id = self.instance.create_session(dict(username="bill"))
+        self.failUnlessEqual(1, self.instance.revoke_user("fred"))
+        self.failUnlessRaises(
+            KeyError,
+            self.instance.get_session, fred_id
+            )
+        self.instance.get_session(bill_id)
+        self.failUnlessEqual(1, self.instance.get_stats()['revoked'])
+
+    def test_revoke_user_accepts_later_tokens(self):
+        """ Tokens issued after revocation should be accepted """
+        self.instance.revoke_user("fred")
+        session = dict(username="fred")
+        now = signedsession.time.time()
+        session_id = self.instance._issue_token(session, now + 1, now + 1)
+        self.instance.get_session(session_id)
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
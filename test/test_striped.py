@@ -0,0 +1,104 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# test/test_striped.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for striped module
+"""
+
+import sys
+import threading
+import time
+
+import scaffold
+
+from gracie import striped
+
+
+class Test_StripedDict(scaffold.TestCase):
+    """ Test cases for StripedDict class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.dict_class = striped.StripedDict
+        self.instance = self.dict_class(num_stripes=4)
+
+    def test_instantiate(self):
+        """ New StripedDict instance should be created """
+        self.failIfIs(None, self.instance)
+
+    def test_get_returns_stored_value(self):
+        """ get should return the value stored for a key """
+        self.instance.set('spam', 1)
+        self.failUnlessEqual(1, self.instance.get('spam'))
+        self.failUnless('spam' in self.instance)
+        self.failUnlessEqual(None, self.instance.get('eggs'))
+
+    def test_keys_spread_across_stripes(self):
+        """ Keys should be stored in the stripe their hash selects """
+        for i in range(100):
+            self.instance.set(i, i)
+        sizes = [len(stripe.mapping) for stripe in self.instance.stripes]
+        self.failUnlessEqual([25, 25, 25, 25], sizes)
+        self.failUnlessEqual(100, len(self.instance))
+
+    def test_pop_removes_key(self):
+        """ pop should remove the key and return its value """
+        self.instance.set('spam', 1)
+        self.failUnlessEqual(1, self.instance.pop('spam'))
+        self.failUnlessEqual(None, self.instance.pop('spam'))
+
+    def test_get_or_create_creates_once(self):
+        """ get_or_create should only call the factory when absent """
+        (value, created) = self.instance.get_or_create('spam', list)
+        self.failUnlessEqual(([], True), (value, created))
+        (got_value, created) = self.instance.get_or_create('spam', list)
+        self.failUnlessIs(value, got_value)
+        self.failIf(created)
+
+    def test_compare_and_set_requires_expected_value(self):
+        """ compare_and_set should store only over the expected value """
+        missing = striped.missing
+        self.failUnless(self.instance.compare_and_set('spam', missing, 1))
+        self.failIf(self.instance.compare_and_set('spam', missing, 2))
+        self.failIf(self.instance.compare_and_set('spam', 3, 2))
+        self.failUnless(self.instance.compare_and_set('spam', 1, 2))
+        self.failUnlessEqual(2, self.instance.get('spam'))
+
+    def test_bulk_operations(self):
+        """ set_many, get_many and pop_many should act on every key """
+        items = dict([(i, str(i)) for i in range(10)])
+        self.instance.set_many(items.items())
+        self.failUnlessEqual(items, self.instance.get_many(range(20)))
+        popped = self.instance.pop_many([1, 2, 99])
+        self.failUnlessEqual({1: "1", 2: "2"}, popped)
+        self.failUnlessEqual(8, len(self.instance))
+
+    def test_contention_counted_per_stripe(self):
+        """ Waiting for a held stripe lock should count contention """
+        stripe = self.instance.stripe_for('spam')
+        stripe.acquire()
+        reader = threading.Thread(target=self.instance.get, args=('spam',))
+        reader.start()
+        time.sleep(0.05)
+        stripe.release()
+        reader.join()
+        index = self.instance.stripes.index(stripe)
+        stats = self.instance.get_stats()
+        self.failUnlessEqual(1, stats['contentions'][index])
+        self.failUnlessEqual(1, sum(stats['contentions']))
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
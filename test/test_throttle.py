@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# test/test_throttle.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for throttle module
+"""
+
+import sys
+import os
+
+import scaffold
+from test_authservice import Stub_TimeModule
+
+from gracie import throttle
+
+
+class Test_LoginThrottle(scaffold.TestCase):
+    """ Test cases for LoginThrottle class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.throttle_class = throttle.LoginThrottle
+        self.time_module_prev = throttle.time
+        self.time_module = Stub_TimeModule(3000.0)
+        throttle.time = self.time_module
+        self.address = "192.0.2.1"
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        throttle.time = self.time_module_prev
+
+    def _make_throttle(self, **kwargs):
+        """ Make a throttle with small limits """
+        params = dict(
+            window = 100, max_user_failures = 3,
+            max_address_failures = 5, num_slots = 64,
+            )
+        params.update(kwargs)
+        return self.throttle_class(**params)
+
+    def _fail(self, instance, username, count, address=None):
+        """ Record failed logins """
+        if address is None:
+            address = self.address
+        for i in range(count):
+            instance.record_failure(username, address)
+
+    def test_new_throttle_allows_login(self):
+        """ A login with no failures recorded should be allowed """
+        instance = self._make_throttle()
+        self.failUnless(instance.is_allowed("fred", self.address))
+
+    def test_user_failures_below_limit_allow_login(self):
+        """ Fewer user failures than the limit should allow a login """
+        instance = self._make_throttle()
+        self._fail(instance, "fred", 2)
+        self.failUnless(instance.is_allowed("fred", self.address))
+
+    def test_user_failures_at_limit_refuse_login(self):
+        """ User failures reaching the limit should refuse the user """
+        instance = self._make_throttle()
+        self._fail(instance, "fred", 3)
+        self.failIf(instance.is_allowed("fred", "192.0.2.99"))
+        self.failUnless(instance.is_allowed("bill", "192.0.2.99"))
+        self.failUnlessEqual(1, instance.get_stats()['rejected_users'])
+
+    def test_address_failures_at_limit_refuse_address(self):
+        """ Address failures reaching the limit should refuse the address """
+        instance = self._make_throttle()
+        for index in range(5):
+            self._fail(instance, "user%(index)d" % vars(), 1)
+        self.failIf(instance.is_allowed("bill", self.address))
+        self.failUnless(instance.is_allowed("bill", "192.0.2.99"))
+        self.failUnlessEqual(1, instance.get_stats()['rejected_addresses'])
+
+    def test_zero_limit_never_refuses(self):
+        """ A limit of zero should not refuse on that key """
+        instance = self._make_throttle(max_user_failures = 0)
+        self._fail(instance, "fred", 4)
+        self.failUnless(instance.is_allowed("fred", "192.0.2.99"))
+
+    def test_failures_decay_over_next_window(self):
+        """ Failures should count less as the window slides past them """
+        instance = self._make_throttle()
+        self._fail(instance, "fred", 3)
+        self.time_module.now += 100
+        self.failIf(instance.is_allowed("fred", self.address))
+        self.time_module.now += 50
+        self.failUnless(instance.is_allowed("fred", self.address))
+        self.time_module.now += 100
+        self._fail(instance, "fred", 2)
+        self.failUnless(instance.is_allowed("fred", self.address))
+
+    def test_unicode_username_counted(self):
+        """ A unicode username should be counted like its encoding """
+        instance = self._make_throttle()
+        self._fail(instance, u"fréd", 3)
+        self.failIf(instance.is_allowed(
+            u"fréd".encode('utf-8'), "192.0.2.99"))
+
+    def test_many_keys_stay_within_table(self):
+        """ Failures for more keys than slots should evict, not grow """
+        instance = self._make_throttle(
+            max_address_failures = 0, num_slots = 8)
+        for index in range(50):
+            self._fail(instance, "user%(index)d" % vars(), 1)
+        self.failUnless(instance.get_stats()['evictions'] > 0)
+        self.failUnlessEqual(8 * throttle._slot_size, len(instance._table))
+
+    def test_failures_shared_with_forked_process(self):
+        """ Failures recorded in a forked process should be seen here """
+        instance = self._make_throttle()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self._fail(instance, "fred", 3)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.failIf(instance.is_allowed("fred", self.address))
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)
@@ -0,0 +1,81 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+# test/test_workerpool.py
+# Part of Gracie, an OpenID provider
+#
+# Copyright © 2007-2008 Ben Finney <ben+python@benfinney.id.au>
+# This is free software; you may copy, modify and/or distribute this work
+# under the terms of the GNU General Public License, version 2 or later.
+# No warranty expressed or implied. See the file LICENSE for details.
+
+""" Unit test for workerpool module
+"""
+
+import sys
+import threading
+
+import scaffold
+
+from gracie import workerpool
+
+
+class Test_WorkerPool(scaffold.TestCase):
+    """ Test cases for WorkerPool class """
+
+    def setUp(self):
+        """ Set up test fixtures """
+        self.pool_class = workerpool.WorkerPool
+        self.instance = self.pool_class(3, queue_size=10)
+        self.instance.start()
+
+    def tearDown(self):
+        """ Tear down test fixtures """
+        self.instance.stop()
+
+    def test_instantiate(self):
+        """ New WorkerPool instance should be created """
+        self.failIfIs(None, self.instance)
+
+    def test_num_threads_as_specified(self):
+        """ WorkerPool should have specified number of threads """
+        self.failUnlessEqual(3, self.instance.num_threads)
+
+    def test_submit_runs_job_with_args(self):
+        """ Submitted job should be called with its arguments """
+        results = []
+        done = threading.Event()
+        def job(value, scale=1):
+            results.append(value * scale)
+            done.set()
+        self.instance.submit(job, 7, scale=6)
+        done.wait(5)
+        self.failUnlessEqual([42], results)
+
+    def test_try_submit_refuses_job_when_queue_full(self):
+        """ try_submit should refuse a job rather than wait for room """
+        instance = self.pool_class(1, queue_size=1)
+        self.failUnless(instance.try_submit(int))
+        self.failIf(instance.try_submit(int))
+        instance.start()
+        instance.stop()
+
+    def test_failing_job_does_not_stop_worker(self):
+        """ A job raising an exception should not kill its worker """
+        done = threading.Event()
+        def bad_job():
+            raise ValueError("Bad job")
+        for _ in range(self.instance.num_threads):
+            self.instance.submit(bad_job)
+        self.instance.submit(done.set)
+        done.wait(5)
+        self.failUnless(done.isSet())
+
+
+suite = scaffold.suite(__name__)
+
+__main__ = scaffold.unittest_main
+
+if __name__ == '__main__':
+    exitcode = __main__(sys.argv)
+    sys.exit(exitcode)